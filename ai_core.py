@@ -1,102 +1,385 @@
+import asyncio
 import json
-from datetime import date, timedelta
+import os
+import threading
+import time
+from datetime import timedelta
 import functions
+import intents
+import metrics
 import openrouter_ai
+import tools
+from llm_cache import get_llm_cache
+from sessions import get_session_store, add_to_history
+from storage import get_storage, user_today
 
-# Глобальная переменная для хранения состояния диалога
-# Формат: {user_id: {'state': 'some_state', 'params': {...}}}
-conversation_state = {}
+# Сколько секунд ждать ответа "да"/"нет" на вопрос о подтверждении удаления
+CONFIRMATION_TTL = int(os.getenv('CONFIRMATION_TTL', '300'))
 
-def load_prompt() -> str:
-    """Загружает системный промпт из файла."""
+# Команды, которые выполняются только после подтверждения пользователя
+DESTRUCTIVE_COMMANDS = ('delete_tasks', 'delete_all_tasks')
+# Повторный запрос к модели, если её JSON не удалось разобрать даже после локальной починки
+REPAIR_REQUEST = ("Твой предыдущий ответ не удалось разобрать. Повтори вызов инструментов "
+                  "корректным JSON без пояснений или ответь обычным текстом.")
+
+# Статистика быстрого пути (локального распознавания команд)
+# llm_latency — скользящая оценка времени ответа AI, по ней считается сэкономленное время
+intent_stats = {'local_hits': 0, 'llm_calls': 0, 'time_saved': 0.0, 'llm_latency': 2.0}
+_stats_lock = threading.Lock()
+
+def load_prompt(user_id: int) -> str:
+    """Загружает системный промпт из файла. Даты в нем — по часовому поясу пользователя."""
     with open('ai_prompt.txt', 'r', encoding='utf-8') as f:
         prompt = f.read()
-    
-    today = date.today()
+
+    today = user_today(user_id)
     tomorrow = today + timedelta(days=1)
     day_after_tomorrow = today + timedelta(days=2)
 
     prompt = prompt.replace('{current_date}', today.strftime('%Y-%m-%d'))
     prompt = prompt.replace('{current_date_tomorrow}', tomorrow.strftime('%Y-%m-%d'))
     prompt = prompt.replace('{day_after_tomorrow_date}', day_after_tomorrow.strftime('%Y-%m-%d'))
-    
+
     return prompt
 
-def process_message(user_id: int, text: str) -> str:
+def get_intent_stats() -> dict:
+    """Возвращает счетчики быстрого пути: попадания, обращения к AI, долю попаданий и сэкономленное время (с)."""
+    with _stats_lock:
+        stats = dict(intent_stats)
+    total = stats['local_hits'] + stats['llm_calls']
+    stats['hit_rate'] = stats['local_hits'] / total if total else 0.0
+    return stats
+
+def _record_local_hit(elapsed: float):
+    with _stats_lock:
+        intent_stats['local_hits'] += 1
+        intent_stats['time_saved'] += max(intent_stats['llm_latency'] - elapsed, 0.0)
+
+def _record_llm_call(elapsed: float):
+    with _stats_lock:
+        intent_stats['llm_calls'] += 1
+        intent_stats['llm_latency'] = 0.8 * intent_stats['llm_latency'] + 0.2 * elapsed
+
+def _ask_confirmation(session: dict, state: str, params: dict, question: str) -> str:
+    """Запоминает в сессии действие, ожидающее подтверждения, и возвращает вопрос пользователю."""
+    session['pending'] = {'state': state, 'params': params, 'expires_at': time.time() + CONFIRMATION_TTL}
+    return question
+
+def execute_tool_call(user_id: int, tool_call: dict, session: dict) -> str:
     """
-    Обрабатывает сообщение пользователя, определяет намерение и возвращает ответ.
+    Выполняет вызов инструмента формата {"tool_call": ..., "arguments": ...} и возвращает ответ пользователю.
+    session — открытая сессия чата (см. sessions.SessionStore.open), в неё записываются вопросы о подтверждении.
     """
-    global conversation_state
-
-    state_info = conversation_state.get(user_id)
-
-    # 1. Проверка, ожидаем ли мы подтверждения какого-либо действия
-    if state_info:
-        state = state_info.get('state')
-        # Подтверждение удаления ВСЕХ задач
-        if state == 'awaiting_confirmation_delete_all':
-            if text.lower() in ['да', 'yes']:
-                conversation_state.pop(user_id, None)
-                return functions.delete_all_tasks()
-            elif text.lower() in ['нет', 'no']:
-                conversation_state.pop(user_id, None)
-                return "Отмена операции. Задачи не были удалены."
-            else:
-                return "Пожалуйста, ответьте 'да' или 'нет'."
-        
-        # Подтверждение удаления конкретных задач (по дате или номеру)
-        elif state == 'awaiting_confirmation_delete_specific':
-            if text.lower() in ['да', 'yes']:
-                params = state_info.get('params', {})
-                result = functions.delete_tasks(date=params.get('date'), task_number=params.get('task_number'))
-                conversation_state.pop(user_id, None)
-                return result
-            elif text.lower() in ['нет', 'no']:
-                conversation_state.pop(user_id, None)
-                return "Отмена операции. Ничего не было удалено."
+    command = tool_call['tool_call']
+    args, error = _validate(tool_call)
+    if error:
+        return error
+    with metrics.span('storage', op=command):
+        return _execute_tool(user_id, command, args, session)
+
+def _validate(tool_call: dict):
+    """Проверяет аргументы по схеме инструмента. Возвращает (аргументы, None) или (None, ответ об ошибке)."""
+    args, error = tools.validate(tool_call['tool_call'], tool_call.get('arguments'))
+    if error:
+        metrics.inc('tool_calls_invalid_total', tool=tool_call['tool_call'])
+        return None, f"❌ Не удалось выполнить {tool_call['tool_call']}: {error}."
+    return args, None
+
+def execute_tool_calls(user_id: int, calls: list, session: dict) -> str:
+    """
+    Выполняет пакет вызовов инструментов (например, добавление нескольких задач из одного сообщения).
+    Аргументы проверяются по схемам из tools.py, все изменения записываются одной транзакцией.
+    Удаления не выполняются сразу: по ним пользователю задается один общий вопрос о подтверждении.
+    """
+    if len(calls) == 1:
+        return execute_tool_call(user_id, calls[0], session)
+
+    results = []
+    deletions = []
+    with metrics.span('storage', op='batch', calls=len(calls)), get_storage().batch():
+        for call in calls:
+            command = call['tool_call']
+            args, error = _validate(call)
+            if error:
+                results.append(error)
+            elif command in DESTRUCTIVE_COMMANDS:
+                deletions.append({'tool_call': command, 'arguments': args})
             else:
-                return "Пожалуйста, ответьте 'да' или 'нет'."
-
-    # 2. Основная логика, если нет активного состояния
-    prompt = load_prompt()
-    ai_response_text = openrouter_ai.get_ai_response(prompt, text)
-
-    try:
-        tool_call = json.loads(ai_response_text)
-        if 'tool_call' in tool_call:
-            command = tool_call['tool_call']
-            args = tool_call.get('arguments', {})
-
-            if command == 'add_task':
-                return functions.add_task(args.get('date'), args.get('task'))
-            
-            elif command == 'show_tasks':
-                return functions.show_tasks(args.get('date'))
-            
-            elif command == 'delete_tasks':
-                params = {'date': args.get('date'), 'task_number': args.get('task_number')}
-                if not params['date']:
-                    return "Не могу удалить, т.к. не понял дату. Попробуйте уточнить."
-                
-                if params['task_number'] is not None:
-                    confirmation_question = f"Вы уверены, что хотите удалить задачу №{params['task_number']} на {params['date']}? (да/нет)"
-                else:
-                    confirmation_question = f"Вы уверены, что хотите удалить ВСЕ задачи на {params['date']}? (да/нет)"
-                
-                conversation_state[user_id] = {
-                    'state': 'awaiting_confirmation_delete_specific',
-                    'params': params
-                }
-                return confirmation_question
-
-            elif command == 'delete_all_tasks':
-                conversation_state[user_id] = {'state': 'awaiting_confirmation_delete_all', 'params': {}}
-                return "Вы уверены, что хотите удалить АБСОЛЮТНО все задачи? Это действие необратимо. (да/нет)"
-            
+                results.append(_execute_tool(user_id, command, args, session))
+
+    if len(deletions) == 1:
+        results.append(_execute_tool(user_id, deletions[0]['tool_call'], deletions[0]['arguments'], session))
+    elif deletions:
+        lines = [_deletion_description(call) for call in deletions]
+        results.append(_ask_confirmation(
+            session, 'awaiting_confirmation_batch', {'actions': deletions},
+            "Вы уверены, что хотите удалить:\n" + "\n".join(f"• {line}" for line in lines) + "\n(да/нет)"
+        ))
+    return "\n".join(results)
+
+def _deletion_description(call: dict) -> str:
+    args = call['arguments']
+    if call['tool_call'] == 'delete_all_tasks':
+        return "АБСОЛЮТНО все задачи"
+    if args.get('task_number') is not None:
+        return f"задачу №{args['task_number']} на {args['date']}"
+    return f"ВСЕ задачи на {args['date']}"
+
+def _delete_batch(user_id: int, actions: list) -> str:
+    """Выполняет подтвержденные удаления одной транзакцией."""
+    # Внутри одной даты удаляем сначала задачи с большими номерами, чтобы номера остальных не сдвинулись
+    ordered = sorted(actions, key=lambda call: (
+        call['tool_call'] == 'delete_all_tasks',
+        call['arguments'].get('date') or '',
+        call['arguments'].get('task_number') is None,
+        -(call['arguments'].get('task_number') or 0),
+    ))
+    results = []
+    with get_storage().batch():
+        for call in ordered:
+            if call['tool_call'] == 'delete_all_tasks':
+                results.append(functions.delete_all_tasks(user_id))
             else:
-                return f"Неизвестная команда от AI: {command}"
+                args = call['arguments']
+                results.append(functions.delete_tasks(user_id, date=args.get('date'), task_number=args.get('task_number')))
+    return "\n".join(results)
+
+def _execute_tool(user_id: int, command: str, args: dict, session: dict) -> str:
+    if command == 'add_task':
+        return functions.add_task(user_id, args.get('date'), args.get('task'), args.get('time'))
+
+    elif command == 'show_tasks':
+        return functions.show_tasks(user_id, args.get('date'), args.get('end_date'))
+
+    elif command == 'delete_tasks':
+        params = {'date': args.get('date'), 'task_number': args.get('task_number')}
+        if not params['date']:
+            return "Не могу удалить, т.к. не понял дату. Попробуйте уточнить."
+
+        if params['task_number'] is not None:
+            confirmation_question = f"Вы уверены, что хотите удалить задачу №{params['task_number']} на {params['date']}? (да/нет)"
+        else:
+            confirmation_question = f"Вы уверены, что хотите удалить ВСЕ задачи на {params['date']}? (да/нет)"
+
+        return _ask_confirmation(session, 'awaiting_confirmation_delete_specific', params, confirmation_question)
+
+    elif command == 'delete_all_tasks':
+        return _ask_confirmation(
+            session, 'awaiting_confirmation_delete_all', {},
+            "Вы уверены, что хотите удалить АБСОЛЮТНО все задачи? Это действие необратимо. (да/нет)"
+        )
+
+    else:
+        return f"Неизвестная команда от AI: {command}"
+
+def _handle_pending_state(user_id: int, text: str, session: dict):
+    """Если от пользователя ожидается подтверждение, обрабатывает ответ. Иначе возвращает None."""
+    state_info = session.get('pending')
+    if not state_info:
+        return None
+
+    answer = text.strip().lower()
+    if state_info['expires_at'] <= time.time():
+        # Вопрос задан слишком давно — не выполняем удаление по запоздалому "да"
+        session.pop('pending')
+        metrics.inc('confirmations_expired_total')
+        if answer in ['да', 'yes', 'нет', 'no']:
+            return "Время на подтверждение истекло, ничего не удалено. Повторите команду, если нужно."
+        return None
+
+    state = state_info.get('state')
+    # Подтверждение удаления ВСЕХ задач
+    if state == 'awaiting_confirmation_delete_all':
+        if answer in ['да', 'yes']:
+            session.pop('pending')
+            return functions.delete_all_tasks(user_id)
+        elif answer in ['нет', 'no']:
+            session.pop('pending')
+            return "Отмена операции. Задачи не были удалены."
+        else:
+            return "Пожалуйста, ответьте 'да' или 'нет'."
+
+    # Подтверждение нескольких удалений из одного сообщения
+    elif state == 'awaiting_confirmation_batch':
+        if answer in ['да', 'yes']:
+            session.pop('pending')
+            return _delete_batch(user_id, state_info['params']['actions'])
+        elif answer in ['нет', 'no']:
+            session.pop('pending')
+            return "Отмена операции. Ничего не было удалено."
+        else:
+            return "Пожалуйста, ответьте 'да' или 'нет'."
+
+    # Подтверждение удаления конкретных задач (по дате или номеру)
+    elif state == 'awaiting_confirmation_delete_specific':
+        if answer in ['да', 'yes']:
+            params = state_info.get('params', {})
+            session.pop('pending')
+            return functions.delete_tasks(user_id, date=params.get('date'), task_number=params.get('task_number'))
+        elif answer in ['нет', 'no']:
+            session.pop('pending')
+            return "Отмена операции. Ничего не было удалено."
+        else:
+            return "Пожалуйста, ответьте 'да' или 'нет'."
+
+    return None
+
+def _handle_local_intent(user_id: int, text: str, session: dict):
+    """Быстрый путь: простые команды распознаем локально, без обращения к AI. Иначе возвращает None."""
+    started = time.perf_counter()
+    with metrics.span('intent'):
+        intent = intents.parse_intent(text, user_today(user_id))
+    if intent and intent[1] >= intents.MIN_CONFIDENCE:
+        _record_local_hit(time.perf_counter() - started)
+        metrics.inc('intents_total', path='local')
+        return execute_tool_calls(user_id, [intent[0]], session)
+    return None
+
+def _extract_tool_calls(ai_response):
+    """
+    Достает вызовы инструментов из ответа модели: нативные tool_calls или JSON в тексте
+    (с локальной починкой). Возвращает список вызовов ([] — обычный текстовый ответ)
+    или None, если ответ похож на вызов инструмента, но разобрать его не удалось.
+    """
+    with metrics.span('parse'):
+        native = getattr(ai_response, 'tool_calls', None)
+        if native:
+            calls, repaired = tools.normalize_calls(native), False
+        else:
+            calls, repaired = tools.parse_tool_calls(ai_response)
+    if repaired:
+        metrics.inc('ai_fallbacks_total', reason='repaired_json')
+    return calls
+
+def _handle_ai_response(user_id: int, ai_response_text: str, calls, session: dict) -> str:
+    """Выполняет вызовы инструментов из ответа AI или возвращает ответ как обычный текст."""
+    if calls is None:
+        metrics.inc('ai_fallbacks_total', reason='invalid_json')
+        return "Не удалось разобрать ответ AI. Попробуйте переформулировать запрос."
+    if calls:
+        return execute_tool_calls(user_id, calls, session)
+    return ai_response_text
+
+def _handle_without_ai(user_id: int, text: str):
+    """
+    Шаги 1-2: ответ на вопрос о подтверждении или простая команда.
+    Возвращает (ответ или None, история сообщений для AI).
+    """
+    with get_session_store().open(user_id) as session:
+        history = list(session.get('history', []))
+        # 1. Проверка, ожидаем ли мы подтверждения какого-либо действия
+        response = _handle_pending_state(user_id, text, session)
+        if response is not None:
+            metrics.inc('intents_total', path='pending')
+        else:
+            # 2. Простые команды без обращения к AI
+            response = _handle_local_intent(user_id, text, session)
+        if response is not None:
+            add_to_history(session, 'user', text)
+            add_to_history(session, 'assistant', response)
+        return response, history
+
+def _usage(ai_response) -> dict:
+    """Токены из ответа модели для JSON-лога этапа llm (пусто, если провайдер их не вернул)."""
+    return getattr(ai_response, 'usage', None) or {}
+
+def _repair_history(history: list, text: str, ai_response_text: str) -> list:
+    """История для повторного запроса: исходное сообщение и неразобранный ответ модели."""
+    return history + [{'role': 'user', 'content': text}, {'role': 'assistant', 'content': str(ai_response_text)}]
+
+def _finish_with_ai(user_id: int, text: str, ai_response_text: str, calls) -> str:
+    """Шаг 3: выполняет ответ AI и запоминает обмен сообщениями в истории."""
+    with get_session_store().open(user_id) as session:
+        response = _handle_ai_response(user_id, ai_response_text, calls, session)
+        add_to_history(session, 'user', text)
+        add_to_history(session, 'assistant', response)
+    return response
+
+def process_message(user_id: int, text: str, on_partial=None) -> str:
+    """
+    Обрабатывает сообщение пользователя, определяет намерение и возвращает ответ.
+    Если передан on_partial, ответ AI запрашивается потоково и on_partial(text)
+    получает накопленный текст (см. streaming.StreamingReply).
+    """
+    response, history = _handle_without_ai(user_id, text)
+    if response is not None:
+        return response
+
+    # 3. Основная логика: определяем намерение с помощью AI.
+    # Последние сообщения диалога помогают понять запросы вроде "удали её".
+    # Сессия на время запроса не блокируется, чтобы не задерживать другие потоки.
+    metrics.inc('intents_total', path='llm')
+    with metrics.span('load_prompt'):
+        prompt = load_prompt(user_id)
+    # Те же слова при том же промпте и той же истории модель превращает в те же вызовы инструментов
+    cache = get_llm_cache()
+    calls = cache.get(prompt, text, history)
+    if calls is not None:
+        return _finish_with_ai(user_id, text, '', calls)
+
+    started = time.perf_counter()
+    with metrics.span('llm', streaming=on_partial is not None) as span:
+        ai_response_text = openrouter_ai.get_ai_response(
+            prompt, text, on_delta=on_partial, history=history, tools=tools.TOOLS
+        )
+        span.set(**_usage(ai_response_text))
+    _record_llm_call(time.perf_counter() - started)
+
+    calls = _extract_tool_calls(ai_response_text)
+    if calls is None:
+        # Локальная починка не помогла — один раз просим модель повторить вызов
+        metrics.inc('ai_fallbacks_total', reason='reask')
+        with metrics.span('llm', streaming=False, reask=True) as span:
+            ai_response_text = openrouter_ai.get_ai_response(
+                prompt, REPAIR_REQUEST, history=_repair_history(history, text, ai_response_text), tools=tools.TOOLS
+            )
+            span.set(**_usage(ai_response_text))
+        calls = _extract_tool_calls(ai_response_text)
+    else:
+        cache.put(prompt, text, calls, history)
+
+    return _finish_with_ai(user_id, text, ai_response_text, calls)
+
+async def process_message_async(user_id: int, text: str, on_partial=None) -> str:
+    """
+    Асинхронный вариант process_message для async_main.py.
+    Вызывающая сторона должна обрабатывать сообщения одного чата строго по очереди,
+    иначе ответы на подтверждения могут перепутаться.
+    Шаги с сессиями, задачами и кэшем ответов обращаются к SQLite синхронно и могут ждать
+    блокировку базы (BEGIN IMMEDIATE, timeout=10), поэтому выполняются в потоках:
+    цикл событий не должен останавливаться для всех чатов из-за одного.
+    """
+    response, history = await asyncio.to_thread(_handle_without_ai, user_id, text)
+    if response is not None:
+        return response
+
+    metrics.inc('intents_total', path='llm')
+    with metrics.span('load_prompt'):
+        # Часовой пояс пользователя читается из базы
+        prompt = await asyncio.to_thread(load_prompt, user_id)
+    cache = get_llm_cache()
+    calls = await asyncio.to_thread(cache.get, prompt, text, history)
+    if calls is not None:
+        return await asyncio.to_thread(_finish_with_ai, user_id, text, '', calls)
+
+    started = time.perf_counter()
+    with metrics.span('llm', streaming=on_partial is not None) as span:
+        ai_response_text = await openrouter_ai.get_ai_response_async(
+            prompt, text, on_delta=on_partial, history=history, tools=tools.TOOLS
+        )
+        span.set(**_usage(ai_response_text))
+    _record_llm_call(time.perf_counter() - started)
 
-    except (json.JSONDecodeError, TypeError):
-        return ai_response_text
+    calls = _extract_tool_calls(ai_response_text)
+    if calls is None:
+        metrics.inc('ai_fallbacks_total', reason='reask')
+        with metrics.span('llm', streaming=False, reask=True) as span:
+            ai_response_text = await openrouter_ai.get_ai_response_async(
+                prompt, REPAIR_REQUEST, history=_repair_history(history, text, ai_response_text), tools=tools.TOOLS
+            )
+            span.set(**_usage(ai_response_text))
+        calls = _extract_tool_calls(ai_response_text)
+    else:
+        await asyncio.to_thread(cache.put, prompt, text, calls, history)
 
-    return "Что-то пошло не так при обработке вашего запроса."
\ No newline at end of file
+    return await asyncio.to_thread(_finish_with_ai, user_id, text, ai_response_text, calls)
@@ -0,0 +1,229 @@
+# Асинхронный режим запуска бота: python async_main.py
+#
+# В отличие от main.py (потоки TeleBot), здесь один цикл событий обслуживает все чаты:
+# пока модель думает над ответом одному пользователю, остальные не ждут.
+# Сообщения одного чата обрабатываются строго по очереди, поэтому состояния
+# подтверждения и история диалога в сессии (sessions.py) не перепутываются.
+import asyncio
+import os
+import signal
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+from telebot.async_telebot import AsyncTeleBot
+
+load_dotenv() # До импорта модулей бота: они читают настройки при импорте
+
+import ai_core
+import functions
+import metrics
+import openrouter_ai
+import pages
+import streaming
+import main as sync_main # Общие настройки, справка и фоновые сервисы
+
+bot = AsyncTeleBot(sync_main.token) # Только для получения обновлений
+outbox = sync_main.outbox # Отправка — через общую очередь с учетом лимитов Telegram
+
+# Сколько секунд ждать завершения уже начатых ответов при остановке
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '30'))
+POLLING_TIMEOUT = 20
+
+
+class ChatDispatcher:
+    """
+    Раздает входящие обновления по чатам.
+    Для каждого чата, у которого есть необработанные обновления, работает одна задача,
+    которая обрабатывает их по порядку; разные чаты обрабатываются параллельно.
+    """
+
+    def __init__(self, handle):
+        self._handle = handle
+        self._queues = {}  # chat_id -> deque обновлений
+        self._workers = {}  # chat_id -> asyncio.Task
+
+    def submit(self, update):
+        """Ставит обновление в очередь его чата (порядок вызовов submit сохраняется)."""
+        chat_id = get_chat_id(update)
+        self._queues.setdefault(chat_id, deque()).append(update)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+    def pending(self) -> int:
+        """Количество обновлений, ожидающих обработки или обрабатываемых сейчас."""
+        return sum(len(queue) for queue in self._queues.values()) + len(self._workers)
+
+    async def _drain(self, chat_id):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                update = queue.popleft()
+                try:
+                    await self._handle(update)
+                except Exception as e:
+                    print(f"[Ошибка] Не удалось обработать обновление {update.update_id}: {e}")
+        finally:
+            del self._workers[chat_id]
+            del self._queues[chat_id]
+
+    async def join(self, timeout: float = None) -> bool:
+        """Ждет обработки всех принятых обновлений. Возвращает False, если не уложились в timeout."""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self._workers:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            await asyncio.wait(list(self._workers.values()), timeout=remaining)
+        return True
+
+
+def get_chat_id(update):
+    """Чат, к которому относится обновление (None для обновлений без чата)."""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    return None
+
+
+async def handle_update(update):
+    await bot.process_new_updates([update])
+
+dispatcher = ChatDispatcher(handle_update)
+
+
+# --- Обработчики сообщений Telegram ---
+
+@bot.message_handler(commands=["start", "help"])
+async def start_help_command(message):
+    """Обработчик команд /start и /help."""
+    # Функции из functions.py обращаются к SQLite синхронно — выполняем их в потоке
+    await asyncio.to_thread(functions.register_user, message.chat.id)
+    outbox.send_message(message.chat.id, sync_main.HELP_MESSAGE, parse_mode='Markdown')
+
+@bot.message_handler(commands=["timezone"])
+async def timezone_command(message):
+    """Обработчик команды /timezone <часовой пояс>."""
+    response = await asyncio.to_thread(functions.set_timezone, message.chat.id, sync_main.command_argument(message))
+    outbox.send_message(message.chat.id, response)
+
+@bot.message_handler(commands=["notify"])
+async def notify_command(message):
+    """Обработчик команды /notify <ЧЧ:ММ|off>."""
+    response = await asyncio.to_thread(functions.set_notify_time, message.chat.id, sync_main.command_argument(message))
+    outbox.send_message(message.chat.id, response)
+
+@bot.message_handler(commands=["stats"])
+async def stats_command(message):
+    """Обработчик команды /stats (только для администратора)."""
+    if str(message.chat.id) != str(sync_main.ADMIN_ID):
+        return
+    outbox.send_message(message.chat.id, sync_main.format_stats())
+
+@bot.message_handler(content_types=["text"])
+async def handle_text_message(message):
+    """
+    Основной обработчик текстовых сообщений.
+    Передает текст в AI-ядро и отправляет ответ пользователю.
+    """
+    user_id = message.chat.id
+    text = message.text
+    metrics.observe('bot_update_age_seconds', max(time.time() - message.date, 0))
+
+    with metrics.context(chat_id=user_id, message_id=message.message_id), metrics.span('message'):
+        # Отправляем "Думаю..." для обратной связи (ждем отправки: для правок нужен message_id)
+        with metrics.span('placeholder'):
+            thinking_message = await asyncio.wrap_future(
+                outbox.send_message(user_id, "Думаю... 🤔", disable_notification=True)
+            )
+
+        async def edit(partial, reply_markup=None):
+            # Правка только ставится в очередь, поток ответа модели не ждет её отправки
+            outbox.edit_message_text(partial, user_id, thinking_message.message_id, reply_markup=reply_markup)
+
+        reply = streaming.AsyncStreamingReply(edit)
+
+        try:
+            response = await ai_core.process_message_async(user_id, text, on_partial=reply.update)
+            await reply.finish(response)
+        except Exception as e:
+            print(f"[Ошибка] Проблема в AI-ядре: {e}")
+            metrics.inc('bot_errors_total')
+            await reply.fail("Произошла внутренняя ошибка. Попробуйте позже.")
+
+@bot.callback_query_handler(func=lambda call: pages.is_callback(call.data))
+async def tasks_page_callback(call):
+    """Листание списка задач кнопками (см. main.tasks_page_callback)."""
+    if call.message is None:
+        return
+    chat_id = call.message.chat.id
+    with metrics.context(chat_id=chat_id), metrics.span('tasks_page'):
+        page = await asyncio.to_thread(pages.handle_callback, chat_id, call.data)
+        outbox.edit_message_text(page, chat_id, call.message.message_id, reply_markup=page.reply_markup)
+        outbox.submit('answer_callback_query', chat_id, call.id)
+
+
+# --- Получение обновлений и остановка ---
+
+async def poll_updates(stop_event: asyncio.Event, position: dict):
+    """
+    Long polling: забирает обновления у Telegram и передает их диспетчеру.
+    В position['offset'] хранится номер следующего ожидаемого обновления.
+    """
+    while not stop_event.is_set():
+        try:
+            updates = await bot.get_updates(offset=position['offset'], timeout=POLLING_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Ошибка при получении обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            position['offset'] = update.update_id + 1
+            dispatcher.submit(update)
+
+async def run(stop_event: asyncio.Event = None):
+    """Работает до сигнала SIGINT/SIGTERM (или до stop_event, если его передали — например, из benchmark.py)."""
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                pass # Windows: остановка по Ctrl+C через KeyboardInterrupt
+
+    position = {'offset': None}
+    poller = asyncio.create_task(poll_updates(stop_event, position))
+    await stop_event.wait()
+
+    # Мягкая остановка: перестаем брать новые обновления и дожидаемся уже принятых
+    print("Остановка: дожидаемся обработки текущих сообщений...")
+    poller.cancel()
+    if not await dispatcher.join(SHUTDOWN_TIMEOUT):
+        print(f"Не дождались обработки {dispatcher.pending()} обновлений.")
+    if position['offset'] is not None:
+        # Подтверждаем Telegram уже полученные обновления, чтобы после перезапуска они не пришли снова
+        try:
+            await bot.get_updates(offset=position['offset'], timeout=0)
+        except Exception as e:
+            print(f"Не удалось подтвердить полученные обновления: {e}")
+    if not await asyncio.to_thread(outbox.join, SHUTDOWN_TIMEOUT):
+        print(f"Не успели отправить {outbox.pending()} сообщений.")
+    await bot.close_session()
+    await openrouter_ai.close_async_client()
+    print("Бот остановлен.")
+
+if __name__ == '__main__':
+    sync_main.start_background_services()
+
+    print("AI-бот (асинхронный режим) запускается...")
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,417 @@
+# Нагрузочный тест бота без сети: python benchmark.py --users 50 --messages 20
+#
+# Запускает настоящие обработчики main.py (или async_main.py, webhook.py, cluster.py — см. --mode) против
+# локальных имитаций Telegram (fake_telegram.py) и OpenRouter (fake_openrouter.py).
+# Каждый виртуальный пользователь отправляет сообщения по одному и ждет окончательного
+# ответа; сценарии (добавление, просмотр, удаление с подтверждением, болтовня) выбираются
+# случайно с заданными весами. Результат — JSON-отчет с пропускной способностью и
+# перцентилями задержек, который можно сравнить с отчетом предыдущей версии (--compare).
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from queue import Queue, Empty
+
+PLACEHOLDER = "Думаю... 🤔"
+CURSOR = " ▌"  # Как в streaming.CURSOR (модуль бота импортируется позже, после настройки окружения)
+
+# Сценарии: список сообщений, которые пользователь отправляет подряд. {n} — порядковый номер.
+SCENARIOS = {
+    'add_local': ["добавь на завтра купить хлеб {n}"],
+    'add_llm': ["надо бы завтра позвонить другу {n}"],
+    'show_local': ["покажи задачи на завтра"],
+    'show_llm': ["есть ли у меня дела на завтра?"],
+    'chat': ["как дела?"],
+    'delete_confirm': ["удали задачу 1 на завтра", "да"],
+    'delete_llm_confirm': ["удали её", "да"],
+    'delete_all_cancel': ["удали все задачи", "нет"],
+}
+DEFAULT_WEIGHTS = {
+    'add_local': 25, 'add_llm': 15, 'show_local': 15, 'show_llm': 10,
+    'chat': 15, 'delete_confirm': 10, 'delete_llm_confirm': 5, 'delete_all_cancel': 5,
+}
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """Перцентиль методом ближайшего ранга (sorted_values должен быть отсортирован)."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+def summarize(values: list) -> dict:
+    """Сводка по выборке задержек (секунды): count, mean, max и перцентили."""
+    values = sorted(values)
+    summary = {'count': len(values)}
+    if values:
+        summary['mean'] = round(sum(values) / len(values), 4)
+        summary['max'] = round(values[-1], 4)
+        for p in PERCENTILES:
+            summary[f'p{p}'] = round(percentile(values, p), 4)
+    return summary
+
+
+class VirtualUser:
+    """Пользователь-робот: отправляет сообщение и ждет окончательного ответа бота."""
+
+    def __init__(self, chat_id: int, telegram, timeout: float):
+        self.chat_id = chat_id
+        self.telegram = telegram
+        self.timeout = timeout
+        self.inbox = Queue()  # (время, текст) исходящих сообщений бота в этот чат
+
+    def say(self, text: str) -> dict:
+        """
+        Отправляет сообщение и ждет ответ. Возвращает замеры (секунды от отправки):
+        ack — появилось "Думаю...", first_partial — первый фрагмент потокового ответа,
+        total — окончательный ответ. При таймауте total отсутствует.
+        """
+        while not self.inbox.empty():
+            self.inbox.get_nowait()  # Запоздавшие сообщения прошлого шага не относятся к этому
+        started = time.monotonic()
+        self.telegram.push_message(self.chat_id, text)
+        sample = {}
+        deadline = started + self.timeout
+        while True:
+            try:
+                at, reply = self.inbox.get(timeout=max(0.0, deadline - time.monotonic()))
+            except Empty:
+                return sample
+            elapsed = at - started
+            if reply == PLACEHOLDER:
+                sample.setdefault('ack', elapsed)
+            elif reply.endswith(CURSOR):
+                sample.setdefault('first_partial', elapsed)
+            else:
+                sample['total'] = elapsed
+                sample['reply'] = reply
+                return sample
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.samples = []  # {'kind', 'ack', 'first_partial', 'total'}
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    # --- Окружение ---
+
+    def setup(self):
+        args = self.args
+        # Модули бота (и fake_telegram, который берет TokenBucket из outbox) читают настройки
+        # при импорте, поэтому окружение задаем до их импорта
+        os.environ['METRICS'] = '1'  # Замеры этапов внутри бота (metrics.py) попадают в отчет
+        if args.unlimited:
+            os.environ.update(OUTBOX_GLOBAL_RATE='100000', OUTBOX_CHAT_RATE='100000', OUTBOX_CHAT_BURST='100000')
+            rates = dict(global_rate=100000, chat_rate=100000, chat_burst=100000)
+        else:
+            rates = dict(global_rate=30, chat_rate=1, chat_burst=3)
+        from fake_openrouter import FakeOpenRouter
+        from fake_telegram import FakeTelegram
+
+        self.telegram = FakeTelegram(latency=args.telegram_latency, **rates).start()
+        self.openrouter = FakeOpenRouter(
+            latency=args.llm_latency, token_interval=args.token_interval, error_rate=args.error_rate
+        ).start()
+        self.tmpdir = tempfile.mkdtemp(prefix='bench-')
+        os.environ.update(
+            TELEGRAM_TOKEN='123456:benchmark',
+            OPENROUTER_API_KEY='benchmark',
+            OPENROUTER_BASE_URL=self.openrouter.base_url,
+            TASKS_DB=os.path.join(self.tmpdir, 'tasks.db'),
+        )
+
+        import telebot.apihelper
+        import telebot.asyncio_helper
+        telebot.apihelper.API_URL = self.telegram.api_url
+        telebot.asyncio_helper.API_URL = self.telegram.api_url
+
+        self.users = {}
+        self.telegram.listeners.append(self._on_bot_message)
+
+    def _on_bot_message(self, message: dict):
+        user = self.users.get(message['chat_id'])
+        if user is not None:
+            user.inbox.put((time.monotonic(), message['text']))
+
+    def start_bot(self):
+        import main
+        if self.args.mode == 'cluster':
+            # Рабочие процессы запускаются заново (spawn) и наследуют окружение, заданное в setup()
+            import cluster
+            self._cluster = cluster.Cluster(api_url=self.telegram.api_url).start(self.args.workers)
+            if not self._cluster.wait_ready():
+                print("Не все рабочие процессы запустились вовремя.")
+            self._stop_flag = threading.Event()
+            self._bot_thread = threading.Thread(
+                target=self._cluster.run, args=(main.token, self._stop_flag), daemon=True
+            )
+            self._bot_thread.start()
+            return
+        main.outbox.start()
+        if self.args.mode in ('async', 'webhook'):
+            if self.args.mode == 'webhook':
+                with socket.socket() as sock:
+                    sock.bind(('127.0.0.1', 0))
+                    port = sock.getsockname()[1]
+                os.environ.update(WEBHOOK_HOST='127.0.0.1', WEBHOOK_PORT=str(port),
+                                  WEBHOOK_URL=f'http://127.0.0.1:{port}/telegram')
+                import webhook as entry
+            else:
+                import async_main as entry
+            ready = threading.Event()
+
+            async def runner():
+                self._loop = asyncio.get_running_loop()
+                self._stop_event = asyncio.Event()
+                ready.set()
+                await entry.run(self._stop_event)
+
+            self._bot_thread = threading.Thread(target=asyncio.run, args=(runner(),), daemon=True)
+            self._bot_thread.start()
+            ready.wait()
+        else:
+            self._bot_thread = threading.Thread(
+                target=main.bot.polling,
+                kwargs=dict(none_stop=True, interval=0, timeout=1, long_polling_timeout=1),
+                daemon=True,
+            )
+            self._bot_thread.start()
+
+    def stop_bot(self):
+        import main
+        if self.args.mode == 'cluster':
+            self._stop_flag.set()
+            self._bot_thread.join(60)
+            self.telegram.stop()
+            self.openrouter.stop()
+            return
+        if self.args.mode in ('async', 'webhook'):
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        else:
+            main.bot.stop_polling()
+        self._bot_thread.join(10)
+        main.outbox.stop()
+        self.telegram.stop()
+        self.openrouter.stop()
+
+    # --- Нагрузка ---
+
+    def _user_loop(self, user: VirtualUser, rng: random.Random):
+        kinds = list(self.args.weights)
+        weights = [self.args.weights[k] for k in kinds]
+        steps = [('start', "/start")]
+        for n in range(self.args.messages):
+            kind = rng.choices(kinds, weights)[0]
+            steps += [(kind, text.format(n=n)) for text in SCENARIOS[kind]]
+
+        for kind, text in steps:
+            sample = user.say(text)
+            with self._lock:
+                if 'total' in sample:
+                    sample['kind'] = kind
+                    self.samples.append(sample)
+                else:
+                    self.errors += 1
+            if self.args.think:
+                time.sleep(rng.uniform(0, 2 * self.args.think))
+
+    def run(self) -> dict:
+        args = self.args
+        self.setup()
+        self.start_bot()
+        import ai_core
+
+        rng = random.Random(args.seed)
+        threads = []
+        for i in range(args.users):
+            user = VirtualUser(1000 + i, self.telegram, args.timeout)
+            self.users[user.chat_id] = user
+            threads.append(threading.Thread(
+                target=self._user_loop, args=(user, random.Random(rng.random())), daemon=True
+            ))
+
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - started
+
+        intent_stats = ai_core.get_intent_stats()
+        intent_stats['cache_hit_rate'] = ai_core.get_llm_cache().get_stats()['hit_rate']
+        self.stop_bot()
+        import metrics
+        if args.mode == 'cluster':
+            intent_stats = self._merge_cluster_reports()
+        return self.report(duration, intent_stats, metrics.snapshot())
+
+    def _merge_cluster_reports(self) -> dict:
+        """Собирает статистику рабочих процессов в этот процесс (metrics) и в общий intent_stats."""
+        import metrics
+        metrics.reset()
+        local_hits = llm_calls = cache_hits = cache_lookups = 0
+        for report in self._cluster.reports.values():
+            metrics.merge(report['metrics'])
+            local_hits += report['intent_stats']['local_hits']
+            llm_calls += report['intent_stats']['llm_calls']
+            cache = report['llm_cache']
+            cache_hits += cache['hits'] + cache['disk_hits']
+            cache_lookups += cache['hits'] + cache['disk_hits'] + cache['misses']
+        return {
+            'hit_rate': local_hits / (local_hits + llm_calls) if local_hits + llm_calls else 0.0,
+            'cache_hit_rate': cache_hits / cache_lookups if cache_lookups else 0.0,
+        }
+
+    # --- Отчет ---
+
+    def report(self, duration: float, intent_stats: dict, bot_metrics: dict) -> dict:
+        args = self.args
+        by_kind = {}
+        for sample in self.samples:
+            by_kind.setdefault(sample['kind'], []).append(sample)
+
+        def stages(samples):
+            return {
+                stage: summarize([s[stage] for s in samples if stage in s])
+                for stage in ('total', 'ack', 'first_partial')
+            }
+
+        return {
+            'version': git_version(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {
+                'mode': args.mode, 'workers': args.workers if args.mode == 'cluster' else None, 'users': args.users, 'messages': args.messages, 'seed': args.seed,
+                'llm_latency': args.llm_latency, 'token_interval': args.token_interval,
+                'error_rate': args.error_rate, 'telegram_latency': args.telegram_latency,
+                'think': args.think, 'unlimited': args.unlimited, 'weights': args.weights,
+            },
+            'duration': round(duration, 3),
+            'messages': len(self.samples),
+            'errors': self.errors,
+            'throughput': round(len(self.samples) / duration, 3) if duration else 0.0,
+            'latency': stages(self.samples),
+            'by_kind': {kind: stages(samples) for kind, samples in sorted(by_kind.items())},
+            # Этапы внутри бота (оценка перцентилей по корзинам гистограмм metrics.py)
+            'stages': bot_metrics['stages'],
+            'counters': bot_metrics['counters'],
+            'llm': {'requests': self.openrouter.requests, 'errors': self.openrouter.errors},
+            'local_hit_rate': round(intent_stats['hit_rate'], 4),
+            'llm_cache_hit_rate': round(intent_stats.get('cache_hit_rate', 0.0), 4),
+            'telegram': {'calls': len(self.telegram.sent), 'rejected_429': self.telegram.rejected},
+        }
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or 'unknown'
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+
+
+# --- Сравнение отчетов ---
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    """
+    Сравнивает два отчета. Возвращает строки таблицы и помечает регрессии:
+    рост задержки или падение пропускной способности больше чем на threshold (доля).
+    """
+    rows = []
+
+    def check(name, old, new, higher_is_better=False):
+        if not old:
+            return
+        change = (new - old) / old
+        regressed = -change > threshold if higher_is_better else change > threshold
+        rows.append((name, old, new, change, regressed))
+
+    check('throughput', baseline['throughput'], current['throughput'], higher_is_better=True)
+    for p in PERCENTILES:
+        check(f'total p{p}', baseline['latency']['total'].get(f'p{p}'), current['latency']['total'].get(f'p{p}', 0))
+    for kind in sorted(set(baseline['by_kind']) & set(current['by_kind'])):
+        for p in (50, 95):
+            check(f'{kind} p{p}', baseline['by_kind'][kind]['total'].get(f'p{p}'),
+                  current['by_kind'][kind]['total'].get(f'p{p}', 0))
+    return rows
+
+def print_report(report: dict):
+    total = report['latency']['total']
+    print(f"Версия {report['version']}, режим {report['config']['mode']}, "
+          f"пользователей {report['config']['users']}: {report['messages']} ответов за {report['duration']} с "
+          f"({report['throughput']} в секунду), ошибок {report['errors']}")
+    print(f"Задержка ответа: p50 {total.get('p50')} с, p95 {total.get('p95')} с, p99 {total.get('p99')} с")
+    for kind, stages in report['by_kind'].items():
+        print(f"  {kind:20} n={stages['total']['count']:<5} p50 {stages['total'].get('p50')} с, "
+              f"p95 {stages['total'].get('p95')} с")
+    print("Этапы внутри бота:")
+    for stage, summary in report.get('stages', {}).items():
+        print(f"  {stage:20} n={summary['count']:<5} p50 {summary['p50']} с, p95 {summary['p95']} с")
+    print(f"Запросов к модели: {report['llm']['requests']}, локально распознано: {report['local_hit_rate']:.0%}, "
+          f"из кэша: {report.get('llm_cache_hit_rate', 0.0):.0%}, "
+          f"вызовов Telegram: {report['telegram']['calls']} (429: {report['telegram']['rejected_429']})")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных имитациях Telegram и OpenRouter")
+    parser.add_argument('--mode', choices=('sync', 'async', 'webhook', 'cluster'), default='sync',
+                        help="main.py, async_main.py, webhook.py или cluster.py")
+    parser.add_argument('--workers', type=int, default=2, help="число рабочих процессов для --mode cluster")
+    parser.add_argument('--users', type=int, default=20, help="число одновременных пользователей")
+    parser.add_argument('--messages', type=int, default=10, help="сценариев на пользователя")
+    parser.add_argument('--think', type=float, default=0.0, help="средняя пауза пользователя между сообщениями, с")
+    parser.add_argument('--llm-latency', default='lognormal:0.8:0.4',
+                        help="задержка модели: fixed:S, uniform:A:B, lognormal:MEDIAN:SIGMA, exp:MEAN")
+    parser.add_argument('--token-interval', type=float, default=0.01, help="пауза между словами потокового ответа, с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 503 от модели")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help="задержка ответа Telegram API, с")
+    parser.add_argument('--unlimited', action='store_true', help="без лимитов Telegram на частоту сообщений")
+    parser.add_argument('--weights', type=json.loads, default=DEFAULT_WEIGHTS,
+                        help='веса сценариев в JSON, например {"chat": 1, "add_local": 3}')
+    parser.add_argument('--timeout', type=float, default=60.0, help="сколько ждать ответа на сообщение, с")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="куда записать JSON-отчет")
+    parser.add_argument('--compare', help="JSON-отчет предыдущей версии для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.1, help="допустимое ухудшение при сравнении (доля)")
+    args = parser.parse_args(argv)
+    unknown = set(args.weights) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    return args
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    # help.txt и ai_prompt.txt бот читает из текущей папки
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    report = Benchmark(args).run()
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Отчет сохранен в {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        rows = compare(baseline, report, args.threshold)
+        print(f"\nСравнение с {baseline.get('version')}:")
+        for name, old, new, change, regressed in rows:
+            print(f"  {name:28} {old:>9} -> {new:<9} {change:+.1%}{'  <-- хуже' if regressed else ''}")
+        if any(row[4] for row in rows):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,569 @@
+# Многопроцессный режим: python cluster.py --workers 4
+#
+# Процесс-распределитель получает обновления Telegram (long polling) и раздает их рабочим
+# процессам по chat_id через согласованное хеширование: все сообщения одного чата попадают
+# в один процесс и обрабатываются там по очереди, как в async_main.py, а при добавлении
+# или удалении процесса переезжает только примерно 1/N чатов. Чат переезжает только после
+# того, как старый процесс доработает все уже отданные ему сообщения этого чата.
+#
+# Планировщик уведомлений и повтор сохраненных сообщений работают ровно в одном рабочем
+# процессе — владельце аренды (lease) в базе. Если он завершится, аренду через CLUSTER_LEASE_TTL
+# секунд заберет другой процесс. Остальные процессы пересылают ему события планировщика
+# (новая задача с напоминанием, смена настроек) через распределитель. Процесс, у которого
+# аренду забрали, останавливает планировщик, дорабатывает свои сообщения и заменяется новым.
+#
+# Сессии диалога должны храниться в SQLite (SESSION_STORAGE=sqlite, по умолчанию):
+# при переезде чата его сессия остается доступна новому процессу.
+# Добавить процесс на ходу — SIGUSR1, убрать — SIGUSR2.
+#
+# Общий лимит Telegram на бота (OUTBOX_GLOBAL_RATE) делится поровну между всеми запущенными
+# процессами, включая выводимые: они еще отправляют ответы. При изменении числа процессов
+# распределитель рассылает всем новую долю, поэтому в сумме лимит не превышается.
+import argparse
+import asyncio
+import bisect
+import hashlib
+import itertools
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv() # До импорта модулей бота: они читают настройки при импорте
+
+from storage import DB_FILE
+
+# Число рабочих процессов по умолчанию
+CLUSTER_WORKERS = int(os.getenv('CLUSTER_WORKERS', str(os.cpu_count() or 2)))
+# Срок аренды планировщика, секунд. Владелец продлевает её втрое чаще
+LEASE_TTL = float(os.getenv('CLUSTER_LEASE_TTL', '15'))
+# Виртуальных узлов на процесс в кольце хешей: чем больше, тем ровнее делятся чаты
+RING_VNODES = 64
+POLLING_TIMEOUT = 20
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '30'))
+
+
+# --- Кольцо хешей ---
+
+def _hash(key) -> int:
+    return int.from_bytes(hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Согласованное хеширование: ключ принадлежит ближайшему по часовой стрелке виртуальному узлу."""
+
+    def __init__(self, nodes=(), vnodes: int = RING_VNODES):
+        self.vnodes = vnodes
+        self._points = []  # Отсортированные хеши виртуальных узлов
+        self._owners = {}  # хеш -> узел
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.vnodes):
+            point = _hash(f'{node}#{i}')
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove(self, node):
+        for i in range(self.vnodes):
+            point = _hash(f'{node}#{i}')
+            if self._owners.pop(point, None) is not None:
+                self._points.remove(point)
+
+    def get(self, key):
+        """Узел, которому принадлежит ключ (None, если кольцо пустое)."""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+    @property
+    def nodes(self) -> set:
+        return set(self._owners.values())
+
+
+# --- Аренда планировщика ---
+
+class Lease:
+    """
+    Аренда с ограниченным сроком в SQLite: в каждый момент ею владеет не больше одного процесса.
+    Владелец продлевает аренду; если он перестал это делать, после истечения срока её забирает другой.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, name: str, owner: str, ttl: float = LEASE_TTL, path: str = DB_FILE):
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+        self.path = path
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def acquire(self) -> bool:
+        """Берет или продлевает аренду. Возвращает True, если теперь ею владеет этот процесс."""
+        now = time.time()
+        cursor = self._connect().execute(
+            'INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+            'WHERE leases.owner = excluded.owner OR leases.expires_at <= ?',
+            (self.name, self.owner, now + self.ttl, now)
+        )
+        return cursor.rowcount == 1
+
+    def release(self):
+        """Отдает аренду, чтобы другой процесс мог взять её сразу, не дожидаясь истечения срока."""
+        self._connect().execute('DELETE FROM leases WHERE name = ? AND owner = ?', (self.name, self.owner))
+
+    def hold(self, stopped: threading.Event, on_acquired, on_lost):
+        """
+        Берет и продлевает аренду каждые ttl/3 секунд, пока не установлен stopped.
+        on_acquired() вызывается, когда аренда получена, on_lost() — когда её забрал другой процесс
+        (например, этот долго не мог её продлить); после потери аренды hold() завершается.
+        """
+        held = False
+        while not stopped.is_set():
+            try:
+                acquired = self.acquire()
+            except sqlite3.Error as e:
+                print(f"Не удалось продлить аренду {self.name} ({self.owner}): {e}")
+                acquired = False
+            if acquired and not held:
+                held = True
+                on_acquired()
+            elif not acquired and held:
+                on_lost()
+                return
+            stopped.wait(self.ttl / 3)
+
+
+# --- Рабочий процесс ---
+
+class _ForwardingScheduler:
+    """Планировщик рабочего процесса: события уходят распределителю, а от него — владельцу аренды."""
+
+    def __init__(self, control):
+        self._control = control
+
+    def user_changed(self, chat_id: int):
+        self._control.put(('schedule', 'user_changed', chat_id))
+
+    def task_added(self, task: dict):
+        self._control.put(('schedule', 'task_added', task))
+
+
+def _worker_main(worker_id: int, inbox, control, api_url: str, global_rate: float):
+    """Точка входа рабочего процесса."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Остановкой управляет распределитель
+    # Общий лимит Telegram на бота делится между процессами; настройки читаются при импорте
+    os.environ['OUTBOX_GLOBAL_RATE'] = str(global_rate)
+    import telebot.apihelper
+    import telebot.asyncio_helper
+    if api_url:
+        telebot.apihelper.API_URL = api_url
+        telebot.asyncio_helper.API_URL = api_url
+    asyncio.run(_worker_run(worker_id, inbox, control))
+
+
+async def _worker_run(worker_id: int, inbox, control):
+    from telebot import types
+    import ai_core
+    import async_main
+    import metrics
+    import openrouter_ai
+    import scheduler
+    import main as sync_main
+
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    outbox = async_main.outbox
+    outbox.start(resume=False)
+    if metrics.METRICS_PORT:
+        metrics.start_server(metrics.METRICS_PORT + 1 + worker_id)
+    scheduler.set_scheduler(_ForwardingScheduler(control))
+
+    async def handle(update):
+        try:
+            await async_main.handle_update(update)
+        finally:
+            control.put(('done', worker_id, async_main.get_chat_id(update)))
+
+    dispatcher = async_main.ChatDispatcher(handle)
+    state = {'scheduler': None}
+
+    def on_item(item):
+        if item is None:
+            stop_event.set()
+        elif item[0] == 'update':
+            dispatcher.submit(types.Update.de_json(item[1]))
+        elif item[0] == 'schedule':
+            notifications = state['scheduler']  # Может смениться в потоке аренды
+            if notifications is not None:
+                getattr(notifications, item[1])(item[2])
+        elif item[0] == 'rate':
+            outbox.set_global_rate(item[1])
+
+    def read_inbox():
+        while True:
+            item = inbox.get()
+            loop.call_soon_threadsafe(on_item, item)
+            if item is None:
+                return
+
+    lease = Lease('scheduler', f'{socket.gethostname()}:{os.getpid()}')
+    lease_stopped = threading.Event()
+
+    def start_scheduler():
+        print(f"[Процесс {worker_id}] Получена аренда: запускаем планировщик уведомлений.")
+        state['scheduler'] = scheduler.Scheduler(sync_main.send_notification)
+        state['scheduler'].start()
+        outbox.start_resume()
+
+    def stop_scheduler():
+        # Уведомления теперь отправляет новый владелец аренды: останавливаем планировщик и повтор
+        # сохраненных сообщений, а распределитель заменит этот процесс новым. Процесс доработает
+        # отданные ему сообщения и отправит свою очередь, как при выводе (remove_worker)
+        print(f"[Процесс {worker_id}] Аренда планировщика потеряна, процесс будет заменен.")
+        notifications, state['scheduler'] = state['scheduler'], None
+        notifications.stop()
+        outbox.stop_resume()
+        control.put(('lease_lost', worker_id))
+
+    threading.Thread(target=read_inbox, name='cluster-inbox', daemon=True).start()
+    threading.Thread(
+        target=lease.hold, args=(lease_stopped, start_scheduler, stop_scheduler), name='cluster-lease', daemon=True
+    ).start()
+    control.put(('ready', worker_id))
+    print(f"[Процесс {worker_id}] Запущен (pid {os.getpid()}).")
+
+    await stop_event.wait()
+    lease_stopped.set() # Останавливаемся — аренду больше не берем и не продлеваем
+    if not await dispatcher.join(SHUTDOWN_TIMEOUT):
+        print(f"[Процесс {worker_id}] Не дождались обработки {dispatcher.pending()} обновлений.")
+    if state['scheduler'] is not None:
+        state['scheduler'].stop()
+        lease.release()
+    if not await asyncio.to_thread(outbox.join, SHUTDOWN_TIMEOUT):
+        print(f"[Процесс {worker_id}] Не успели отправить {outbox.pending()} сообщений.")
+    await openrouter_ai.close_async_client()
+    control.put(('stopped', worker_id, {
+        'intent_stats': ai_core.get_intent_stats(),
+        'llm_cache': ai_core.get_llm_cache().get_stats(),
+        'metrics': metrics.export(),
+    }))
+
+
+# --- Распределитель ---
+
+def get_chat_id(update: dict):
+    """Чат, к которому относится обновление в виде JSON (None для обновлений без чата)."""
+    for key in ('message', 'edited_message'):
+        if update.get(key):
+            return update[key]['chat']['id']
+    message = (update.get('callback_query') or {}).get('message')
+    return message['chat']['id'] if message else None
+
+
+class _Worker:
+    __slots__ = ('id', 'process', 'inbox', 'draining', 'closed')
+
+    def __init__(self, worker_id, process, inbox):
+        self.id = worker_id
+        self.process = process
+        self.inbox = inbox
+        self.draining = False  # Убран из кольца и дорабатывает уже отданные сообщения
+        self.closed = False  # Получил команду остановки
+
+
+class Cluster:
+    """Рабочие процессы и раздача им обновлений по кольцу хешей."""
+
+    def __init__(self, api_url: str = None, global_rate: float = None):
+        import outbox
+        import telebot.apihelper
+        self.api_url = api_url or telebot.apihelper.API_URL
+        self.global_rate = global_rate or outbox.GLOBAL_RATE
+        self.ring = HashRing()
+        self.workers = {}  # id -> _Worker
+        self.reports = {}  # id -> итоговая статистика остановленного процесса
+        self._context = multiprocessing.get_context('spawn') # fork небезопасен: в процессе уже есть потоки
+        self._control = self._context.Queue()
+        self._inflight = {}  # chat_id -> [id процесса, сколько сообщений чата отдано и не обработано]
+        self._ids = itertools.count()
+        self._lock = threading.RLock()
+        self._stopping = False
+        self._resize = 0  # Запрошенное по сигналам изменение числа процессов
+        self._ready = set()  # Процессы, которые закончили запуск
+        self._deferred = []  # События планировщика, которые мог не получить останавливаемый процесс
+        self._control_thread = None
+
+    # --- Процессы ---
+
+    def _rate_share(self, count: int) -> float:
+        """Доля общего лимита на бота для одного из count процессов."""
+        return self.global_rate / max(count, 1)
+
+    def _set_rate(self, rate: float):
+        """Рассылает новую долю лимита всем процессам. Вызывать под self._lock."""
+        for worker in self.workers.values():
+            worker.inbox.put(('rate', rate))
+
+    def _spawn(self, worker_id: int, rate: float) -> _Worker:
+        inbox = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main, args=(worker_id, inbox, self._control, self.api_url, rate),
+            name=f'worker-{worker_id}', daemon=True,
+        )
+        process.start()
+        return _Worker(worker_id, process, inbox)
+
+    def add_worker(self) -> int:
+        """Запускает новый рабочий процесс; ему сразу переходит его доля чатов."""
+        with self._lock:
+            # Сначала уменьшаем долю работающих процессов, затем запускаем новый с такой же долей
+            rate = self._rate_share(len(self.workers) + 1)
+            self._set_rate(rate)
+            worker = self._spawn(next(self._ids), rate)
+            self.workers[worker.id] = worker
+            self.ring.add(worker.id)
+        print(f"Рабочий процесс {worker.id} добавлен, всего {len(self.ring.nodes)}.")
+        return worker.id
+
+    def remove_worker(self, worker_id: int = None):
+        """Убирает процесс из кольца; он остановится, доработав уже отданные ему сообщения."""
+        with self._lock:
+            active = sorted(self.ring.nodes)
+            if len(active) <= 1:
+                print("Нельзя убрать последний рабочий процесс.")
+                return
+            worker_id = active[-1] if worker_id is None else worker_id
+            self.ring.remove(worker_id)
+            # Долю лимита процесс освободит, только когда завершится (см. _check_workers)
+            self.workers[worker_id].draining = True
+            self._stop_drained()
+        print(f"Рабочий процесс {worker_id} выводится, осталось {len(self.ring.nodes)}.")
+
+    def replace_worker(self, worker_id: int):
+        """Запускает новый процесс вместо worker_id, а worker_id выводит (он доработает отданные ему сообщения)."""
+        with self._lock:
+            if self._stopping or worker_id not in self.ring.nodes:
+                return
+            self.add_worker()
+            self.remove_worker(worker_id)
+
+    def _close(self, worker: _Worker):
+        if not worker.closed:
+            worker.closed = True
+            worker.inbox.put(None)
+
+    def _stop_drained(self):
+        busy = {entry[0] for entry in self._inflight.values()}
+        for worker in self.workers.values():
+            if worker.draining and worker.id not in busy:
+                self._close(worker)
+
+    def _check_workers(self):
+        """Перезапускает процессы, завершившиеся аварийно. Их необработанные сообщения потеряны."""
+        with self._lock:
+            count = len(self.workers)
+            for worker in list(self.workers.values()):
+                if worker.process.is_alive() or self._stopping:
+                    continue
+                self._inflight = {chat: entry for chat, entry in self._inflight.items() if entry[0] != worker.id}
+                if worker.draining:
+                    del self.workers[worker.id]
+                    continue
+                print(f"Рабочий процесс {worker.id} завершился (код {worker.process.exitcode}), перезапускаем.")
+                self._ready.discard(worker.id)
+                self.workers[worker.id] = self._spawn(worker.id, self._rate_share(count))
+            if len(self.workers) != count:
+                # Выведенные процессы завершились — их долю получают оставшиеся
+                self._set_rate(self._rate_share(len(self.workers)))
+            if self._deferred and not any(worker.closed for worker in self.workers.values()):
+                # Аренду теперь держит один из оставшихся процессов (или возьмет её вскоре)
+                for worker in self.workers.values():
+                    for message in self._deferred:
+                        worker.inbox.put(message)
+                self._deferred = []
+
+    # --- Раздача обновлений ---
+
+    def route(self, update: dict) -> int:
+        """Передает обновление процессу, которому принадлежит его чат. Возвращает номер процесса."""
+        chat_id = get_chat_id(update)
+        with self._lock:
+            entry = self._inflight.get(chat_id)
+            if entry is None:
+                entry = self._inflight[chat_id] = [self.ring.get(chat_id), 0]
+            # Пока у прежнего владельца есть необработанные сообщения чата, новые идут туда же
+            entry[1] += 1
+            worker = self.workers[entry[0]]
+        worker.inbox.put(('update', update))
+        return worker.id
+
+    def _control_loop(self):
+        while True:
+            message = self._control.get()
+            if message is None:
+                return
+            kind = message[0]
+            if kind == 'done':
+                _, worker_id, chat_id = message
+                with self._lock:
+                    entry = self._inflight.get(chat_id)
+                    if entry is not None and entry[0] == worker_id:
+                        entry[1] -= 1
+                        if not entry[1]:
+                            del self._inflight[chat_id]
+                            self._stop_drained()
+            elif kind == 'schedule':
+                # Настоящий планировщик только у владельца аренды, остальные событие пропустят.
+                # Владельцем может быть и выводимый процесс, поэтому событие получают все, кто еще
+                # читает свою очередь. Процесс, получивший команду остановки, её уже не читает, но
+                # может держать аренду до самого завершения: после его завершения событие
+                # пересылается еще раз (повтор безопасен — отправка отмечается в базе)
+                with self._lock:
+                    workers = [w for w in self.workers.values() if not w.closed]
+                    if len(workers) < len(self.workers) and not self._stopping:
+                        self._deferred.append(message)
+                for worker in workers:
+                    worker.inbox.put(message)
+            elif kind == 'lease_lost':
+                self.replace_worker(message[1])
+            elif kind == 'ready':
+                with self._lock:
+                    self._ready.add(message[1])
+            elif kind == 'stopped':
+                self.reports[message[1]] = message[2]
+
+    def wait_ready(self, timeout: float = 60) -> bool:
+        """Ждет, пока все процессы закончат запуск (импорт модулей, подключение к базе)."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if set(self.workers) <= self._ready:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def request_resize(self, delta: int):
+        """Добавить (delta > 0) или убрать процессы при следующей проверке в run() — безопасно из обработчика сигнала."""
+        self._resize += delta
+
+    def pending(self) -> int:
+        """Сколько отданных процессам сообщений еще не обработано."""
+        with self._lock:
+            return sum(entry[1] for entry in self._inflight.values())
+
+    # --- Запуск и остановка ---
+
+    def start(self, workers: int = CLUSTER_WORKERS):
+        rate = self._rate_share(workers)
+        for _ in range(workers):
+            with self._lock:
+                worker = self._spawn(next(self._ids), rate)
+                self.workers[worker.id] = worker
+                self.ring.add(worker.id)
+        self._control_thread = threading.Thread(target=self._control_loop, name='cluster-control', daemon=True)
+        self._control_thread.start()
+        print(f"Запущено рабочих процессов: {workers}.")
+        return self
+
+    def stop(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """Останавливает все процессы, дождавшись обработки отданных им сообщений."""
+        with self._lock:
+            self._stopping = True
+            workers = list(self.workers.values())
+        for worker in workers:
+            self._close(worker)
+        deadline = time.monotonic() + timeout + 5
+        for worker in workers:
+            worker.process.join(max(deadline - time.monotonic(), 0))
+            if worker.process.is_alive():
+                print(f"Рабочий процесс {worker.id} не остановился, завершаем принудительно.")
+                worker.process.terminate()
+        self._control.put(None)
+        self._control_thread.join(5) # Итоговая статистика процессов (reports) уже получена
+
+    def run(self, token: str, stop_event: threading.Event):
+        """Получает обновления (long polling) и раздает их процессам до stop_event."""
+        import telebot.apihelper
+        offset = None
+
+        def poll():
+            nonlocal offset
+            while not stop_event.is_set():
+                try:
+                    updates = telebot.apihelper.get_updates(
+                        token, offset=offset, timeout=POLLING_TIMEOUT, long_polling_timeout=POLLING_TIMEOUT
+                    )
+                except Exception as e:
+                    print(f"Ошибка при получении обновлений: {e}")
+                    stop_event.wait(1)
+                    continue
+                for update in updates:
+                    if stop_event.is_set():
+                        return # Неотданные обновления Telegram пришлет снова после перезапуска
+                    self.route(update)
+                    offset = update['update_id'] + 1
+
+        threading.Thread(target=poll, name='cluster-polling', daemon=True).start()
+        while not stop_event.wait(1):
+            self._check_workers()
+            while self._resize > 0:
+                self._resize -= 1
+                self.add_worker()
+            while self._resize < 0:
+                self._resize += 1
+                self.remove_worker()
+
+        print("Остановка: дожидаемся обработки текущих сообщений...")
+        self.stop()
+        if offset is not None:
+            # Подтверждаем Telegram отданные обновления, чтобы после перезапуска они не пришли снова
+            try:
+                telebot.apihelper.get_updates(token, offset=offset, timeout=0, long_polling_timeout=0)
+            except Exception as e:
+                print(f"Не удалось подтвердить полученные обновления: {e}")
+        print("Бот остановлен.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бот в нескольких процессах с распределением чатов по chat_id")
+    parser.add_argument('--workers', type=int, default=CLUSTER_WORKERS, help="число рабочих процессов")
+    args = parser.parse_args(argv)
+
+    import main as sync_main
+    sync_main.start_background_services(notifications=False)
+
+    cluster = Cluster().start(args.workers)
+    stop_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda *_: cluster.request_resize(1))
+        signal.signal(signal.SIGUSR2, lambda *_: cluster.request_resize(-1))
+
+    print("AI-бот (несколько процессов) запускается...")
+    cluster.run(sync_main.token, stop_event)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from string import Template
+
+# Локальная имитация OpenAI-совместимого API OpenRouter (POST .../chat/completions)
+# для нагрузочных тестов без сети. Время ответа берется из заданного распределения,
+# а текст ответа — из сценария: первое правило, регулярное выражение которого
+# найдено в последнем сообщении пользователя, определяет ответ (вызов инструмента
+# или обычный текст). Поддерживается потоковый режим (stream=True, SSE). Если в запросе
+# есть tools, вызовы инструментов из сценария возвращаются нативно (message.tool_calls).
+# В usage токенами считаются слова. В потоковом режиме usage приходит последним фрагментом без choices,
+# если в запросе есть stream_options.include_usage (как у OpenAI).
+# Для тестов можно заранее задать исход следующих запросов: queue_response(429, retry_after=1),
+# queue_response(latency=2) и т. д.
+#
+# Подключение бота:
+#     server = FakeOpenRouter(latency='lognormal:0.8:0.4').start()
+#     os.environ['OPENROUTER_BASE_URL'] = server.base_url  # до импорта openrouter_ai
+
+# Сценарий по умолчанию: (регулярное выражение, шаблон ответа).
+# В шаблоне доступны $today, $tomorrow, $day_after_tomorrow и именованные группы выражения.
+DEFAULT_SCRIPT = [
+    (r'(?:надо бы|нужно|не забыть) завтра (?P<a>[^,]+), (?P<b>.+?) и (?P<c>.+)',
+     '{"tool_calls": ['
+     '{"tool_call": "add_task", "arguments": {"date": "$tomorrow", "task": "$a"}}, '
+     '{"tool_call": "add_task", "arguments": {"date": "$tomorrow", "task": "$b"}}, '
+     '{"tool_call": "add_task", "arguments": {"date": "$tomorrow", "task": "$c"}}]}'),
+    (r'(?:надо бы|нужно|не забыть) завтра (?P<task>.+)',
+     '{"tool_call": "add_task", "arguments": {"date": "$tomorrow", "task": "$task"}}'),
+    (r'(?:надо бы|нужно|не забыть) сегодня (?P<task>.+)',
+     '{"tool_call": "add_task", "arguments": {"date": "$today", "task": "$task"}}'),
+    (r'есть ли .*завтра',
+     '{"tool_call": "show_tasks", "arguments": {"date": "$tomorrow"}}'),
+    (r'есть ли .*сегодня',
+     '{"tool_call": "show_tasks", "arguments": {"date": "$today"}}'),
+    (r'удали (?:её|ее|это)',
+     '{"tool_call": "delete_tasks", "arguments": {"date": "$tomorrow", "task_number": 1}}'),
+    (r'очисти вообще вс[её]',
+     '{"tool_call": "delete_all_tasks", "arguments": {}}'),
+    (r'',
+     'Я помогаю вести список задач: могу добавить задачу на любой день, показать задачи '
+     'на сегодня или завтра, напомнить о деле в нужное время и удалить то, что уже сделано. '
+     'Просто напишите, что нужно сделать и когда.'),
+]
+
+
+def parse_latency(spec: str):
+    """
+    Разбирает описание распределения задержки (в секундах) и возвращает функцию-генератор:
+    "fixed:0.5", "uniform:0.2:1.5", "lognormal:<медиана>:<sigma>", "exp:<среднее>".
+    """
+    kind, *params = spec.split(':')
+    params = [float(p) for p in params]
+    if kind == 'fixed':
+        return lambda: params[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(params[0], params[1])
+    if kind == 'lognormal':
+        mu = math.log(params[0])
+        return lambda: random.lognormvariate(mu, params[1])
+    if kind == 'exp':
+        return lambda: random.expovariate(1 / params[0])
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+class FakeOpenRouter:
+    def __init__(self, latency: str = 'fixed:0', token_interval: float = 0.0, error_rate: float = 0.0,
+                 script: list = None, native_tools: bool = True, host: str = '127.0.0.1', port: int = 0):
+        self.latency_spec = latency
+        self._latency = parse_latency(latency)  # Задержка до начала ответа
+        self.token_interval = token_interval  # Пауза между словами в потоковом режиме
+        self.error_rate = error_rate  # Доля запросов, на которые отвечаем 503
+        self.native_tools = native_tools  # False — как модель без function calling: запросы с tools отклоняются
+        self.script = [(re.compile(pattern, re.IGNORECASE), Template(template))
+                       for pattern, template in (script or DEFAULT_SCRIPT)]
+        self.requests = 0
+        self.errors = 0
+        self.request_times = []  # time.monotonic() прихода каждого запроса
+        self._scripted = deque()  # Заданные заранее исходы следующих запросов
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        """Значение для OPENROUTER_BASE_URL."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/v1"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='fake-openrouter', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def queue_response(self, status: int = 200, latency: float = None, retry_after: float = None):
+        """
+        Задает исход следующего еще не пришедшего запроса (по порядку прихода): HTTP-статус
+        (ошибка вместо ответа по сценарию, если не 200), задержку вместо случайной и заголовок Retry-After.
+        """
+        with self._lock:
+            self._scripted.append({'status': status, 'latency': latency, 'retry_after': retry_after})
+
+    def reply_for(self, messages: list) -> str:
+        """Ответ модели по сценарию для последнего сообщения пользователя."""
+        text = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+        # Как и настоящая модель, берем сегодняшнюю дату из системного промпта
+        prompt = next((m['content'] for m in messages if m['role'] == 'system'), '')
+        match = re.search(r"Текущая дата: (\d{4}-\d{2}-\d{2})", prompt)
+        today = date.fromisoformat(match.group(1)) if match else date.today()
+        values = {
+            'today': today.isoformat(),
+            'tomorrow': (today + timedelta(days=1)).isoformat(),
+            'day_after_tomorrow': (today + timedelta(days=2)).isoformat(),
+        }
+        for pattern, template in self.script:
+            match = pattern.search(text)
+            if match:
+                # Значения подставляются внутрь JSON-строк, поэтому экранируем их
+                groups = {k: json.dumps(v or '', ensure_ascii=False)[1:-1] for k, v in match.groupdict().items()}
+                return template.safe_substitute(values, **groups)
+        return ''
+
+    def handle(self, request: dict):
+        """
+        Возвращает (HTTP-статус, ответ, потоковый ли ответ, заголовки).
+        Задержка выдерживается здесь же.
+        """
+        with self._lock:
+            self.requests += 1
+            self.request_times.append(time.monotonic())
+            scripted = self._scripted.popleft() if self._scripted else {}
+            status = scripted.get('status') or (503 if random.random() < self.error_rate else 200)
+            if status != 200:
+                self.errors += 1
+        latency = scripted.get('latency')
+        time.sleep(self._latency() if latency is None else latency)
+        if status != 200:
+            headers = {}
+            if scripted.get('retry_after') is not None:
+                headers['Retry-After'] = str(scripted['retry_after'])
+            message = 'Service temporarily unavailable' if status >= 500 else f'Request failed with status {status}'
+            return status, {'error': {'message': message, 'code': status}}, False, headers
+
+        if request.get('tools') and not self.native_tools:
+            return 404, {'error': {'message': 'No endpoints found that support tool use', 'code': 404}}, False, {}
+
+        content = self.reply_for(request.get('messages', []))
+        tool_calls = self._tool_calls(content) if request.get('tools') else None
+        base = {'id': f'fake-{self.requests}', 'created': int(time.time()), 'model': request.get('model', 'fake')}
+        usage = self._usage(request.get('messages', []), content)
+        if request.get('stream'):
+            if not (request.get('stream_options') or {}).get('include_usage'):
+                usage = None
+            return 200, (base, content, tool_calls, usage), True, {}
+        message = {'role': 'assistant', 'content': content}
+        if tool_calls:
+            message = {'role': 'assistant', 'content': None, 'tool_calls': tool_calls}
+        return 200, dict(base, object='chat.completion', choices=[{
+            'index': 0, 'message': message, 'finish_reason': 'tool_calls' if tool_calls else 'stop',
+        }], usage=usage), False, {}
+
+    @staticmethod
+    def _usage(messages: list, content: str) -> dict:
+        prompt = sum(len(m['content'].split()) for m in messages if isinstance(m.get('content'), str))
+        completion = len(content.split())
+        return {'prompt_tokens': prompt, 'completion_tokens': completion, 'total_tokens': prompt + completion}
+
+    @staticmethod
+    def _tool_calls(content: str):
+        """Вызовы инструментов из ответа сценария в формате OpenAI или None, если это обычный текст."""
+        try:
+            value = json.loads(content)
+        except json.JSONDecodeError:
+            return None
+        items = value.get('tool_calls', [value]) if isinstance(value, dict) else value
+        return [{
+            'id': f'call_{i}', 'type': 'function',
+            'function': {'name': item['tool_call'], 'arguments': json.dumps(item.get('arguments', {}), ensure_ascii=False)},
+        } for i, item in enumerate(items)]
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def _send_chunk(self, base: dict, delta: dict):
+                chunk = dict(base, object='chat.completion.chunk', choices=[{
+                    'index': 0, 'finish_reason': None, 'delta': delta,
+                }])
+                self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+            def _finish_stream(self, base: dict, usage: dict):
+                if usage:
+                    chunk = dict(base, object='chat.completion.chunk', choices=[], usage=usage)
+                    self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                self._write_chunk(b"data: [DONE]\n\n")
+                self._write_chunk(b"")
+
+            def _stream(self, base: dict, content: str, tool_calls: list, usage: dict):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                if tool_calls:
+                    # Как у OpenAI: сначала имя функции, затем аргументы по частям
+                    for index, call in enumerate(tool_calls):
+                        arguments = call['function']['arguments']
+                        self._send_chunk(base, {'tool_calls': [{
+                            'index': index, 'id': call['id'], 'type': 'function',
+                            'function': {'name': call['function']['name'], 'arguments': ''},
+                        }]})
+                        for start in range(0, len(arguments), 16):
+                            self._send_chunk(base, {'tool_calls': [{
+                                'index': index, 'function': {'arguments': arguments[start:start + 16]},
+                            }]})
+                    self._finish_stream(base, usage)
+                    return
+                words = content.split(' ')
+                for i, word in enumerate(words):
+                    if i and fake.token_interval:
+                        time.sleep(fake.token_interval)
+                    self._send_chunk(base, {'content': word + (' ' if i < len(words) - 1 else '')})
+                self._finish_stream(base, usage)
+
+            def do_POST(self):
+                if not self.path.rstrip('/').endswith('/chat/completions'):
+                    self.send_error(404)
+                    return
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+                status, response, streaming, headers = fake.handle(request)
+                if streaming:
+                    self._stream(*response)
+                    return
+                data = json.dumps(response, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+if __name__ == '__main__':
+    server = FakeOpenRouter(latency='lognormal:0.8:0.4', token_interval=0.02, port=8082).start()
+    print(f"Fake OpenRouter API: {server.base_url}")
+    threading.Event().wait()
@@ -0,0 +1,270 @@
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from outbox import TokenBucket
+
+# Локальная имитация Telegram Bot API для проверки бота без сети.
+# Поддерживает getMe, getUpdates, setWebhook, deleteWebhook, sendMessage, editMessageText
+# и answerCallbackQuery, записывает все исходящие сообщения и, как настоящий Telegram,
+# отвечает 429 с retry_after при превышении общего лимита бота или лимита одного чата
+# и 400 на сообщения длиннее 4096 символов.
+# После setWebhook обновления доставляются POST-запросами на адрес webhook (по порядку,
+# с повтором, пока бот не ответит 2xx), а getUpdates возвращает 409.
+#
+# Подключение бота:
+#     server = FakeTelegram().start()
+#     telebot.apihelper.API_URL = server.api_url
+
+
+class FakeTelegram:
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 latency: float = 0.0, host: str = '127.0.0.1', port: int = 0):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.latency = latency  # Искусственная задержка ответа, секунд
+        self.sent = []  # Все принятые исходящие вызовы: {'method', 'chat_id', 'message_id', 'text', 'reply_markup', 'time'}
+        self.rejected = 0  # Сколько вызовов получили 429
+        self.answered_callbacks = 0  # Сколько нажатий кнопок подтверждено (answerCallbackQuery)
+        self.listeners = []  # listener(message) вызывается для каждого принятого исходящего вызова
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self.webhook_url = ''
+        self.webhook_secret = None
+        self.webhook_deliveries = 0  # Сколько POST-запросов отправлено на webhook, включая повторы
+        self._delivery = None
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def api_url(self) -> str:
+        """Шаблон адреса для telebot.apihelper.API_URL."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='fake-telegram', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.set_webhook('')
+        self._server.shutdown()
+        self._server.server_close()
+
+    # --- Входящие обновления ---
+
+    def push_message(self, chat_id: int, text: str) -> int:
+        """Имитирует сообщение пользователя. Возвращает update_id."""
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self.push_update({'message': message})
+
+    def push_callback(self, chat_id: int, message_id: int, data: str) -> int:
+        """Имитирует нажатие кнопки под сообщением бота. Возвращает update_id."""
+        return self.push_update({'callback_query': {
+            'id': str(next(self._message_ids)),
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'},
+                'text': '',
+            },
+        }})
+
+    def push_update(self, update: dict) -> int:
+        with self._cond:
+            update = dict(update, update_id=next(self._update_ids))
+            self._updates.append(update)
+            self._cond.notify_all()
+        return update['update_id']
+
+    def _get_updates(self, offset: int, timeout: float) -> list:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # Как в Telegram: offset подтверждает получение всех предыдущих обновлений
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return list(self._updates[:100])
+
+    # --- Доставка на webhook ---
+
+    def set_webhook(self, url: str, secret_token: str = None):
+        with self._cond:
+            self.webhook_url = url
+            self.webhook_secret = secret_token
+            self._cond.notify_all()
+            if url and self._delivery is None:
+                self._delivery = threading.Thread(target=self._deliver, name='fake-telegram-webhook', daemon=True)
+                self._delivery.start()
+
+    def _deliver(self):
+        """Отправляет обновления на webhook по одному; при ошибке повторяет то же обновление."""
+        while True:
+            with self._cond:
+                while self.webhook_url and not self._updates:
+                    self._cond.wait()
+                if not self.webhook_url:
+                    self._delivery = None
+                    return
+                update, url, secret = self._updates[0], self.webhook_url, self.webhook_secret
+            request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), method='POST')
+            request.add_header('Content-Type', 'application/json')
+            if secret:
+                request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+            self.webhook_deliveries += 1
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    delivered = 200 <= response.status < 300
+            except (urllib.error.URLError, OSError):
+                delivered = False
+            with self._cond:
+                if delivered:
+                    self._updates = [u for u in self._updates if u['update_id'] != update['update_id']]
+            if not delivered:
+                time.sleep(0.1)
+
+    # --- Исходящие сообщения ---
+
+    def _check_limits(self, chat_id):
+        """Возвращает retry_after (секунд), если лимит превышен, иначе None."""
+        with self._cond:
+            now = time.monotonic()
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            delay = max(self._global.delay(now), bucket.delay(now))
+            if delay > 0:
+                self.rejected += 1
+                return max(1, int(delay + 0.999))
+            self._global.take(now)
+            bucket.take(now)
+            return None
+
+    def _record(self, method: str, chat_id: int, message_id: int, text: str, reply_markup=None):
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+        message = {'method': method, 'chat_id': chat_id, 'message_id': message_id, 'text': text,
+                   'reply_markup': reply_markup, 'time': time.time()}
+        with self._cond:
+            self.sent.append(message)
+        for listener in self.listeners:
+            listener(message)
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'},
+            'text': text,
+        }
+
+    def handle(self, method: str, params: dict):
+        """Выполняет вызов Bot API. Возвращает (HTTP-статус, JSON-ответ)."""
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}}
+        if method == 'setWebhook':
+            self.set_webhook(params.get('url', ''), params.get('secret_token'))
+            return 200, {'ok': True, 'result': True}
+        if method == 'deleteWebhook':
+            self.set_webhook('')
+            return 200, {'ok': True, 'result': True}
+        if method == 'getUpdates':
+            if self.webhook_url:
+                return 409, {'ok': False, 'error_code': 409,
+                             'description': "Conflict: can't use getUpdates method while webhook is active"}
+            updates = self._get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+            return 200, {'ok': True, 'result': updates}
+        if method == 'answerCallbackQuery':
+            with self._cond:
+                self.answered_callbacks += 1
+            return 200, {'ok': True, 'result': True}
+
+        if method not in ('sendMessage', 'editMessageText'):
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+
+        chat_id = int(params['chat_id'])
+        if len(params.get('text', '')) > 4096:
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: message is too long'}
+        retry_after = self._check_limits(chat_id)
+        if retry_after is not None:
+            return 429, {
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {retry_after}',
+                'parameters': {'retry_after': retry_after},
+            }
+        if method == 'sendMessage':
+            message_id = next(self._message_ids)
+        else:
+            message_id = int(params['message_id'])
+        return 200, {'ok': True, 'result': self._record(
+            method, chat_id, message_id, params.get('text', ''), params.get('reply_markup'))}
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _params(self) -> dict:
+                # telebot передает параметры в строке запроса, async_telebot — в форме, другие клиенты — в JSON
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                if body:
+                    if 'json' in (self.headers.get('Content-Type') or ''):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body.decode('utf-8')))
+                return params
+
+            def _serve(self):
+                method = urlsplit(self.path).path.rsplit('/', 1)[-1]
+                status, response = fake.handle(method, self._params())
+                data = json.dumps(response, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _serve
+            do_POST = _serve
+
+        return Handler
+
+
+if __name__ == '__main__':
+    server = FakeTelegram(port=8081).start()
+    print(f"Fake Telegram API: {server.api_url}")
+    threading.Event().wait()
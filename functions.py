@@ -1,125 +1,121 @@
-import json
-from datetime import datetime
+import re
+import pytz
+import pages
+import scheduler
+from storage import get_storage, user_today
 
-TASKS_FILE = "tasks.json"
+TASKS_FILE = "tasks.json"  # Старый формат хранения, используется только для миграции
 
-def save_tasks(tasks):
-    """Сохраняет задачи в файл tasks.json."""
-    with open(TASKS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(tasks, f, ensure_ascii=False, indent=4)
+def today_str(user_id: int) -> str:
+    """Сегодняшняя дата (ГГГГ-ММ-ДД) в часовом поясе пользователя."""
+    return user_today(user_id).strftime('%Y-%m-%d')
 
-def load_tasks():
+def load_tasks(user_id: int) -> dict:
     """
-    Загружает задачи из файла tasks.json, автоматически удаляя прошедшие задачи.
+    Возвращает актуальные задачи пользователя (сегодня и в будущем) в формате {дата: [задачи]}.
+    Устаревшие задачи удаляются из хранилища фоновым потоком, а здесь просто не попадают в выборку.
     """
-    try:
-        with open(TASKS_FILE, 'r', encoding='utf-8') as f:
-            tasks = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-    today_str = datetime.now().strftime('%Y-%m-%d')
-    
-    # Фильтруем задачи, оставляя только актуальные (сегодня и в будущем)
-    actual_tasks = {
-        date: task_list for date, task_list in tasks.items() 
-        if date >= today_str and task_list
-    }
-
-    # Если были изменения (т.е. старые задачи удалены), сохраняем очищенный список
-    if len(actual_tasks) != len(tasks):
-        save_tasks(actual_tasks)
-        print("Обнаружены и удалены устаревшие задачи.")
-
-    return actual_tasks
-
-def add_task(date: str, task: str) -> str:
-    """Добавляет задачу и сохраняет в файл."""
+    return get_storage().get_all_tasks(user_id, from_date=today_str(user_id))
+
+def parse_time(value: str):
+    """Приводит время к виду ЧЧ:ММ. Возвращает None, если это не время."""
+    match = re.fullmatch(r"(\d{1,2})[:.](\d{2})", (value or '').strip())
+    if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        return None
+    return f"{int(match.group(1)):02d}:{match.group(2)}"
+
+def register_user(user_id: int):
+    """Регистрирует пользователя, чтобы он получал утреннюю сводку."""
+    if get_storage().ensure_user(user_id) and scheduler.get_scheduler():
+        scheduler.get_scheduler().user_changed(user_id)
+
+def add_task(user_id: int, date: str, task: str, time: str = None) -> str:
+    """Добавляет задачу пользователя в хранилище. Если указано время (ЧЧ:ММ), в это время придет напоминание."""
     if not date or not task:
         return "Не удалось добавить задачу: не указана дата или текст."
-    
-    tasks = load_tasks()
-    tasks.setdefault(date, []).append(task)
-    save_tasks(tasks)
-    
-    return f"✅ Добавлено: [{date}] — {task}"
-
-def show_tasks(specific_date: str = None) -> str:
-    """Формирует строку с задачами для вывода, загружая их из файла."""
-    tasks = load_tasks() # Теперь эта функция возвращает только актуальные задачи
-    if not tasks:
-        return "Список задач пуст."
-
-    # Если запрошена конкретная дата
-    if specific_date:
-        if specific_date in tasks and tasks[specific_date]:
-            task_list = tasks[specific_date]
-            formatted_tasks = [f"{i}. {t}" for i, t in enumerate(task_list, 1)]
-            return f"Задачи на {specific_date}:\n" + "\n".join(formatted_tasks)
-        else:
-            return f"На {specific_date} задач нет."
-
-    # Если дата не указана, показываем все актуальные задачи
-    all_tasks_parts = []
-    today_str = datetime.now().strftime('%Y-%m-%d')
+    remind_at = None
+    if time:
+        remind_at = parse_time(time)
+        if remind_at is None:
+            return f"Не удалось добавить задачу: неверное время '{time}'. Используйте формат ЧЧ:ММ."
+
+    register_user(user_id)
+    storage = get_storage()
+    task_id = storage.add_task(user_id, date, task, remind_at)
+    if remind_at and scheduler.get_scheduler():
+        # Если задача добавлена в пакете (storage.batch), планировщик должен увидеть её уже сохраненной
+        storage.after_commit(lambda: scheduler.get_scheduler().task_added(
+            {'id': task_id, 'chat_id': user_id, 'date': date, 'text': task, 'remind_at': remind_at}
+        ))
+        return f"✅ Добавлено: [{date} {remind_at}] — {task}"
 
-    # Сначала задачи на сегодня, если они есть
-    if today_str in tasks and tasks[today_str]:
-        all_tasks_parts.append("--- Задачи на сегодня ---")
-        today_tasks = [f"  {i}. {t}" for i, t in enumerate(tasks[today_str], 1)]
-        all_tasks_parts.append("\n".join(today_tasks))
-
-    # Затем остальные задачи, отсортированные по дате
-    other_tasks_parts = []
-    for date, task_list in sorted(tasks.items()):
-        if date == today_str or not task_list:
-            continue
-        formatted_tasks = [f"  {i}. {t}" for i, t in enumerate(task_list, 1)]
-        other_tasks_parts.append(f"{date}:\n" + "\n".join(formatted_tasks))
-    
-    if other_tasks_parts:
-        all_tasks_parts.append("--- Остальные задачи ---")
-        all_tasks_parts.append("\n\n".join(other_tasks_parts))
-
-    if not all_tasks_parts:
-        return "Актуальных задач нет."
+    return f"✅ Добавлено: [{date}] — {task}"
 
-    return "\n\n".join(all_tasks_parts)
+def show_tasks(user_id: int, specific_date: str = None, end_date: str = None) -> str:
+    """
+    Формирует первую страницу списка задач пользователя: на дату, на диапазон дат
+    (specific_date — end_date) или все актуальные задачи. Остальные страницы листаются
+    кнопками под сообщением (см. pages.py).
+    """
+    if end_date and not specific_date:
+        specific_date = today_str(user_id)
+    return pages.render(user_id, specific_date, end_date or specific_date)
 
-def delete_all_tasks() -> str:
-    """Очищает все задачи и сохраняет изменения."""
-    save_tasks({})
+def delete_all_tasks(user_id: int) -> str:
+    """Удаляет все задачи пользователя."""
+    get_storage().delete_all(user_id)
     return "🗑️ Все задачи удалены."
 
-def delete_tasks(date: str, task_number: int = None) -> str:
+def delete_tasks(user_id: int, date: str, task_number: int = None) -> str:
     """
-    Удаляет задачи на указанную дату.
+    Удаляет задачи пользователя на указанную дату.
     Если указан task_number, удаляет конкретную задачу.
     Иначе удаляет все задачи на эту дату.
     """
-    tasks = load_tasks()
-
-    if date not in tasks:
-        return f"На дату {date} задач для удаления не найдено."
+    storage = get_storage()
 
     # Удаление конкретной задачи по номеру
     if task_number is not None:
         try:
-            # Номер задачи от пользователя (1-based), конвертируем в индекс (0-based)
-            task_index = int(task_number) - 1
-            if 0 <= task_index < len(tasks[date]):
-                removed_task = tasks[date].pop(task_index)
-                # Если на дату больше не осталось задач, удаляем и саму дату
-                if not tasks[date]:
-                    del tasks[date]
-                save_tasks(tasks)
-                return f"✅ Задача '{removed_task}' на {date} удалена."
-            else:
-                return f"❌ Ошибка: задачи с номером {task_number} на {date} не существует."
+            # Номер задачи от пользователя (1-based)
+            number = int(task_number)
         except (ValueError, TypeError):
             return "❌ Ошибка: неверный номер задачи."
+        removed_task = storage.delete_task(user_id, date, number) if number >= 1 else None
+        if removed_task is not None:
+            return f"✅ Задача '{removed_task}' на {date} удалена."
+        if not storage.get_tasks(user_id, date):
+            return f"На дату {date} задач для удаления не найдено."
+        return f"❌ Ошибка: задачи с номером {task_number} на {date} не существует."
     # Удаление всех задач на дату
     else:
-        del tasks[date]
-        save_tasks(tasks)
-        return f"🗑️ Все задачи на {date} были удалены."
\ No newline at end of file
+        if not storage.delete_date(user_id, date):
+            return f"На дату {date} задач для удаления не найдено."
+        return f"🗑️ Все задачи на {date} были удалены."
+
+def set_timezone(user_id: int, timezone: str) -> str:
+    """Меняет часовой пояс пользователя (например, Europe/Moscow)."""
+    try:
+        timezone = pytz.timezone((timezone or '').strip()).zone
+    except pytz.UnknownTimeZoneError:
+        return "❌ Неизвестный часовой пояс. Пример: /timezone Europe/Moscow"
+    get_storage().update_user(user_id, timezone=timezone)
+    if scheduler.get_scheduler():
+        scheduler.get_scheduler().user_changed(user_id)
+    return f"🌍 Часовой пояс установлен: {timezone}"
+
+def set_notify_time(user_id: int, value: str) -> str:
+    """Меняет время утренней сводки (ЧЧ:ММ) или отключает её ("off")."""
+    value = (value or '').strip().lower()
+    if value in ('off', 'выкл', 'нет'):
+        notify_time = None
+    else:
+        notify_time = parse_time(value)
+        if notify_time is None:
+            return "❌ Укажите время в формате ЧЧ:ММ или off. Пример: /notify 07:30"
+    get_storage().update_user(user_id, notify_time=notify_time)
+    if scheduler.get_scheduler():
+        scheduler.get_scheduler().user_changed(user_id)
+    if notify_time is None:
+        return "🔕 Утренняя сводка отключена."
+    return f"⏰ Утренняя сводка будет приходить в {notify_time}."
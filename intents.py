@@ -0,0 +1,144 @@
+import os
+import re
+from datetime import date, timedelta
+
+# Минимальная уверенность, при которой локальный разбор используется вместо AI
+MIN_CONFIDENCE = float(os.getenv('LOCAL_INTENT_MIN_CONFIDENCE', '0.9'))
+
+WEEKDAYS = {
+    'понедельник': 0, 'вторник': 1, 'среда': 2, 'среду': 2, 'четверг': 3,
+    'пятница': 4, 'пятницу': 4, 'суббота': 5, 'субботу': 5, 'воскресенье': 6,
+}
+MONTHS = {
+    'января': 1, 'февраля': 2, 'марта': 3, 'апреля': 4, 'мая': 5, 'июня': 6,
+    'июля': 7, 'августа': 8, 'сентября': 9, 'октября': 10, 'ноября': 11, 'декабря': 12,
+}
+
+# --- Части регулярных выражений ---
+
+DATE = (
+    r"(?P<date>сегодня|послезавтра|завтра"
+    r"|\d{4}-\d{1,2}-\d{1,2}|\d{1,2}\.\d{1,2}(?:\.\d{2,4})?|\d{1,2}-\d{1,2}"
+    r"|\d{1,2}\s+(?:" + "|".join(MONTHS) + r")"
+    r"|" + "|".join(WEEKDAYS) + r")"
+)
+ON_DATE = r"(?:(?:на|в|во)\s+)?" + DATE
+AT_TIME = r"(?:\s+в\s+(?P<time>\d{1,2}:\d{2}))?"
+TASKS = r"(?:мои\s+|все\s+|все\s+мои\s+)?(?:задачи|дела|планы|список(?:\s+дел|\s+задач)?)"
+SHOW = r"(?:покажи|показать|выведи|проверь|посмотри)(?:\s+мне)?"
+DELETE = r"(?:удали|удалить|очисти|очистить|сотри|стереть)"
+DONE = r"(?:удали|удалить|убери|сотри|выполнил|выполнила|сделал|сделала)"
+NUMBER = r"(?:задачу\s+|дело\s+)?(?:номер\s+|№\s*)?(?P<number>\d+)"
+ADD = r"(?:напомни(?:\s+мне)?|добавь(?:\s+задачу)?|добавить(?:\s+задачу)?|создай(?:\s+задачу)?|запиши(?:\s+задачу)?)"
+
+# (шаблон, команда, уверенность). Шаблоны проверяются по порядку и должны совпасть с текстом целиком.
+PATTERNS = [
+    # Просмотр задач на дату
+    (SHOW + r"\s+" + TASKS + r"\s+" + ON_DATE, 'show_tasks', 1.0),
+    (TASKS + r"\s+" + ON_DATE, 'show_tasks', 1.0),
+    (r"(?:что|какие\s+планы|какие\s+дела|какие\s+задачи)(?:\s+у\s+меня)?\s+" + ON_DATE, 'show_tasks', 1.0),
+    # Просмотр всех задач
+    (SHOW + r"\s+" + TASKS, 'show_tasks', 1.0),
+    (r"(?:мои\s+задачи|мои\s+дела|список\s+дел|список\s+задач)", 'show_tasks', 1.0),
+    (r"какие\s+у\s+меня\s+(?:задачи|дела|планы)", 'show_tasks', 1.0),
+    # Удаление задачи по номеру
+    (DONE + r"\s+" + NUMBER + r"\s+" + ON_DATE, 'delete_tasks', 1.0),
+    (DONE + r"\s+" + ON_DATE + r"\s+" + NUMBER, 'delete_tasks', 1.0),
+    # Удаление всех задач на дату
+    (DELETE + r"(?:\s+" + TASKS + r")?\s+" + ON_DATE, 'delete_tasks', 1.0),
+    # Удаление абсолютно всех задач
+    (DELETE + r"\s+(?:весь\s+)?" + TASKS, 'delete_all_tasks', 1.0),
+    # Добавление задачи: дата до текста ("напомни завтра купить молоко")
+    (ADD + r"\s+" + ON_DATE + AT_TIME + r"(?:\s+задачу)?\s*[:,—-]?\s+(?P<task>.+)", 'add_task', 1.0),
+    # Добавление задачи: дата после текста ("напомни купить молоко завтра")
+    (ADD + r"\s*[:,—-]?\s+(?P<task>.+?)\s+" + ON_DATE + AT_TIME, 'add_task', 0.9),
+]
+COMPILED_PATTERNS = [
+    (re.compile(pattern, re.IGNORECASE), command, confidence)
+    for pattern, command, confidence in PATTERNS
+]
+
+# Слова, которые не могут быть текстом задачи ("добавь задачу на завтра" без самой задачи)
+EMPTY_TASKS = {'задачу', 'задача', 'дело', 'напоминание', 'что-нибудь'}
+# Похоже на перечисление нескольких дел ("молоко, хлеб и позвонить маме"): одна это задача
+# или несколько, решает модель — она вернет несколько вызовов add_task
+TASK_LIST = re.compile(r"[,;]|\sи\s", re.IGNORECASE)
+
+
+def resolve_date(value: str, today: date = None) -> str:
+    """Переводит дату из пользовательского формата в ГГГГ-ММ-ДД. Возвращает None, если дату не разобрать."""
+    today = today or date.today()
+    value = value.lower().strip()
+
+    if value == 'сегодня':
+        return today.strftime('%Y-%m-%d')
+    if value == 'завтра':
+        return (today + timedelta(days=1)).strftime('%Y-%m-%d')
+    if value == 'послезавтра':
+        return (today + timedelta(days=2)).strftime('%Y-%m-%d')
+    if value in WEEKDAYS:
+        # Ближайший такой день недели, включая сегодняшний
+        days_ahead = (WEEKDAYS[value] - today.weekday()) % 7
+        return (today + timedelta(days=days_ahead)).strftime('%Y-%m-%d')
+
+    year = None
+    match = re.fullmatch(r"(\d{4})-(\d{1,2})-(\d{1,2})", value)
+    if match:
+        year, month, day = (int(part) for part in match.groups())
+    elif re.fullmatch(r"\d{1,2}\.\d{1,2}(?:\.\d{2,4})?", value):
+        parts = [int(part) for part in value.split('.')]
+        day, month = parts[0], parts[1]
+        if len(parts) == 3:
+            year = parts[2] + 2000 if parts[2] < 100 else parts[2]
+    elif re.fullmatch(r"\d{1,2}-\d{1,2}", value):
+        month, day = (int(part) for part in value.split('-'))
+    else:
+        day_str, month_name = value.split()
+        day, month = int(day_str), MONTHS[month_name]
+
+    try:
+        if year is not None:
+            return date(year, month, day).strftime('%Y-%m-%d')
+        resolved = date(today.year, month, day)
+        # Дата в этом году уже прошла — имеем в виду следующий год
+        if resolved < today:
+            resolved = date(today.year + 1, month, day)
+        return resolved.strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def parse_intent(text: str, today: date = None):
+    """
+    Пытается распознать простую команду без обращения к AI.
+    Возвращает ({"tool_call": ..., "arguments": ...}, уверенность) или None,
+    если текст не похож ни на одну из известных команд.
+    """
+    text = re.sub(r"\s+", " ", text.replace('ё', 'е').replace('Ё', 'Е')).strip().rstrip('.!?')
+
+    for pattern, command, confidence in COMPILED_PATTERNS:
+        match = pattern.fullmatch(text)
+        if not match:
+            continue
+        groups = match.groupdict()
+
+        arguments = {}
+        if groups.get('date'):
+            arguments['date'] = resolve_date(groups['date'], today)
+            if arguments['date'] is None:
+                return None
+        if groups.get('number'):
+            arguments['task_number'] = int(groups['number'])
+        if command == 'add_task':
+            task = groups['task'].strip(' :,—-')
+            # Предлог перед датой мог попасть в текст задачи ("напомни купить молоко на завтра")
+            task = re.sub(r"(?:^|\s+)(?:на|в|во)$", "", task, flags=re.IGNORECASE).strip()
+            if not task or task.lower() in EMPTY_TASKS or TASK_LIST.search(task):
+                return None
+            arguments['task'] = task
+            if groups.get('time'):
+                arguments['time'] = groups['time']
+
+        return {"tool_call": command, "arguments": arguments}, confidence
+
+    return None
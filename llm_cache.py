@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+import metrics
+import tools
+from storage import DB_FILE
+
+# Кэш ответов модели перед openrouter_ai.get_ai_response. Кэшируются только вызовы инструментов:
+# при одинаковом системном промпте, одинаковой истории диалога и одинаковом (после нормализации)
+# тексте модель отвечает одними и теми же вызовами, а обычные текстовые ответы каждый раз свои.
+# История входит в ключ: по ней модель уточняет даты и номера задач ("убери вторую задачу"
+# после "запиши 25.10 отчет", "удали её"), и такой ответ нельзя выдавать другому чату.
+# Поэтому и сообщения со ссылками на предыдущие реплики кэшируются без отдельных исключений:
+# ответ на них повторится только при той же истории, которую видела модель.
+# В промпт подставляется сегодняшняя дата пользователя (по его часовому поясу), так что с её
+# сменой ключ меняется сам; при смене дня на сервере устаревшие записи просто удаляются.
+
+# Сколько ответов держать в памяти (0 — кэш выключен)
+LLM_CACHE_SIZE = int(os.getenv('LLM_CACHE_SIZE', '1000'))
+# LLM_CACHE_DISK=1 — дополнительно хранить кэш в SQLite (в базе задач), чтобы он пережил перезапуск
+LLM_CACHE_DISK = os.getenv('LLM_CACHE_DISK', '0') == '1'
+# Сколько записей хранить на диске
+LLM_CACHE_DISK_SIZE = int(os.getenv('LLM_CACHE_DISK_SIZE', '10000'))
+
+
+# Знаки препинания, кроме разделителей внутри дат и времени: "12.10" (12 октября) и "12-10"
+# (10 декабря) — разные дни, а "9:30" не то же, что "9 30"
+PUNCTUATION = re.compile(r'(?!(?<=\d)[./:-](?=\d))[^\w\s]')
+
+
+def normalize(text: str) -> str:
+    """Приводит текст к виду для ключа кэша: регистр, ё/е, знаки препинания и лишние пробелы не важны."""
+    text = text.lower().replace('ё', 'е')
+    text = PUNCTUATION.sub(' ', text)
+    return ' '.join(text.split())
+
+
+class LLMCache:
+    """
+    LRU-кэш вызовов инструментов в памяти с необязательным вторым уровнем в SQLite.
+    Ключ — хеш готового системного промпта и истории диалога плюс нормализованный текст сообщения.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            day TEXT NOT NULL,
+            calls TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+    """
+    CLEANUP_EVERY = 100
+
+    def __init__(self, max_size: int = LLM_CACHE_SIZE, path: str = None, disk_size: int = LLM_CACHE_DISK_SIZE):
+        self.max_size = max_size
+        self.path = path
+        self.disk_size = disk_size
+        self._data = OrderedDict()  # ключ -> JSON вызовов; в начале — самые давние
+        self._day = date.today().isoformat()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'bypassed': 0, 'stored': 0}
+        if path:
+            conn = self._connect()
+            conn.executescript(self.SCHEMA)
+            conn.execute('DELETE FROM llm_cache WHERE day != ?', (self._day,))
+
+    def _connect(self) -> sqlite3.Connection:
+        """Возвращает соединение текущего потока (sqlite3 не разрешает делить их между потоками)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, result: str):
+        with self._lock:
+            self.stats[result] += 1
+        metrics.inc('llm_cache_total', result=result)
+
+    def _check_day(self):
+        """При смене дня сбрасывает кэш: ответы со вчерашними датами больше не верны."""
+        today = date.today().isoformat()
+        if today == self._day:
+            return
+        with self._lock:
+            if today == self._day:
+                return
+            self._day = today
+            self._data.clear()
+        if self.path:
+            self._connect().execute('DELETE FROM llm_cache WHERE day != ?', (today,))
+        print(f"Кэш ответов модели сброшен: наступило {today}")
+
+    def key(self, prompt: str, text: str, history: list = None):
+        """Ключ кэша или None, если сообщение кэшировать нельзя (в нем нет ни одного слова)."""
+        normalized = normalize(text)
+        if not normalized:
+            return None
+        context = prompt + '\n' + json.dumps(history or [], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(context.encode('utf-8')).hexdigest()[:16] + ':' + normalized
+
+    def get(self, prompt: str, text: str, history: list = None):
+        """Возвращает сохраненные вызовы инструментов или None. history — история, которую увидела бы модель."""
+        if not self.max_size:
+            return None
+        key = self.key(prompt, text, history)
+        if key is None:
+            self._count('bypassed')
+            return None
+        self._check_day()
+        with self._lock:
+            data = self._data.get(key)
+            if data is not None:
+                self._data.move_to_end(key)
+        if data is not None:
+            self._count('hits')
+            return json.loads(data)
+        if self.path:
+            row = self._connect().execute(
+                'SELECT calls FROM llm_cache WHERE key = ? AND day = ?', (key, self._day)
+            ).fetchone()
+            if row:
+                self._remember(key, row[0])
+                self._count('disk_hits')
+                return json.loads(row[0])
+        self._count('misses')
+        return None
+
+    def put(self, prompt: str, text: str, calls: list, history: list = None):
+        """Запоминает вызовы инструментов. Текстовые ответы и некорректные вызовы не сохраняются."""
+        if not self.max_size or not calls:
+            return
+        if any(tools.validate(call['tool_call'], call['arguments'])[1] for call in calls):
+            return
+        key = self.key(prompt, text, history)
+        if key is None:
+            return
+        self._check_day()
+        data = json.dumps(calls, ensure_ascii=False)
+        self._remember(key, data)
+        self._count('stored')
+        if self.path:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, day, calls, created_at) VALUES (?, ?, ?, ?)',
+                (key, self._day, data, time.time())
+            )
+            self._writes += 1
+            if self._writes % self.CLEANUP_EVERY == 0:
+                conn.execute(
+                    'DELETE FROM llm_cache WHERE key IN ('
+                    ' SELECT key FROM llm_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)',
+                    (self.disk_size,)
+                )
+
+    def _remember(self, key: str, data: str):
+        with self._lock:
+            self._data[key] = data
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        if self.path:
+            self._connect().execute('DELETE FROM llm_cache')
+
+    def get_stats(self) -> dict:
+        """Счетчики попаданий и промахов, доля попаданий и размер кэша в памяти."""
+        with self._lock:
+            stats = dict(self.stats, size=len(self._data))
+        hits = stats['hits'] + stats['disk_hits']
+        total = hits + stats['misses']
+        stats['hit_rate'] = hits / total if total else 0.0
+        return stats
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_llm_cache() -> LLMCache:
+    """Возвращает общий для процесса кэш (размер задается LLM_CACHE_SIZE, диск — LLM_CACHE_DISK)."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LLMCache(path=DB_FILE if LLM_CACHE_DISK else None)
+    return _cache
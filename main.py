@@ -1,28 +1,33 @@
 import telebot
 import os
+import time
 from dotenv import load_dotenv
 
+# Переменные окружения загружаем до импорта модулей бота: они читают настройки при импорте
+load_dotenv()
+
 # --- Кастомные импорты ---
 import ai_core  # Наше новое AI-ядро
+import streaming
 
-# --- Импорты для планировщика (остаются без изменений) ---
-import time
-import threading
-from datetime import datetime
-import pytz
-from functions import load_tasks # Планировщику все еще нужно загружать задачи
+# --- Импорты для хранилища, планировщика уведомлений и очереди отправки ---
+import functions
+import metrics
+import outbox as outbox_module
+import pages
+import scheduler
+import storage
 
 # --- Инициализация ---
-load_dotenv()
 token = os.getenv('TELEGRAM_TOKEN')
 if not token:
     raise ValueError("Не найден TELEGRAM_TOKEN в .env файле!")
 bot = telebot.TeleBot(token)
+# Все сообщения отправляются через очередь с учетом лимитов Telegram
+outbox = outbox_module.Outbox(bot)
 
-# --- Константы и настройки для планировщика ---
+# --- Администратор (получает старые задачи из tasks.json и может смотреть /stats) ---
 ADMIN_ID = os.getenv('ADMIN_ID', "YOUR_TELEGRAM_ID")
-MOSCOW_TZ = pytz.timezone('Europe/Moscow')
-last_notification_date = None
 
 # --- Справка ---
 try:
@@ -33,10 +38,43 @@ except FileNotFoundError:
 
 # --- Обработчики сообщений Telegram ---
 
+def format_stats() -> str:
+    """Текст ответа на /stats."""
+    stats = ai_core.get_intent_stats()
+    return (
+        f"Распознано локально: {stats['local_hits']}\n"
+        f"Обращений к AI: {stats['llm_calls']}\n"
+        f"Доля локальных ответов: {stats['hit_rate']:.0%}\n"
+        f"Сэкономлено времени: {stats['time_saved']:.1f} с"
+    )
+
 @bot.message_handler(commands=["start", "help"])
 def start_help_command(message):
     """Обработчик команд /start и /help."""
-    bot.send_message(message.chat.id, HELP_MESSAGE, parse_mode='Markdown')
+    functions.register_user(message.chat.id)
+    outbox.send_message(message.chat.id, HELP_MESSAGE, parse_mode='Markdown')
+
+def command_argument(message) -> str:
+    """Текст после команды: "/notify 07:30" -> "07:30"."""
+    parts = message.text.split(maxsplit=1)
+    return parts[1] if len(parts) > 1 else ''
+
+@bot.message_handler(commands=["timezone"])
+def timezone_command(message):
+    """Обработчик команды /timezone <часовой пояс>."""
+    outbox.send_message(message.chat.id, functions.set_timezone(message.chat.id, command_argument(message)))
+
+@bot.message_handler(commands=["notify"])
+def notify_command(message):
+    """Обработчик команды /notify <ЧЧ:ММ|off>."""
+    outbox.send_message(message.chat.id, functions.set_notify_time(message.chat.id, command_argument(message)))
+
+@bot.message_handler(commands=["stats"])
+def stats_command(message):
+    """Обработчик команды /stats (только для администратора): статистика локального распознавания команд."""
+    if str(message.chat.id) != str(ADMIN_ID):
+        return
+    outbox.send_message(message.chat.id, format_stats())
 
 @bot.message_handler(content_types=["text"])
 def handle_text_message(message):
@@ -46,64 +84,68 @@ def handle_text_message(message):
     """
     user_id = message.chat.id
     text = message.text
+    metrics.observe('bot_update_age_seconds', max(time.time() - message.date, 0))
 
-    # Отправляем "Думаю..." для обратной связи
-    thinking_message = bot.send_message(user_id, "Думаю... 🤔", disable_notification=True)
+    with metrics.context(chat_id=user_id, message_id=message.message_id), metrics.span('message'):
+        # Отправляем "Думаю..." для обратной связи (ждем отправки: для правок нужен message_id)
+        with metrics.span('placeholder'):
+            thinking_message = outbox.send_message(user_id, "Думаю... 🤔", disable_notification=True).result()
 
-    try:
-        # Получаем ответ от AI-ядра
-        response = ai_core.process_message(user_id, text)
-        bot.edit_message_text(response, user_id, thinking_message.message_id)
-    except Exception as e:
-        print(f"[Ошибка] Проблема в AI-ядре: {e}")
-        bot.edit_message_text("Произошла внутренняя ошибка. Попробуйте позже.", user_id, thinking_message.message_id)
+        # Ответ модели показываем по мере генерации, редактируя "Думаю..."
+        reply = streaming.StreamingReply(
+            lambda partial, reply_markup=None: outbox.edit_message_text(
+                partial, user_id, thinking_message.message_id, reply_markup=reply_markup
+            )
+        )
 
-
-# --- Логика уведомлений и планировщика (без изменений) ---
-def check_tasks_and_notify():
-    """Проверяет задачи на сегодня и отправляет уведомление."""
-    global last_notification_date
-    if ADMIN_ID == "YOUR_TELEGRAM_ID":
-        print("Внимание: ADMIN_ID не установлен. Уведомления не будут отправляться.")
+        try:
+            # Получаем ответ от AI-ядра
+            response = ai_core.process_message(user_id, text, on_partial=reply.update)
+            reply.finish(response)
+        except Exception as e:
+            print(f"[Ошибка] Проблема в AI-ядре: {e}")
+            metrics.inc('bot_errors_total')
+            reply.fail("Произошла внутренняя ошибка. Попробуйте позже.")
+
+@bot.callback_query_handler(func=lambda call: pages.is_callback(call.data))
+def tasks_page_callback(call):
+    """Листание списка задач кнопками: страница читается из кэша или хранилища, без обращения к AI."""
+    if call.message is None:
         return
+    chat_id = call.message.chat.id
+    with metrics.context(chat_id=chat_id), metrics.span('tasks_page'):
+        page = pages.handle_callback(chat_id, call.data)
+        outbox.edit_message_text(page, chat_id, call.message.message_id, reply_markup=page.reply_markup)
+        outbox.submit('answer_callback_query', chat_id, call.id)
 
-    today_moscow = datetime.now(MOSCOW_TZ).date()
-    today_str = today_moscow.strftime('%Y-%m-%d')
 
-    if today_moscow == last_notification_date:
-        return # Уже отправляли сегодня
+# --- Запуск бота и планировщика ---
+def send_notification(chat_id, text):
+    """Отправка уведомления планировщика: сохраняется в очереди отправки и переживает ошибки и перезапуски."""
+    return outbox.send_message(chat_id, text, priority=outbox_module.BULK, durable=True)
 
-    current_tasks = load_tasks()
-    if today_str in current_tasks and current_tasks[today_str]:
-        tasks_today = current_tasks[today_str]
-        message = "Доброе утро! ☀️ На сегодня у вас есть задачи:\n\n"
-        for i, task in enumerate(tasks_today, 1):
-            message += f"{i}. {task}\n"
+def start_background_services(notifications: bool = True):
+    """
+    Миграция старых задач, фоновая очистка и планировщик уведомлений (общие для всех режимов запуска).
+    notifications=False — без очереди отправки и планировщика: в cluster.py их запускают рабочие процессы.
+    """
+    # Однократный перенос задач из старого tasks.json (они принадлежали администратору)
+    if ADMIN_ID != "YOUR_TELEGRAM_ID":
+        storage.migrate_json(functions.TASKS_FILE, int(ADMIN_ID))
+        functions.register_user(int(ADMIN_ID))
+    storage.start_pruner()
+
+    # Метрики (если включены): страница /metrics и показатели, которые считываются при выгрузке
+    metrics.start_server()
+    if not notifications:
+        return
+    metrics.gauge('outbox_pending', outbox.pending)
 
-        try:
-            bot.send_message(ADMIN_ID, message)
-            last_notification_date = today_moscow # Обновляем дату после успешной отправки
-            print(f"Уведомление о задачах на {today_str} отправлено.")
-        except Exception as e:
-            print(f"Ошибка при отправке уведомления: {e}")
-    else:
-        print(f"На {today_str} нет задач, уведомление не отправлено.")
-
-def run_scheduler():
-    """Запускает цикл проверки времени для уведомлений."""
-    while True:
-        now_moscow = datetime.now(MOSCOW_TZ)
-        # Проверяем задачи в определенное время, например, в 5 утра
-        if now_moscow.hour == 5:
-            check_tasks_and_notify()
-        time.sleep(3600) # Проверка раз в час
+    outbox.start()
+    scheduler.start_scheduler(send_notification)
 
-# --- Запуск бота и планировщика ---
 if __name__ == '__main__':
-    scheduler_thread = threading.Thread(target=run_scheduler)
-    scheduler_thread.daemon = True
-    scheduler_thread.start()
-    print("Планировщик запущен.")
+    start_background_services()
 
     print("AI-бот запускается...")
     bot.polling(none_stop=True)
\ No newline at end of file
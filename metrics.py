@@ -0,0 +1,302 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Метрики включаются любой из настроек: METRICS=1 (только сбор, например для benchmark.py),
+# METRICS_PORT (страница /metrics в формате Prometheus) или METRICS_LOG=1 (JSON-строка на каждый этап).
+# Когда метрики выключены, span() и счетчики ничего не делают и почти ничего не стоят.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+JSON_LOG = os.getenv('METRICS_LOG', '0') == '1'
+ENABLED = os.getenv('METRICS', '0') == '1' or bool(METRICS_PORT) or JSON_LOG
+
+# Границы корзин гистограмм длительности, в секундах
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Описания метрик для страницы /metrics
+HELP = {
+    'bot_stage_duration_seconds': "Длительность этапов обработки сообщения",
+    'bot_stage_errors_total': "Этапы, завершившиеся исключением",
+    'bot_update_age_seconds': "Возраст обновления Telegram к началу обработки",
+    'bot_errors_total': "Внутренние ошибки при обработке сообщений",
+    'intents_total': "Сообщения по способу обработки (pending, local, llm)",
+    'confirmations_expired_total': "Подтверждения удаления, на которые ответили слишком поздно",
+    'ai_fallbacks_total': "Ответы модели, которые не удалось выполнить как вызов инструмента",
+    'tool_calls_invalid_total': "Вызовы инструментов с аргументами, не прошедшими проверку схемы",
+    'llm_requests_total': "Запросы к модели по результату",
+    'llm_retries_total': "Повторы запросов к модели",
+    'llm_hedges_total': "Хеджирующие запросы к модели",
+    'llm_failures_total': "Сообщения, для которых модель так и не ответила",
+    'llm_cache_total': "Обращения к кэшу ответов модели (hits, disk_hits, misses, bypassed, stored)",
+    'task_pages_total': "Страницы списка задач: из кэша (hit) и собранные заново (miss)",
+    'llm_tokens_total': "Токены по данным usage из ответа модели",
+    'webhook_updates_total': "Запросы Telegram к webhook по результату (accepted, duplicate, overloaded, ...)",
+    'telegram_requests_total': "Вызовы Telegram Bot API по методу и результату",
+    'outbox_queue_wait_seconds': "Время ожидания сообщения в очереди отправки",
+}
+
+_lock = threading.Lock()
+_counters = {}  # (имя, метки) -> значение
+_histograms = {}  # (имя, метки) -> [счетчики корзин..., сумма, количество]
+_gauges = {}  # имя -> функция без аргументов, значение читается при выгрузке
+_context = contextvars.ContextVar('metrics_context', default=None)
+_server = None
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name: str, value: float = 1, **labels):
+    """Увеличивает счетчик."""
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name: str, value: float, **labels):
+    """Добавляет значение (обычно длительность в секундах) в гистограмму."""
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    index = bisect.bisect_left(BUCKETS, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+        histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+def gauge(name: str, read):
+    """Регистрирует показатель, значение которого read() считывается при каждой выгрузке метрик."""
+    _gauges[name] = read
+
+
+# --- Этапы обработки ---
+
+class _Span:
+    """Замер одного этапа: длительность попадает в bot_stage_duration_seconds{stage=...}."""
+    __slots__ = ('stage', 'fields', 'started')
+
+    def __init__(self, stage: str, fields: dict):
+        self.stage = stage
+        self.fields = fields
+
+    def set(self, **fields):
+        """Добавляет поля в JSON-лог этапа (например, число токенов)."""
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.started
+        observe('bot_stage_duration_seconds', duration, stage=self.stage)
+        if exc_type is not None:
+            inc('bot_stage_errors_total', stage=self.stage)
+        if JSON_LOG:
+            log('span', stage=self.stage, duration_ms=round(duration * 1000, 3),
+                status='error' if exc_type else 'ok', **self.fields)
+        return False
+
+
+class _NullSpan:
+    """Заглушка вместо _Span, когда метрики выключены."""
+    __slots__ = ()
+
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def span(stage: str, **fields):
+    """
+    Замеряет этап обработки сообщения:
+        with metrics.span('llm') as s:
+            ...
+            s.set(prompt_tokens=120)
+    fields попадают только в JSON-лог, метка гистограммы — только stage.
+    """
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(stage, fields)
+
+
+class context:
+    """
+    Поля (chat_id и т.п.), которые добавляются в JSON-логи всех этапов внутри блока.
+    Работает и в потоках, и в асинхронных задачах (contextvars).
+    """
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def __enter__(self):
+        if ENABLED:
+            self._token = _context.set(dict(_context.get() or {}, **self.fields))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if ENABLED:
+            _context.reset(self._token)
+        return False
+
+
+def log(event: str, **fields):
+    """Пишет событие JSON-строкой в стандартный вывод (если METRICS_LOG=1)."""
+    if not JSON_LOG:
+        return
+    record = {'time': datetime.now().isoformat(timespec='milliseconds'), 'event': event}
+    record.update(_context.get() or {})
+    record.update(fields)
+    print(json.dumps(record, ensure_ascii=False, default=str), flush=True)
+
+
+# --- Выгрузка ---
+
+def _format_labels(labels, extra: tuple = ()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in items) + '}'
+
+def render() -> str:
+    """Метрики в текстовом формате Prometheus."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(value) for key, value in _histograms.items()}
+    lines = []
+    described = set()
+
+    def describe(name, kind):
+        if name not in described:
+            described.add(name)
+            if name in HELP:
+                lines.append(f"# HELP {name} {HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name, 'counter')
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), histogram in sorted(histograms.items()):
+        describe(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), histogram):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-2]}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram[-1]}")
+    for name, read in sorted(_gauges.items()):
+        try:
+            value = read()
+        except Exception as e:
+            print(f"Не удалось получить значение метрики {name}: {e}")
+            continue
+        describe(name, 'gauge')
+        lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+def _quantile(histogram: list, q: float) -> float:
+    """Оценка квантиля по корзинам гистограммы (линейная интерполяция, как histogram_quantile)."""
+    total = histogram[-1]
+    if not total:
+        return 0.0
+    rank = q * total
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(BUCKETS, histogram):
+        if cumulative + count >= rank and count:
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = bound
+    return BUCKETS[-1]
+
+def snapshot() -> dict:
+    """
+    Текущие значения в виде словаря (для benchmark.py):
+    {'counters': {"имя{метки}": значение}, 'stages': {этап: {count, mean, p50, p95, p99}}}.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(value) for key, value in _histograms.items()}
+    stages = {}
+    for (name, labels), histogram in sorted(histograms.items()):
+        if name != 'bot_stage_duration_seconds':
+            continue
+        summary = {'count': histogram[-1], 'mean': round(histogram[-2] / histogram[-1], 4)}
+        for p in (50, 95, 99):
+            summary[f'p{p}'] = round(_quantile(histogram, p / 100), 4)
+        stages[dict(labels)['stage']] = summary
+    return {
+        'counters': {f"{name}{_format_labels(labels)}": value for (name, labels), value in sorted(counters.items())},
+        'stages': stages,
+    }
+
+def export() -> dict:
+    """Накопленные значения как есть, для передачи из другого процесса в merge() (см. cluster.py)."""
+    with _lock:
+        return {
+            'counters': list(_counters.items()),
+            'histograms': [(key, list(value)) for key, value in _histograms.items()],
+        }
+
+def merge(state: dict):
+    """Добавляет к своим значениям результат export() другого процесса."""
+    with _lock:
+        for key, value in state['counters']:
+            _counters[key] = _counters.get(key, 0) + value
+        for key, value in state['histograms']:
+            histogram = _histograms.get(key)
+            if histogram is None:
+                histogram = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+            for i, item in enumerate(value):
+                histogram[i] += item
+
+def reset():
+    """Обнуляет накопленные значения."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+# --- Страница /metrics ---
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def start_server(port: int = METRICS_PORT, host: str = METRICS_HOST):
+    """Запускает страницу /metrics (если задан порт). Возвращает сервер или None."""
+    global _server
+    if not port or _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((host, port), _Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+    print(f"Метрики доступны на http://{host}:{_server.server_address[1]}/metrics")
+    return _server
@@ -1,49 +1,443 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, APIStatusError
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import deque
+import asyncio
+import httpx
+import metrics
 import os
+import random
+import threading
+import time
 
-def get_client():
-    """Возвращает инициализированный клиент OpenRouter."""
+# --- Настройки подключения (можно переопределить через .env) ---
+BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+MODEL = os.getenv("OPENROUTER_MODEL", "qwen/qwen-turbo") # Using a faster model
+CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("OPENROUTER_READ_TIMEOUT", "30"))
+POOL_SIZE = int(os.getenv("OPENROUTER_POOL_SIZE", "20"))
+
+# Повторы при 429/5xx и сетевых ошибках: экспоненциальная задержка с джиттером
+MAX_RETRIES = int(os.getenv("OPENROUTER_MAX_RETRIES", "3"))
+BACKOFF_BASE = float(os.getenv("OPENROUTER_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("OPENROUTER_BACKOFF_MAX", "8"))
+
+# Хеджирование: если ответа нет дольше p95, отправляем второй такой же запрос и берем первый ответ
+HEDGE_ENABLED = os.getenv("OPENROUTER_HEDGE", "0") == "1"
+HEDGE_MIN_DELAY = float(os.getenv("OPENROUTER_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MIN_SAMPLES = 20
+
+# Нативный вызов инструментов (tools). Если модель или провайдер его не поддерживает,
+# переключаемся на старый протокол: JSON с вызовом в тексте ответа (см. ai_prompt.txt)
+TOOLS_ENABLED = os.getenv("OPENROUTER_TOOLS", "1") == "1"
+
+# Ограничение числа одновременных запросов к провайдеру в асинхронном режиме
+MAX_CONCURRENCY = int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "10"))
+
+EXTRA_HEADERS = {
+    "HTTP-Referer": "http://localhost", # Replace with your site URL
+    "X-Title": "Chat Bot Netology", # Replace with your app name
+}
+
+_client = None
+_client_lock = threading.Lock()
+_latencies = deque(maxlen=200) # Время последних успешных ответов, для оценки p95
+_hedge_executor = None
+_async_client = None
+_async_semaphore = None
+_tools_supported = True # Сбрасывается при первом отказе провайдера принимать tools
+
+
+class AIResponse(str):
+    """
+    Текст ответа модели. В tool_calls — нативные вызовы инструментов
+    [{"name": ..., "arguments": строка JSON}] (пусто, если модель ответила текстом),
+    в usage — израсходованные токены {"prompt_tokens", "completion_tokens"} (пусто, если провайдер их не вернул).
+    """
+
+    def __new__(cls, text: str, tool_calls: list = None, usage: dict = None):
+        response = super().__new__(cls, text)
+        response.tool_calls = tool_calls or []
+        response.usage = usage or {}
+        return response
+
+
+def _get_api_key() -> str:
     api_key = os.getenv("OPENROUTER_API_KEY")
     if not api_key:
         raise ValueError("Не найден OPENROUTER_API_KEY в .env файле!")
-    
-    return OpenAI(
-        base_url="https://openrouter.ai/api/v1",
-        api_key=api_key,
+    return api_key
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=POOL_SIZE,
+        max_keepalive_connections=POOL_SIZE,
+        keepalive_expiry=60,
     )
 
-def get_ai_response(system_prompt: str, user_text: str) -> str:
+def get_client():
     """
-    Отправляет запрос к модели OpenRouter с заданным системным промптом и текстом пользователя.
-    Возвращает "сырой" ответ от модели (может быть JSON или обычный текст).
+    Возвращает общий для процесса клиент OpenRouter.
+    Клиент создается один раз и переиспользует HTTP-соединения (keep-alive),
+    поэтому каждое сообщение не платит за новое TCP/TLS-подключение.
     """
-    try:
-        client = get_client()
-        
-        completion = client.chat.completions.create(
-            model="qwen/qwen-turbo", # Using a faster model
-            messages=[
-                {
-                    "role": "system",
-                    "content": system_prompt,
-                },
-                {
-                    "role": "user",
-                    "content": user_text,
-                },
-            ],
-            extra_headers={
-                "HTTP-Referer": "http://localhost", # Replace with your site URL
-                "X-Title": "Chat Bot Netology", # Replace with your app name
-            }
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    base_url=BASE_URL,
+                    api_key=_get_api_key(),
+                    timeout=_timeout(),
+                    max_retries=0, # Повторы делаем сами, см. _complete_with_retries
+                    http_client=httpx.Client(timeout=_timeout(), limits=_limits()),
+                )
+    return _client
+
+def get_async_client():
+    """Возвращает общий асинхронный клиент OpenRouter (для режима async_main.py)."""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(
+            base_url=BASE_URL,
+            api_key=_get_api_key(),
+            timeout=_timeout(),
+            max_retries=0,
+            http_client=httpx.AsyncClient(timeout=_timeout(), limits=_limits()),
         )
+    return _async_client
+
+async def close_async_client():
+    """Закрывает асинхронный клиент и его пул соединений (при остановке бота)."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+
+def _get_async_semaphore() -> asyncio.Semaphore:
+    global _async_semaphore
+    if _async_semaphore is None:
+        _async_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    return _async_semaphore
+
+def _is_retryable(error: Exception) -> bool:
+    """Повторяем только временные ошибки: таймауты, обрывы соединения, 429 и 5xx."""
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, APIConnectionError)
+
+def _backoff_delay(attempt: int, error: Exception) -> float:
+    """Задержка перед повтором: "full jitter" от экспоненты, но не меньше Retry-After от сервера."""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    if isinstance(error, APIStatusError):
+        try:
+            delay = max(delay, min(BACKOFF_MAX, float(error.response.headers.get("retry-after", 0))))
+        except (TypeError, ValueError):
+            pass
+    return delay
+
+def _request(messages: list, tools: list = None, **kwargs) -> dict:
+    """Параметры запроса к модели (tools передаются, только если провайдер их поддерживает)."""
+    request = dict(model=MODEL, messages=messages, extra_headers=EXTRA_HEADERS, **kwargs)
+    if kwargs.get('stream'):
+        # Без этого в потоковом ответе нет usage: его присылают последним фрагментом без choices
+        request['extra_body'] = {"stream_options": {"include_usage": True}}
+    if tools and _tools_supported:
+        request.update(tools=tools, tool_choice="auto")
+    return request
+
+def _tools_rejected(error: Exception) -> bool:
+    """Провайдер отказался принимать tools (например, "No endpoints found that support tool use")."""
+    return (isinstance(error, APIStatusError) and error.status_code in (400, 404, 422)
+            and "tool" in str(error).lower())
+
+def _response_from_completion(completion, usage: dict) -> AIResponse:
+    message = completion.choices[0].message
+    tool_calls = [
+        {"name": call.function.name, "arguments": call.function.arguments or ""}
+        for call in (getattr(message, "tool_calls", None) or [])
+    ]
+    return AIResponse((message.content or "").strip(), tool_calls, usage)
+
+def _add_tool_call_delta(calls: dict, delta):
+    """Собирает нативные вызовы инструментов из фрагментов потокового ответа."""
+    for call in getattr(delta, "tool_calls", None) or []:
+        entry = calls.setdefault(call.index, {"name": "", "arguments": ""})
+        if call.function is not None:
+            entry["name"] += call.function.name or ""
+            entry["arguments"] += call.function.arguments or ""
+
+def _complete_with_retries(messages: list, tools: list = None) -> AIResponse:
+    """Выполняет запрос к модели, повторяя его при временных ошибках."""
+    client = get_client()
+    for attempt in range(MAX_RETRIES + 1):
+        started = time.monotonic()
+        try:
+            completion = client.chat.completions.create(**_request(messages, tools))
+        except Exception as e:
+            metrics.inc('llm_requests_total', status='error')
+            if attempt == MAX_RETRIES or not _is_retryable(e):
+                raise
+            delay = _backoff_delay(attempt, e)
+            print(f"Временная ошибка OpenRouter ({e}), повтор через {delay:.2f} с")
+            metrics.inc('llm_retries_total')
+            time.sleep(delay)
+            continue
+
+        _latencies.append(time.monotonic() - started)
+        usage = _record_usage(getattr(completion, 'usage', None))
+        return _response_from_completion(completion, usage)
+
+def _stream_with_retries(messages: list, on_delta, tools: list = None) -> AIResponse:
+    """
+    Потоковый запрос: on_delta(text) вызывается с накопленным текстом после каждого фрагмента.
+    Повторяем запрос, только если пользователь еще не получил ни одного фрагмента.
+    """
+    client = get_client()
+    for attempt in range(MAX_RETRIES + 1):
+        started = time.monotonic()
+        text = ""
+        calls = {}
+        usage = None
+        try:
+            stream = client.chat.completions.create(**_request(messages, tools, stream=True))
+            for chunk in stream:
+                usage = getattr(chunk, 'usage', None) or usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                _add_tool_call_delta(calls, delta)
+                if delta.content:
+                    text += delta.content
+                    on_delta(text)
+        except Exception as e:
+            metrics.inc('llm_requests_total', status='error')
+            if text or attempt == MAX_RETRIES or not _is_retryable(e):
+                raise
+            delay = _backoff_delay(attempt, e)
+            print(f"Временная ошибка OpenRouter ({e}), повтор через {delay:.2f} с")
+            metrics.inc('llm_retries_total')
+            time.sleep(delay)
+            continue
+
+        _latencies.append(time.monotonic() - started)
+        usage = _record_usage(usage)
+        return AIResponse(text.strip(), [calls[index] for index in sorted(calls)], usage)
+
+def _record_usage(usage) -> dict:
+    """
+    Учитывает успешный ответ и израсходованные токены (если провайдер вернул usage).
+    usage — объект из ответа или словарь (в потоковом ответе старого клиента openai это просто dict).
+    Возвращает {"prompt_tokens", "completion_tokens"} или пустой словарь.
+    """
+    metrics.inc('llm_requests_total', status='ok')
+    if usage is None:
+        return {}
+    if not isinstance(usage, dict):
+        usage = {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens}
+    tokens = {
+        'prompt_tokens': usage.get('prompt_tokens') or 0,
+        'completion_tokens': usage.get('completion_tokens') or 0,
+    }
+    metrics.inc('llm_tokens_total', tokens['prompt_tokens'], type='prompt')
+    metrics.inc('llm_tokens_total', tokens['completion_tokens'], type='completion')
+    return tokens
+
+def _hedge_delay():
+    """Задержка перед хеджирующим запросом (p95 последних ответов) или None, если данных мало."""
+    if len(_latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(_latencies)
+    return max(HEDGE_MIN_DELAY, ordered[int(0.95 * (len(ordered) - 1))])
+
+def _complete_hedged(messages: list, tools: list = None) -> AIResponse:
+    """
+    Отправляет запрос и, если ответ задерживается дольше p95, дублирует его.
+    Возвращается ответ, пришедший первым; второй запрос дорабатывает в фоне.
+    """
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _client_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="openrouter-hedge")
+
+    delay = _hedge_delay()
+    pending = {_hedge_executor.submit(_complete_with_retries, messages, tools)}
+    if delay is not None:
+        done, _ = wait(pending, timeout=delay)
+        if not done:
+            metrics.inc('llm_hedges_total')
+            pending.add(_hedge_executor.submit(_complete_with_retries, messages, tools))
+
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+async def _complete_with_retries_async(messages: list, tools: list = None) -> AIResponse:
+    """Асинхронный вариант _complete_with_retries с общим лимитом одновременных запросов."""
+    client = get_async_client()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with _get_async_semaphore():
+                started = time.monotonic()
+                completion = await client.chat.completions.create(**_request(messages, tools))
+        except Exception as e:
+            metrics.inc('llm_requests_total', status='error')
+            if attempt == MAX_RETRIES or not _is_retryable(e):
+                raise
+            delay = _backoff_delay(attempt, e)
+            print(f"Временная ошибка OpenRouter ({e}), повтор через {delay:.2f} с")
+            metrics.inc('llm_retries_total')
+            await asyncio.sleep(delay)
+            continue
+
+        _latencies.append(time.monotonic() - started)
+        usage = _record_usage(getattr(completion, 'usage', None))
+        return _response_from_completion(completion, usage)
+
+async def _stream_with_retries_async(messages: list, on_delta, tools: list = None) -> AIResponse:
+    """Асинхронный вариант _stream_with_retries: on_delta — корутина."""
+    client = get_async_client()
+    for attempt in range(MAX_RETRIES + 1):
+        text = ""
+        calls = {}
+        usage = None
+        try:
+            async with _get_async_semaphore():
+                started = time.monotonic()
+                stream = await client.chat.completions.create(**_request(messages, tools, stream=True))
+                async for chunk in stream:
+                    usage = getattr(chunk, 'usage', None) or usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    _add_tool_call_delta(calls, delta)
+                    if delta.content:
+                        text += delta.content
+                        await on_delta(text)
+        except Exception as e:
+            metrics.inc('llm_requests_total', status='error')
+            if text or attempt == MAX_RETRIES or not _is_retryable(e):
+                raise
+            delay = _backoff_delay(attempt, e)
+            print(f"Временная ошибка OpenRouter ({e}), повтор через {delay:.2f} с")
+            metrics.inc('llm_retries_total')
+            await asyncio.sleep(delay)
+            continue
+
+        _latencies.append(time.monotonic() - started)
+        usage = _record_usage(usage)
+        return AIResponse(text.strip(), [calls[index] for index in sorted(calls)], usage)
+
+async def _complete_hedged_async(messages: list, tools: list = None) -> AIResponse:
+    """Асинхронный вариант _complete_hedged: опоздавший запрос отменяется."""
+    delay = _hedge_delay()
+    pending = {asyncio.ensure_future(_complete_with_retries_async(messages, tools))}
+    if delay is not None:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            metrics.inc('llm_hedges_total')
+            pending.add(asyncio.ensure_future(_complete_with_retries_async(messages, tools)))
 
-        result = completion.choices[0].message.content or ""
-        return result.strip()
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+def _build_messages(system_prompt: str, user_text: str, history: list = None) -> list:
+    """history — предыдущие сообщения диалога [{"role": "user"/"assistant", "content": ...}]."""
+    return [
+        {
+            "role": "system",
+            "content": system_prompt,
+        },
+        *(history or []),
+        {
+            "role": "user",
+            "content": user_text,
+        },
+    ]
+
+def _disable_tools(error: Exception):
+    global _tools_supported
+    _tools_supported = False
+    metrics.inc('ai_fallbacks_total', reason='no_native_tools')
+    print(f"Модель не поддерживает tools ({error}), переходим на вызовы инструментов в JSON")
+
+def _respond(messages: list, on_delta, tools: list) -> AIResponse:
+    if on_delta is not None:
+        return _stream_with_retries(messages, on_delta, tools)
+    if HEDGE_ENABLED:
+        return _complete_hedged(messages, tools)
+    return _complete_with_retries(messages, tools)
+
+async def _respond_async(messages: list, on_delta, tools: list) -> AIResponse:
+    if on_delta is not None:
+        return await _stream_with_retries_async(messages, on_delta, tools)
+    if HEDGE_ENABLED:
+        return await _complete_hedged_async(messages, tools)
+    return await _complete_with_retries_async(messages, tools)
+
+def get_ai_response(system_prompt: str, user_text: str, on_delta=None, history: list = None,
+                    tools: list = None) -> str:
+    """
+    Отправляет запрос к модели OpenRouter с заданным системным промптом и текстом пользователя.
+    Возвращает ответ модели (AIResponse: текст, может быть JSON, и нативные вызовы инструментов)
+    или строку с сообщением об ошибке.
+    Если передан on_delta, ответ запрашивается потоково (stream=True) и on_delta(text)
+    получает накопленный текст по мере генерации; хеджирование в этом режиме не используется.
+    history — последние сообщения диалога, которые модель увидит перед текущим.
+    tools — описания инструментов для нативного function calling (см. tools.TOOLS).
+    """
+    messages = _build_messages(system_prompt, user_text, history)
+    tools = tools if TOOLS_ENABLED else None
+    try:
+        try:
+            return _respond(messages, on_delta, tools)
+        except Exception as e:
+            if not (tools and _tools_supported and _tools_rejected(e)):
+                raise
+            _disable_tools(e)
+            return _respond(messages, on_delta, None)
 
     except Exception as e:
         print(f"Ошибка при вызове модели OpenRouter: {e}")
+        metrics.inc('llm_failures_total')
         # Возвращаем пустую строку или информацию об ошибке, чтобы ai_core мог ее обработать
         return "Произошла ошибка при обращении к AI. Пожалуйста, попробуйте позже."
 
-# Функции get_intent, chat_reply, speech_to_text, _extract_json_object удалены как устаревшие.
\ No newline at end of file
+async def get_ai_response_async(system_prompt: str, user_text: str, on_delta=None, history: list = None,
+                                tools: list = None) -> str:
+    """Асинхронный вариант get_ai_response (не блокирует цикл событий на время ответа модели)."""
+    messages = _build_messages(system_prompt, user_text, history)
+    tools = tools if TOOLS_ENABLED else None
+    try:
+        try:
+            return await _respond_async(messages, on_delta, tools)
+        except Exception as e:
+            if not (tools and _tools_supported and _tools_rejected(e)):
+                raise
+            _disable_tools(e)
+            return await _respond_async(messages, on_delta, None)
+
+    except Exception as e:
+        print(f"Ошибка при вызове модели OpenRouter: {e}")
+        metrics.inc('llm_failures_total')
+        return "Произошла ошибка при обращении к AI. Пожалуйста, попробуйте позже."
+
+# Функции get_intent, chat_reply, speech_to_text, _extract_json_object удалены как устаревшие.
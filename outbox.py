@@ -0,0 +1,357 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+from storage import get_storage
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около 1 в секунду на чат
+# (короткие всплески в одном чате допускаются — например, "Думаю..." и сразу готовый ответ)
+GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '30'))
+CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1'))
+CHAT_BURST = float(os.getenv('OUTBOX_CHAT_BURST', '3'))
+# Запас к лимитам: Telegram считает запросы по моменту прихода, а сетевая задержка у них
+# разная, поэтому при отправке точно на пределе часть запросов получала бы 429
+RATE_MARGIN = 0.9
+# Сколько запросов к Telegram выполнять одновременно
+WORKERS = int(os.getenv('OUTBOX_WORKERS', '8'))
+
+# Повторы при сетевых ошибках и 5xx
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 1.0
+# Сохраненные в базе сообщения, которые не удалось отправить, повторяем реже и дольше
+DURABLE_RETRY_DELAY = 60.0
+DURABLE_MAX_ATTEMPTS = 10
+RESUME_INTERVAL = 30.0
+
+# Приоритеты: ответы пользователю важнее массовых рассылок
+INTERACTIVE = 0
+BULK = 1
+
+
+class TokenBucket:
+    """Ведро токенов: в среднем rate операций в секунду, всплеск до capacity операций."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до появления токена (0 — можно сразу)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def set_rate(self, rate: float, capacity: float, now: float):
+        """Меняет лимит; накопленные токены сверх нового capacity пропадают."""
+        self._refill(now)
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = min(self.tokens, capacity)
+
+
+class _Job:
+    """Один вызов Bot API, ожидающий отправки."""
+    __slots__ = ('method', 'args', 'kwargs', 'priority', 'future', 'attempts', 'durable_id', 'queued_at')
+
+    def __init__(self, method, args, kwargs, priority, durable_id=None):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.attempts = 0
+        self.durable_id = durable_id
+        self.queued_at = time.monotonic()
+
+
+class _ChatState:
+    """Очередь и лимит одного чата. Сообщения одного чата уходят строго по порядку, по одному."""
+    __slots__ = ('jobs', 'bucket', 'busy', 'scheduled', 'blocked_until')
+
+    def __init__(self):
+        self.jobs = deque()
+        self.bucket = TokenBucket(CHAT_RATE * RATE_MARGIN, CHAT_BURST)
+        self.busy = False  # Запрос этого чата сейчас выполняется
+        self.scheduled = False  # Чат уже стоит в очереди готовых или отложенных
+        self.blocked_until = 0.0  # После 429 — не отправлять до этого момента
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений с учетом лимитов Telegram.
+
+    Все отправки и правки идут через общий лимит бота и лимит своего чата.
+    Когда можно отправить несколько сообщений, первыми уходят ответы пользователям
+    (INTERACTIVE), а массовые рассылки (BULK) ждут. На ответ 429 чат ставится на паузу
+    на retry_after секунд, после чего сообщение отправляется повторно.
+
+    Сообщения с durable=True (утренние сводки, напоминания) сначала сохраняются в базу
+    и удаляются из неё только после доставки, поэтому переживают ошибки и перезапуски.
+    """
+
+    def __init__(self, bot, storage=None, workers: int = WORKERS):
+        self._bot = bot
+        self._storage = storage
+        self._global = TokenBucket(GLOBAL_RATE * RATE_MARGIN, GLOBAL_RATE * RATE_MARGIN)
+        self._chats = {}  # chat_id -> _ChatState
+        self._ready = []  # (приоритет, порядковый номер, chat_id) — чаты, которым можно отправлять
+        self._delayed = []  # (момент готовности, порядковый номер, chat_id) — чаты, ждущие лимита
+        self._durable_ids = set()  # Сохраненные сообщения, которые уже стоят в очереди в памяти
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbox')
+        self._stopped = False
+        self._resume_stopped = False
+
+    @property
+    def storage(self):
+        return self._storage or get_storage()
+
+    # --- Постановка в очередь ---
+
+    def submit(self, method: str, chat_id, *args, priority: int = INTERACTIVE, **kwargs) -> Future:
+        """Ставит в очередь вызов bot.<method>(*args, **kwargs). Возвращает Future с результатом вызова."""
+        return self._enqueue(chat_id, _Job(method, args, kwargs, priority))
+
+    def send_message(self, chat_id, text: str, priority: int = INTERACTIVE, durable: bool = False, **kwargs) -> Future:
+        """
+        Отправляет сообщение через очередь.
+        С durable=True сообщение сначала сохраняется в базу (для рассылок и уведомлений).
+        Внутри storage.batch() оно сохраняется в той же транзакции и уходит только после её
+        фиксации, а при откате не отправляется вовсе.
+        """
+        if not durable:
+            return self._enqueue(chat_id, _Job('send_message', (chat_id, text), kwargs, priority))
+        storage = self.storage
+        durable_id = storage.outbox_add(chat_id, {'text': text, 'kwargs': kwargs})
+        job = _Job('send_message', (chat_id, text), kwargs, priority, durable_id)
+        storage.after_commit(lambda: self._enqueue(chat_id, job))
+        return job.future
+
+    def edit_message_text(self, text: str, chat_id, message_id: int, priority: int = INTERACTIVE, **kwargs) -> Future:
+        """Редактирует сообщение через очередь (правки подчиняются тем же лимитам, что и отправка)."""
+        return self.submit('edit_message_text', chat_id, text, chat_id, message_id, priority=priority, **kwargs)
+
+    def _enqueue(self, chat_id, job: _Job) -> Future:
+        with self._cond:
+            if job.durable_id is not None:
+                self._durable_ids.add(job.durable_id)
+            state = self._chats.get(chat_id)
+            if state is None:
+                state = self._chats[chat_id] = _ChatState()
+            state.jobs.append(job)
+            self._schedule_chat(chat_id, state, time.monotonic())
+            self._cond.notify_all() # Будим диспетчер (notify_all: на этом же условии ждет и поток resume)
+        return job.future
+
+    def _schedule_chat(self, chat_id, state: _ChatState, now: float):
+        """Ставит чат в очередь готовых или отложенных, если ему есть что отправлять. Вызывать под self._cond."""
+        if state.busy or state.scheduled or not state.jobs:
+            return
+        ready_at = max(state.blocked_until, now + state.bucket.delay(now))
+        if ready_at <= now:
+            heapq.heappush(self._ready, (state.jobs[0].priority, next(self._counter), chat_id))
+        else:
+            heapq.heappush(self._delayed, (ready_at, next(self._counter), chat_id))
+        state.scheduled = True
+
+    # --- Отправка ---
+
+    def _next_job(self):
+        """Ждет, пока какой-нибудь чат сможет отправить сообщение, и возвращает (chat_id, job)."""
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._delayed)
+                    state = self._chats[chat_id]
+                    heapq.heappush(self._ready, (state.jobs[0].priority, next(self._counter), chat_id))
+
+                if self._ready:
+                    global_delay = self._global.delay(now)
+                    if global_delay <= 0:
+                        break
+                    self._cond.wait(global_delay)
+                else:
+                    self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            state = self._chats[chat_id]
+            state.scheduled = False
+            state.busy = True
+            self._global.take(now)
+            state.bucket.take(now)
+            return chat_id, state.jobs.popleft()
+
+    def _dispatch_loop(self):
+        while True:
+            item = self._next_job()
+            if item is None:
+                return
+            self._executor.submit(self._execute, *item)
+
+    def _execute(self, chat_id, job: _Job):
+        job.attempts += 1
+        retry_after = None
+        metrics.observe('outbox_queue_wait_seconds', time.monotonic() - job.queued_at)
+        stage = 'telegram_edit' if job.method == 'edit_message_text' else 'telegram_send'
+        try:
+            with metrics.span(stage, chat_id=chat_id, attempt=job.attempts):
+                result = getattr(self._bot, job.method)(*job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            metrics.inc('telegram_requests_total', method=job.method, status=str(e.error_code))
+            if e.error_code == 429:
+                retry_after = float((e.result_json.get('parameters') or {}).get('retry_after', 1))
+                print(f"Telegram: слишком много запросов в чат {chat_id}, пауза {retry_after} с")
+            elif 'message is not modified' in (e.description or ''):
+                self._succeed(job, None) # Текст уже такой — считаем правку выполненной
+            elif e.error_code >= 500 and job.attempts < MAX_ATTEMPTS:
+                retry_after = RETRY_DELAY * job.attempts
+            else:
+                self._fail(job, e, retryable=e.error_code >= 500)
+        except Exception as e:
+            # Сетевые ошибки: таймауты, обрывы соединения
+            metrics.inc('telegram_requests_total', method=job.method, status='network_error')
+            if job.attempts < MAX_ATTEMPTS:
+                retry_after = RETRY_DELAY * job.attempts
+            else:
+                self._fail(job, e, retryable=True)
+        else:
+            metrics.inc('telegram_requests_total', method=job.method, status='ok')
+            self._succeed(job, result)
+
+        with self._cond:
+            state = self._chats[chat_id]
+            state.busy = False
+            now = time.monotonic()
+            if retry_after is not None:
+                # Повторяем это же сообщение первым, чтобы не нарушить порядок в чате
+                state.jobs.appendleft(job)
+                state.blocked_until = now + retry_after
+            if state.jobs:
+                self._schedule_chat(chat_id, state, now)
+            elif state.bucket.is_full(now):
+                del self._chats[chat_id]
+            self._cond.notify_all()
+
+    def _succeed(self, job: _Job, result):
+        if job.durable_id is not None:
+            self.storage.outbox_remove(job.durable_id)
+            with self._cond:
+                self._durable_ids.discard(job.durable_id)
+        job.future.set_result(result)
+
+    def _fail(self, job: _Job, error: Exception, retryable: bool):
+        if job.durable_id is not None:
+            if retryable:
+                # Оставляем в базе: resume() повторит отправку позже
+                delay = DURABLE_RETRY_DELAY * (job.attempts + 1)
+                self.storage.outbox_retry_later(job.durable_id, time.time() + delay)
+            else:
+                self.storage.outbox_remove(job.durable_id)
+            with self._cond:
+                self._durable_ids.discard(job.durable_id)
+        print(f"Не удалось выполнить {job.method}: {error}")
+        job.future.set_exception(error)
+
+    # --- Повтор сохраненных сообщений ---
+
+    def resume(self) -> int:
+        """Ставит в очередь сохраненные сообщения, которым пора уйти. Возвращает их количество."""
+        count = 0
+        for item in self.storage.outbox_pending(time.time()):
+            with self._cond:
+                if item['id'] in self._durable_ids:
+                    continue
+            if item['attempts'] >= DURABLE_MAX_ATTEMPTS:
+                print(f"Сообщение для {item['chat_id']} так и не удалось доставить, удаляем.")
+                self.storage.outbox_remove(item['id'])
+                continue
+            payload = item['payload']
+            job = _Job('send_message', (item['chat_id'], payload['text']), payload.get('kwargs', {}), BULK, item['id'])
+            job.attempts = item['attempts']
+            self._enqueue(item['chat_id'], job)
+            count += 1
+        return count
+
+    def _resume_loop(self):
+        while not (self._stopped or self._resume_stopped):
+            try:
+                resumed = self.resume()
+                if resumed:
+                    print(f"Повторная отправка сохраненных сообщений: {resumed}")
+            except Exception as e:
+                print(f"Ошибка при повторной отправке сохраненных сообщений: {e}")
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopped or self._resume_stopped, RESUME_INTERVAL)
+
+    # --- Запуск и остановка ---
+
+    def start(self, resume: bool = True):
+        """
+        Запускает отправку. resume=False — без повтора сохраненных сообщений из базы:
+        в cluster.py их досылает только один процесс, иначе они ушли бы по нескольку раз.
+        """
+        threading.Thread(target=self._dispatch_loop, name='outbox-dispatcher', daemon=True).start()
+        if resume:
+            self.start_resume()
+
+    def start_resume(self):
+        with self._cond:
+            self._resume_stopped = False
+        threading.Thread(target=self._resume_loop, name='outbox-resume', daemon=True).start()
+
+    def stop_resume(self):
+        """Прекращает повтор сохраненных сообщений (cluster.py: процесс потерял аренду, их досылает новый владелец)."""
+        with self._cond:
+            self._resume_stopped = True
+            self._cond.notify_all()
+
+    def set_global_rate(self, rate: float):
+        """Меняет общий лимит бота на ходу: cluster.py заново делит его между процессами при изменении их числа."""
+        with self._cond:
+            self._global.set_rate(rate * RATE_MARGIN, rate * RATE_MARGIN, time.monotonic())
+            self._cond.notify_all()
+
+    def pending(self) -> int:
+        """Количество сообщений в очереди (включая отправляемые сейчас)."""
+        with self._cond:
+            return sum(len(state.jobs) + state.busy for state in self._chats.values())
+
+    def join(self, timeout: float = None) -> bool:
+        """Ждет, пока очередь опустеет. Возвращает False, если не уложились в timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False)
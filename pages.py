@@ -0,0 +1,228 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from telebot import types
+
+import metrics
+from storage import get_storage, user_today
+
+# Постраничный вывод списка задач. Страница читается из хранилища по курсору (дата, id)
+# последней показанной задачи, поэтому её стоимость не зависит от числа задач пользователя.
+# Листание — кнопки под сообщением: нажатие приходит как callback query и обрабатывается
+# без обращения к модели. Готовые страницы кэшируются; ключ кэша включает версию задач
+# пользователя (storage.tasks_version), так что любое изменение его задач делает старые
+# страницы недостижимыми, не трогая страницы других пользователей.
+
+# Сколько задач показывать на одной странице
+PAGE_SIZE = int(os.getenv('TASKS_PAGE_SIZE', '10'))
+# Максимальная длина страницы: Telegram не принимает сообщения длиннее 4096 символов,
+# запас оставлен на заголовок и подпись. Не поместившиеся задачи переносятся на следующую страницу
+PAGE_CHAR_LIMIT = 3500
+# Длиннее этого текст отдельной задачи обрезается
+TASK_TEXT_LIMIT = 300
+# Сколько готовых страниц держать в памяти (0 — не кэшировать)
+PAGE_CACHE_SIZE = int(os.getenv('TASKS_PAGE_CACHE_SIZE', '1000'))
+
+# Данные кнопки: tp:<с какой даты>:<по какую дату>:<a|b><дата>.<id> — не длиннее 64 байт.
+# Пустая дата "с" означает "с сегодняшнего дня" (список всех актуальных задач), пустая "по" — без ограничения.
+CALLBACK_PREFIX = 'tp:'
+CALLBACK_RE = re.compile(r'tp:(\d{8})?:(\d{8})?:([ab])(\d{8})\.(\d+)')
+
+
+class Page(str):
+    """Текст страницы; reply_markup — кнопки листания (None, если страница одна)."""
+    reply_markup = None
+
+
+def _pack_date(value: str) -> str:
+    return value.replace('-', '') if value else ''
+
+
+def _unpack_date(value: str):
+    return f"{value[:4]}-{value[4:6]}-{value[6:]}" if value else None
+
+
+def _task_line(task: dict, indent: str = '') -> str:
+    text = task['text']
+    if len(text) > TASK_TEXT_LIMIT:
+        text = text[:TASK_TEXT_LIMIT - 1] + '…'
+    return f"{indent}{task['number']}. {text}"
+
+
+def _group_by_date(tasks: list) -> list:
+    groups = []
+    for task in tasks:
+        if not groups or groups[-1][0] != task['date']:
+            groups.append((task['date'], []))
+        groups[-1][1].append(task)
+    return groups
+
+
+def format_tasks(tasks: list, from_date: str, to_date: str, today: str) -> str:
+    """Текст страницы: одна дата, диапазон дат или все актуальные задачи (from_date=None)."""
+    if from_date and from_date == to_date:
+        return f"Задачи на {from_date}:\n" + "\n".join(_task_line(t) for t in tasks)
+
+    groups = [
+        f"{date}:\n" + "\n".join(_task_line(t, '  ') for t in group)
+        for date, group in _group_by_date(tasks)
+    ]
+    if from_date:
+        title = f"Задачи с {from_date} по {to_date}:" if to_date else f"Задачи с {from_date}:"
+        return title + "\n\n" + "\n\n".join(groups)
+
+    # Все актуальные задачи: сначала задачи на сегодня, затем остальные по датам
+    parts = []
+    if tasks[0]['date'] == today:
+        parts.append("--- Задачи на сегодня ---")
+        parts.append("\n".join(_task_line(t, '  ') for t in tasks if t['date'] == today))
+        groups = groups[1:]
+    if groups:
+        parts.append("--- Остальные задачи ---")
+        parts.append("\n\n".join(groups))
+    return "\n\n".join(parts)
+
+
+def empty_text(from_date: str, to_date: str) -> str:
+    if not from_date:
+        return "Список задач пуст."
+    if from_date == to_date:
+        return f"На {from_date} задач нет."
+    if to_date:
+        return f"С {from_date} по {to_date} задач нет."
+    return f"С {from_date} задач нет."
+
+
+def callback_data(from_date: str, to_date: str, direction: str, task: dict) -> str:
+    return (f"{CALLBACK_PREFIX}{_pack_date(from_date)}:{_pack_date(to_date)}:"
+            f"{direction}{_pack_date(task['date'])}.{task['id']}")
+
+
+class PageRenderer:
+    """Чтение и форматирование страниц списка задач с LRU-кэшем готовых страниц."""
+
+    def __init__(self, storage=None, page_size: int = PAGE_SIZE, cache_size: int = PAGE_CACHE_SIZE):
+        self._storage = storage
+        self.page_size = page_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # ключ -> Page; в начале — самые давние
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    @property
+    def storage(self):
+        return self._storage or get_storage()
+
+    def render(self, chat_id: int, from_date: str = None, to_date: str = None,
+               after: tuple = None, before: tuple = None) -> Page:
+        """
+        Страница задач пользователя: первая, следующая за курсором after=(дата, id)
+        или предыдущая перед курсором before. from_date=None — все задачи начиная с сегодняшнего дня.
+        """
+        if from_date and to_date and to_date < from_date:
+            from_date, to_date = to_date, from_date
+        today = user_today(chat_id, self.storage).strftime('%Y-%m-%d')
+        # Версию читаем до данных: если задачи изменятся во время чтения, страница
+        # сохранится под старой версией и больше не будет выдана
+        key = (chat_id, self.storage.tasks_version(chat_id), today, from_date, to_date, after, before)
+        with self._lock:
+            page = self._cache.get(key)
+            if page is not None:
+                self._cache.move_to_end(key)
+                self.stats['hits'] += 1
+        if page is not None:
+            metrics.inc('task_pages_total', result='hit')
+            return page
+        with self._lock:
+            self.stats['misses'] += 1
+        metrics.inc('task_pages_total', result='miss')
+
+        with metrics.span('storage', op='tasks_page'):
+            page = self._build(chat_id, from_date, to_date, after, before, today)
+        if self.cache_size:
+            with self._lock:
+                self._cache[key] = page
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return page
+
+    def _build(self, chat_id, from_date, to_date, after, before, today) -> Page:
+        storage = self.storage
+        start = from_date or today
+        tasks = storage.get_tasks_page(chat_id, start, to_date, after=after, before=before, limit=self.page_size)
+        if not tasks and (after or before):
+            # Курсор устарел (задачи удалены) — показываем начало списка
+            tasks = storage.get_tasks_page(chat_id, start, to_date, limit=self.page_size)
+        if not tasks:
+            return Page(empty_text(from_date, to_date))
+
+        # Не больше PAGE_CHAR_LIMIT символов: остальное уйдет на следующую страницу
+        while len(tasks) > 1 and len(format_tasks(tasks, from_date, to_date, today)) > PAGE_CHAR_LIMIT:
+            tasks = tasks[:-1]
+
+        first, last = tasks[0], tasks[-1]
+        has_prev = bool(storage.get_tasks_page(chat_id, start, to_date, before=(first['date'], first['id']), limit=1))
+        has_next = bool(storage.get_tasks_page(chat_id, start, to_date, after=(last['date'], last['id']), limit=1))
+        text = format_tasks(tasks, from_date, to_date, today)
+        if not (has_prev or has_next):
+            return Page(text)
+
+        page = Page(text + f"\n\nВсего задач: {storage.count_tasks(chat_id, start, to_date)}")
+        buttons = []
+        if has_prev:
+            buttons.append(types.InlineKeyboardButton(
+                "◀ Назад", callback_data=callback_data(from_date, to_date, 'b', first)))
+        if has_next:
+            buttons.append(types.InlineKeyboardButton(
+                "Вперед ▶", callback_data=callback_data(from_date, to_date, 'a', last)))
+        page.reply_markup = types.InlineKeyboardMarkup()
+        page.reply_markup.row(*buttons)
+        return page
+
+    def handle_callback(self, chat_id: int, data: str) -> Page:
+        """Страница по данным нажатой кнопки."""
+        match = CALLBACK_RE.fullmatch(data or '')
+        if not match:
+            return self.render(chat_id)
+        from_date, to_date, direction, date, task_id = match.groups()
+        cursor = (_unpack_date(date), int(task_id))
+        return self.render(
+            chat_id, _unpack_date(from_date), _unpack_date(to_date),
+            after=cursor if direction == 'a' else None,
+            before=cursor if direction == 'b' else None,
+        )
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats, size=len(self._cache))
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / total if total else 0.0
+        return stats
+
+
+def is_callback(data: str) -> bool:
+    """Относится ли нажатая кнопка к листанию задач."""
+    return bool(data) and data.startswith(CALLBACK_PREFIX)
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+def get_renderer() -> PageRenderer:
+    """Возвращает общий для процесса экземпляр (кэш страниц общий для всех потоков)."""
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                _renderer = PageRenderer()
+    return _renderer
+
+
+def render(chat_id: int, from_date: str = None, to_date: str = None, after: tuple = None, before: tuple = None) -> Page:
+    return get_renderer().render(chat_id, from_date, to_date, after, before)
+
+
+def handle_callback(chat_id: int, data: str) -> Page:
+    return get_renderer().handle_callback(chat_id, data)
@@ -0,0 +1,214 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from storage import get_storage, prune_cutoff, DEFAULT_TIMEZONE
+
+# Сводку, пропущенную во время простоя, отправляем, только если опоздали не больше чем на это время
+DIGEST_CATCHUP_WINDOW = int(os.getenv('DIGEST_CATCHUP_WINDOW', str(3 * 3600)))
+# Напоминания, пропущенные во время простоя, отправляем, только если опоздали не больше чем на это время
+CATCHUP_WINDOW = int(os.getenv('REMINDER_CATCHUP_WINDOW', str(12 * 3600)))
+# Повтор при ошибке отправки
+RETRY_DELAY = 60
+MAX_ATTEMPTS = 5
+
+DIGEST = 'digest'
+REMINDER = 'reminder'
+
+
+class Scheduler:
+    """
+    Планировщик уведомлений: утренняя сводка задач для каждого пользователя
+    (в его часовом поясе и в выбранное им время) и напоминания о задачах со временем.
+
+    События хранятся в куче по времени срабатывания, поток спит ровно до ближайшего
+    события, поэтому на каждом шаге не нужно перебирать всех пользователей и задачи.
+    Отправленные уведомления записываются в хранилище: после перезапуска пропущенные
+    события досылаются, а уже отправленные не дублируются.
+    """
+
+    def __init__(self, send, storage=None):
+        self._send = send  # send(chat_id, text) — отправка сообщения пользователю
+        self._storage = storage
+        self._heap = []  # (время срабатывания, порядковый номер, событие)
+        self._counter = itertools.count()
+        self._digest_versions = {}  # chat_id -> версия расписания сводки (старые события пропускаются)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    @property
+    def storage(self):
+        return self._storage or get_storage()
+
+    # --- Планирование событий ---
+
+    def _push(self, due: float, event: dict):
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._counter), event))
+            # Будим поток, если новое событие наступит раньше, чем он собирался проснуться
+            if self._heap[0][2] is event:
+                self._cond.notify()
+
+    def schedule_digest(self, user: dict, now: float = None):
+        """Планирует ближайшую утреннюю сводку пользователя (или отменяет, если сводка отключена)."""
+        chat_id = user['chat_id']
+        with self._cond:
+            version = self._digest_versions.get(chat_id, 0) + 1
+            self._digest_versions[chat_id] = version
+        if not user.get('notify_time'):
+            return
+
+        tz = pytz.timezone(user['timezone'])
+        now = now or time.time()
+        local_now = datetime.fromtimestamp(now, tz)
+        hour, minute = (int(part) for part in user['notify_time'].split(':'))
+
+        day = local_now.date()
+        due = tz.localize(datetime(day.year, day.month, day.day, hour, minute))
+        if due.timestamp() <= now:
+            # Время сегодняшней сводки прошло. Если она не отправлена (бот был выключен)
+            # и опоздание небольшое, событие в прошлом сработает сразу; иначе — ждем завтра.
+            missed = now - due.timestamp() <= DIGEST_CATCHUP_WINDOW
+            if not missed or self.storage.is_delivered(chat_id, DIGEST, day.isoformat()):
+                day += timedelta(days=1)
+                due = tz.localize(datetime(day.year, day.month, day.day, hour, minute))
+
+        self._push(due.timestamp(), {
+            'kind': DIGEST, 'chat_id': chat_id, 'date': day.isoformat(),
+            'version': version, 'attempt': 1,
+        })
+
+    def schedule_reminder(self, task: dict, timezone: str, now: float = None):
+        """Планирует напоминание о задаче в task['remind_at'] по часовому поясу пользователя."""
+        tz = pytz.timezone(timezone)
+        year, month, day = (int(part) for part in task['date'].split('-'))
+        hour, minute = (int(part) for part in task['remind_at'].split(':'))
+        due = tz.localize(datetime(year, month, day, hour, minute)).timestamp()
+        if due < (now or time.time()) - CATCHUP_WINDOW:
+            return # Слишком старое — не досылаем
+        self._push(due, {'kind': REMINDER, 'chat_id': task['chat_id'], 'task_id': task['id'], 'attempt': 1})
+
+    def user_changed(self, chat_id: int):
+        """Перепланирует сводку после регистрации пользователя или смены его настроек."""
+        user = self.storage.get_user(chat_id)
+        if user:
+            self.schedule_digest(user)
+
+    def task_added(self, task: dict):
+        """Планирует напоминание о только что добавленной задаче (если у неё есть время)."""
+        if not task.get('remind_at'):
+            return
+        user = self.storage.get_user(task['chat_id'])
+        self.schedule_reminder(task, user['timezone'] if user else DEFAULT_TIMEZONE)
+
+    # --- Срабатывание событий ---
+
+    def _fire(self, event: dict):
+        storage = self.storage
+        chat_id = event['chat_id']
+
+        if event['kind'] == DIGEST:
+            with self._cond:
+                current = self._digest_versions.get(chat_id)
+            if event['version'] != current:
+                return # Расписание изменилось, есть более новое событие
+            # Сообщение в очереди отправки и отметка о доставке сохраняются одной транзакцией:
+            # иначе сбой между ними приводил бы к повторной сводке или к отметке без сообщения
+            with storage.batch():
+                if not storage.is_delivered(chat_id, DIGEST, event['date']):
+                    tasks_today = storage.get_tasks(chat_id, event['date'])
+                    if tasks_today:
+                        message = "Доброе утро! ☀️ На сегодня у вас есть задачи:\n\n"
+                        for i, task in enumerate(tasks_today, 1):
+                            message += f"{i}. {task}\n"
+                        self._send(chat_id, message)
+                        print(f"Уведомление о задачах на {event['date']} отправлено пользователю {chat_id}.")
+                    storage.mark_delivered(chat_id, DIGEST, event['date'])
+            user = storage.get_user(chat_id)
+            if user:
+                self.schedule_digest(user)
+
+        elif event['kind'] == REMINDER:
+            key = str(event['task_id'])
+            with storage.batch():
+                task = storage.get_task(event['task_id'])
+                if task is None or storage.is_delivered(chat_id, REMINDER, key):
+                    return # Задачу удалили или напоминание уже отправлено
+                self._send(chat_id, f"⏰ Напоминание: {task['text']}")
+                storage.mark_delivered(chat_id, REMINDER, key)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                _, _, event = heapq.heappop(self._heap)
+
+            try:
+                self._fire(event)
+            except Exception as e:
+                print(f"Ошибка при отправке уведомления пользователю {event['chat_id']}: {e}")
+                if event['attempt'] < MAX_ATTEMPTS:
+                    self._push(time.time() + RETRY_DELAY * event['attempt'], dict(event, attempt=event['attempt'] + 1))
+                elif event['kind'] == DIGEST:
+                    # Сегодня отправить не удалось — пропускаем эту сводку и ждем следующую
+                    self.storage.mark_delivered(event['chat_id'], DIGEST, event['date'])
+                    self.user_changed(event['chat_id'])
+
+    # --- Запуск и остановка ---
+
+    def start(self):
+        """Загружает расписание из хранилища и запускает поток планировщика."""
+        storage = self.storage
+        users = {user['chat_id']: user for user in storage.get_users()}
+        for user in users.values():
+            self.schedule_digest(user)
+
+        # Напоминания на даты, которые еще не прошли хотя бы в одном часовом поясе
+        for task in storage.get_reminders(prune_cutoff()):
+            user = users.get(task['chat_id'])
+            if user is None:
+                continue
+            if not storage.is_delivered(task['chat_id'], REMINDER, str(task['id'])):
+                self.schedule_reminder(task, user['timezone'])
+
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+        print(f"Планировщик запущен: пользователей {len(users)}, событий в очереди {len(self._heap)}.")
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+
+# --- Общий планировщик процесса ---
+
+_scheduler = None
+
+def start_scheduler(send, storage=None) -> Scheduler:
+    """Создает и запускает планировщик процесса."""
+    global _scheduler
+    _scheduler = Scheduler(send, storage)
+    _scheduler.start()
+    return _scheduler
+
+def set_scheduler(instance):
+    """Подменяет планировщик процесса (cluster.py пересылает события в процесс с настоящим планировщиком)."""
+    global _scheduler
+    _scheduler = instance
+
+def get_scheduler():
+    """Возвращает запущенный планировщик или None (например, в служебных скриптах)."""
+    return _scheduler
@@ -0,0 +1,228 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from storage import DB_FILE
+
+# Сессия (состояние диалога и последние сообщения) живет столько секунд после последнего обращения
+SESSION_TTL = int(os.getenv('SESSION_TTL', '1800'))
+# Максимальное число хранимых сессий: при переполнении вытесняются самые давние
+SESSION_MAX_SIZE = int(os.getenv('SESSION_MAX_SIZE', '10000'))
+# Сколько последних сообщений (пользователя и бота) передавать модели как контекст
+HISTORY_SIZE = int(os.getenv('SESSION_HISTORY_SIZE', '6'))
+# Длинные сообщения в истории обрезаются (например, полный список задач)
+HISTORY_MESSAGE_LIMIT = 500
+
+
+class _KeyLocks:
+    """Отдельная блокировка на каждый ключ. Блокировки, которые никто не держит, удаляются."""
+
+    def __init__(self):
+        self._locks = {}  # ключ -> [блокировка, сколько потоков её держат или ждут]
+        self._mutex = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        with self._mutex:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._mutex:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+class SessionStore:
+    """
+    Интерфейс хранилища сессий диалога.
+    Сессия — словарь с данными одного чата (ожидаемое подтверждение, история сообщений).
+    Неиспользуемые сессии удаляются через ttl секунд, а общее число сессий ограничено max_size.
+    """
+
+    def __init__(self, ttl: int = SESSION_TTL, max_size: int = SESSION_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._key_locks = _KeyLocks()
+
+    def get(self, chat_id: int):
+        """Возвращает сессию чата или None, если её нет или она устарела."""
+        raise NotImplementedError
+
+    def set(self, chat_id: int, session: dict) -> None:
+        """Сохраняет сессию и продлевает её срок жизни."""
+        raise NotImplementedError
+
+    def delete(self, chat_id: int) -> None:
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def open(self, chat_id: int):
+        """
+        Открывает сессию чата для изменения: пока блок выполняется, другие потоки
+        не могут открыть сессию этого же чата. Изменения сохраняются при выходе из блока
+        (пустая сессия удаляется), а при исключении отбрасываются.
+        """
+        with self._key_locks.hold(chat_id):
+            session = self.get(chat_id) or {}
+            yield session
+            if session:
+                self.set(chat_id, session)
+            else:
+                self.delete(chat_id)
+
+
+class MemorySessionStore(SessionStore):
+    """Сессии в памяти процесса (LRU с ограничением по времени жизни). Теряются при перезапуске."""
+
+    def __init__(self, ttl: int = SESSION_TTL, max_size: int = SESSION_MAX_SIZE):
+        super().__init__(ttl, max_size)
+        self._data = OrderedDict()  # chat_id -> (истекает в, сессия); в начале — самые давние
+        self._lock = threading.Lock()
+
+    def get(self, chat_id):
+        with self._lock:
+            item = self._data.get(chat_id)
+            if item is None:
+                return None
+            if item[0] <= time.time():
+                del self._data[chat_id]
+                return None
+            return json.loads(item[1])
+
+    def set(self, chat_id, session):
+        # Храним копию в JSON: так поведение совпадает с постоянным хранилищем
+        data = json.dumps(session, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._data[chat_id] = (now + self.ttl, data)
+            self._data.move_to_end(chat_id)
+            # Сначала выбрасываем устаревшие сессии, затем самые давние, если их все еще слишком много
+            while self._data:
+                oldest_id, (expires_at, _) = next(iter(self._data.items()))
+                if expires_at > now and len(self._data) <= self.max_size:
+                    break
+                del self._data[oldest_id]
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._data.pop(chat_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Сессии в SQLite (по умолчанию в той же базе, что и задачи): переживают перезапуск бота,
+    так что ответ "да" на вопрос, заданный до обновления, по-прежнему будет понят.
+    Устаревшие и лишние сессии удаляются раз в CLEANUP_EVERY записей.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            chat_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at);
+    """
+    CLEANUP_EVERY = 100
+
+    def __init__(self, path: str = DB_FILE, ttl: int = SESSION_TTL, max_size: int = SESSION_MAX_SIZE):
+        super().__init__(ttl, max_size)
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._connect().executescript(self.SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Возвращает соединение текущего потока (sqlite3 не разрешает делить их между потоками)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, chat_id):
+        row = self._connect().execute(
+            'SELECT data FROM sessions WHERE chat_id = ? AND expires_at > ?', (chat_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, chat_id, session):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO sessions (chat_id, data, expires_at) VALUES (?, ?, ?)',
+            (chat_id, json.dumps(session, ensure_ascii=False), time.time() + self.ttl)
+        )
+        self._writes += 1
+        if self._writes % self.CLEANUP_EVERY == 0:
+            self.cleanup()
+
+    def delete(self, chat_id):
+        self._connect().execute('DELETE FROM sessions WHERE chat_id = ?', (chat_id,))
+
+    def cleanup(self) -> int:
+        """Удаляет устаревшие сессии и самые давние сверх max_size. Возвращает количество удаленных."""
+        conn = self._connect()
+        removed = conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (time.time(),)).rowcount
+        removed += conn.execute(
+            'DELETE FROM sessions WHERE chat_id IN ('
+            ' SELECT chat_id FROM sessions ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_size,)
+        ).rowcount
+        return removed
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM sessions WHERE expires_at > ?', (time.time(),)
+        ).fetchone()[0]
+
+
+# --- История сообщений ---
+
+def add_to_history(session: dict, role: str, content: str):
+    """Добавляет сообщение ("user" или "assistant") в историю сессии, оставляя HISTORY_SIZE последних."""
+    if len(content) > HISTORY_MESSAGE_LIMIT:
+        content = content[:HISTORY_MESSAGE_LIMIT] + '…'
+    history = session.setdefault('history', [])
+    history.append({'role': role, 'content': content})
+    del history[:-HISTORY_SIZE]
+
+
+# --- Выбор реализации ---
+
+BACKENDS = {
+    'memory': MemorySessionStore,
+    'sqlite': SQLiteSessionStore,
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_session_store() -> SessionStore:
+    """Возвращает общее для процесса хранилище сессий (тип задается переменной SESSION_STORAGE)."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                backend = os.getenv('SESSION_STORAGE', 'sqlite')
+                if backend not in BACKENDS:
+                    raise ValueError(f"Неизвестный тип хранилища сессий: {backend}")
+                _store = BACKENDS[backend]()
+    return _store
@@ -0,0 +1,517 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+
+import pytz
+
+# Файл базы данных с задачами (можно переопределить через .env)
+DB_FILE = os.getenv('TASKS_DB', 'tasks.db')
+# Интервал фоновой очистки устаревших задач, в секундах
+PRUNE_INTERVAL = int(os.getenv('TASKS_PRUNE_INTERVAL', '3600'))
+# Сколько дней хранить журнал отправленных уведомлений
+DELIVERY_RETENTION_DAYS = 7
+
+# Настройки уведомлений нового пользователя
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'Europe/Moscow')
+DEFAULT_NOTIFY_TIME = os.getenv('DEFAULT_NOTIFY_TIME', '05:00')
+# Самый западный часовой пояс (UTC-12): там "сегодня" наступает позже всех
+EARLIEST_TIMEZONE = 'Etc/GMT+12'
+
+
+class TaskStorage:
+    """
+    Интерфейс хранилища задач.
+    Задачи хранятся отдельно для каждого пользователя (chat_id) и группируются по дате (ГГГГ-ММ-ДД).
+    Номер задачи — её позиция (1-based) в списке на дату в порядке добавления.
+    """
+
+    def add_task(self, chat_id: int, date: str, text: str, remind_at: str = None) -> int:
+        """Добавляет задачу (remind_at — необязательное время напоминания ЧЧ:ММ). Возвращает id задачи."""
+        raise NotImplementedError
+
+    def get_task(self, task_id: int):
+        """Возвращает задачу по id в виде словаря или None, если её уже нет."""
+        raise NotImplementedError
+
+    def get_tasks(self, chat_id: int, date: str) -> list:
+        """Возвращает список текстов задач пользователя на дату."""
+        raise NotImplementedError
+
+    def get_all_tasks(self, chat_id: int, from_date: str = None) -> dict:
+        """Возвращает {дата: [задачи]} пользователя, начиная с from_date (включительно)."""
+        raise NotImplementedError
+
+    def get_tasks_page(self, chat_id: int, from_date: str, to_date: str = None,
+                       after: tuple = None, before: tuple = None, limit: int = 10) -> list:
+        """
+        Часть задач в диапазоне дат (to_date=None — без верхней границы) в порядке (дата, id):
+        первые limit задач после курсора after=(дата, id) или последние limit перед курсором before.
+        Задачи — словари как в get_task, плюс number — номер задачи в списке на её дату.
+        """
+        raise NotImplementedError
+
+    def count_tasks(self, chat_id: int, from_date: str, to_date: str = None) -> int:
+        """Количество задач пользователя в диапазоне дат."""
+        raise NotImplementedError
+
+    def tasks_version(self, chat_id: int):
+        """Значение, которое меняется при каждом изменении задач пользователя (для кэшей)."""
+        raise NotImplementedError
+
+    def delete_task(self, chat_id: int, date: str, task_number: int):
+        """Удаляет задачу по номеру. Возвращает текст удаленной задачи или None."""
+        raise NotImplementedError
+
+    def delete_date(self, chat_id: int, date: str) -> int:
+        """Удаляет все задачи пользователя на дату. Возвращает количество удаленных."""
+        raise NotImplementedError
+
+    def delete_all(self, chat_id: int) -> int:
+        """Удаляет все задачи пользователя. Возвращает количество удаленных."""
+        raise NotImplementedError
+
+    def prune_expired(self, before_date: str) -> int:
+        """Удаляет задачи всех пользователей с датой раньше before_date."""
+        raise NotImplementedError
+
+    def import_tasks(self, chat_id: int, tasks: dict) -> int:
+        """Массово добавляет задачи формата {дата: [задачи]}. Возвращает количество добавленных."""
+        raise NotImplementedError
+
+    def get_reminders(self, from_date: str) -> list:
+        """Возвращает задачи с временем напоминания, начиная с from_date (словари как в get_task)."""
+        raise NotImplementedError
+
+    # --- Пользователи и настройки уведомлений ---
+
+    def ensure_user(self, chat_id: int) -> bool:
+        """Регистрирует пользователя с настройками по умолчанию. Возвращает True, если он новый."""
+        raise NotImplementedError
+
+    def get_user(self, chat_id: int):
+        """Возвращает настройки пользователя {'chat_id', 'timezone', 'notify_time'} или None."""
+        raise NotImplementedError
+
+    def get_users(self) -> list:
+        """Возвращает настройки всех пользователей."""
+        raise NotImplementedError
+
+    def update_user(self, chat_id: int, **settings) -> None:
+        """Меняет настройки пользователя (timezone, notify_time; notify_time=None отключает сводку)."""
+        raise NotImplementedError
+
+    # --- Журнал отправленных уведомлений ---
+
+    def is_delivered(self, chat_id: int, kind: str, key: str) -> bool:
+        raise NotImplementedError
+
+    def mark_delivered(self, chat_id: int, kind: str, key: str) -> None:
+        raise NotImplementedError
+
+    # --- Очередь исходящих сообщений (см. outbox.py) ---
+
+    def outbox_add(self, chat_id: int, payload: dict) -> int:
+        """Сохраняет сообщение, которое нужно доставить. Возвращает его id."""
+        raise NotImplementedError
+
+    def outbox_pending(self, now: float, limit: int = 1000) -> list:
+        """Возвращает сообщения, которые пора (пере)отправить: [{'id', 'chat_id', 'payload', 'attempts'}]."""
+        raise NotImplementedError
+
+    def outbox_retry_later(self, message_id: int, next_attempt_at: float) -> None:
+        """Откладывает повторную отправку сообщения и увеличивает счетчик попыток."""
+        raise NotImplementedError
+
+    def outbox_remove(self, message_id: int) -> None:
+        """Удаляет доставленное (или безнадежное) сообщение."""
+        raise NotImplementedError
+
+    # --- Пакетные операции ---
+
+    def batch(self):
+        """
+        Контекстный менеджер: все операции внутри блока (в этом потоке) выполняются
+        одной транзакцией — либо применяются все, либо ни одна.
+        """
+        return contextlib.nullcontext()
+
+    def after_commit(self, callback) -> None:
+        """Вызывает callback после фиксации текущего пакета (или сразу, если пакета нет)."""
+        callback()
+
+
+class SQLiteTaskStorage(TaskStorage):
+    """
+    Хранилище задач на SQLite в режиме WAL.
+    Каждая операция — одна короткая транзакция над индексом (chat_id, date),
+    поэтому стоимость не зависит от общего числа задач, а параллельные потоки
+    бота не затирают изменения друг друга.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            text TEXT NOT NULL,
+            remind_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_tasks_chat_date ON tasks (chat_id, date, id);
+        CREATE INDEX IF NOT EXISTS idx_tasks_date ON tasks (date);
+
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id INTEGER PRIMARY KEY,
+            timezone TEXT NOT NULL,
+            notify_time TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS deliveries (
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            delivered_at TEXT NOT NULL DEFAULT (datetime('now')),
+            PRIMARY KEY (chat_id, kind, key)
+        );
+
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_next ON outbox (next_attempt_at);
+    """
+
+    def __init__(self, path: str = DB_FILE):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        # Базы, созданные до появления напоминаний, не знают о колонке remind_at
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(tasks)')]
+        if columns and 'remind_at' not in columns:
+            conn.execute('ALTER TABLE tasks ADD COLUMN remind_at TEXT')
+        conn.executescript(self.SCHEMA)
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_tasks_reminders ON tasks (date) WHERE remind_at IS NOT NULL'
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Возвращает соединение текущего потока (sqlite3 не разрешает делить их между потоками)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._connect(), self._local)
+
+    def batch(self):
+        return self._transaction()
+
+    def after_commit(self, callback):
+        if self._connect().in_transaction:
+            self._local.after_commit = getattr(self._local, 'after_commit', []) + [callback]
+        else:
+            callback()
+
+    def add_task(self, chat_id, date, text, remind_at=None):
+        cursor = self._connect().execute(
+            'INSERT INTO tasks (chat_id, date, text, remind_at) VALUES (?, ?, ?, ?)',
+            (chat_id, date, text, remind_at),
+        )
+        return cursor.lastrowid
+
+    def get_task(self, task_id):
+        row = self._connect().execute(
+            'SELECT id, chat_id, date, text, remind_at FROM tasks WHERE id = ?', (task_id,)
+        ).fetchone()
+        return self._task_from_row(row) if row else None
+
+    @staticmethod
+    def _task_from_row(row) -> dict:
+        return {'id': row[0], 'chat_id': row[1], 'date': row[2], 'text': row[3], 'remind_at': row[4]}
+
+    def get_tasks(self, chat_id, date):
+        rows = self._connect().execute(
+            'SELECT text FROM tasks WHERE chat_id = ? AND date = ? ORDER BY id', (chat_id, date)
+        )
+        return [row[0] for row in rows]
+
+    def get_all_tasks(self, chat_id, from_date=None):
+        rows = self._connect().execute(
+            'SELECT date, text FROM tasks WHERE chat_id = ? AND date >= ? ORDER BY date, id',
+            (chat_id, from_date or ''),
+        )
+        tasks = {}
+        for date, text in rows:
+            tasks.setdefault(date, []).append(text)
+        return tasks
+
+    def get_tasks_page(self, chat_id, from_date, to_date=None, after=None, before=None, limit=10):
+        # Курсор сравнивается как пара (date, id) — это диапазон по индексу (chat_id, date, id)
+        if before is not None:
+            condition, params, order = '(date, id) < (?, ?)', tuple(before), 'DESC'
+        else:
+            condition, params, order = '(date, id) > (?, ?)', tuple(after or ('', 0)), 'ASC'
+        rows = self._connect().execute(
+            'SELECT id, chat_id, date, text, remind_at, ('
+            ' SELECT COUNT(*) FROM tasks p WHERE p.chat_id = t.chat_id AND p.date = t.date AND p.id <= t.id'
+            f') FROM tasks t WHERE chat_id = ? AND date >= ? AND date <= ? AND {condition} '
+            f'ORDER BY date {order}, id {order} LIMIT ?',
+            (chat_id, from_date, to_date or '9999-12-31') + params + (limit,),
+        ).fetchall()
+        if before is not None:
+            rows.reverse()
+        return [dict(self._task_from_row(row), number=row[5]) for row in rows]
+
+    def tasks_version(self, chat_id):
+        # id не переиспользуются (AUTOINCREMENT): добавление увеличивает MAX(id), а изменение
+        # без добавлений уменьшает COUNT(*). Версия берется из базы, поэтому верна и тогда,
+        # когда задачи чата меняет другой процесс (cluster.py, несколько экземпляров webhook)
+        return self._connect().execute(
+            'SELECT COUNT(*), MAX(id) FROM tasks WHERE chat_id = ?', (chat_id,)
+        ).fetchone()
+
+    def count_tasks(self, chat_id, from_date, to_date=None):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM tasks WHERE chat_id = ? AND date >= ? AND date <= ?',
+            (chat_id, from_date, to_date or '9999-12-31'),
+        ).fetchone()[0]
+
+    def delete_task(self, chat_id, date, task_number):
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT id, text FROM tasks WHERE chat_id = ? AND date = ? ORDER BY id LIMIT 1 OFFSET ?',
+                (chat_id, date, task_number - 1),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute('DELETE FROM tasks WHERE id = ?', (row[0],))
+            return row[1]
+
+    def delete_date(self, chat_id, date):
+        cursor = self._connect().execute(
+            'DELETE FROM tasks WHERE chat_id = ? AND date = ?', (chat_id, date)
+        )
+        return cursor.rowcount
+
+    def delete_all(self, chat_id):
+        cursor = self._connect().execute('DELETE FROM tasks WHERE chat_id = ?', (chat_id,))
+        return cursor.rowcount
+
+    def prune_expired(self, before_date):
+        conn = self._connect()
+        cursor = conn.execute('DELETE FROM tasks WHERE date < ?', (before_date,))
+        conn.execute(
+            "DELETE FROM deliveries WHERE delivered_at < datetime('now', ?)",
+            (f'-{DELIVERY_RETENTION_DAYS} days',),
+        )
+        return cursor.rowcount
+
+    def import_tasks(self, chat_id, tasks):
+        rows = [
+            (chat_id, date, text)
+            for date, task_list in sorted(tasks.items())
+            for text in task_list
+        ]
+        with self._transaction() as conn:
+            conn.executemany('INSERT INTO tasks (chat_id, date, text) VALUES (?, ?, ?)', rows)
+        return len(rows)
+
+    def get_reminders(self, from_date):
+        rows = self._connect().execute(
+            'SELECT id, chat_id, date, text, remind_at FROM tasks WHERE remind_at IS NOT NULL AND date >= ?',
+            (from_date,),
+        )
+        return [self._task_from_row(row) for row in rows]
+
+    def ensure_user(self, chat_id):
+        cursor = self._connect().execute(
+            'INSERT OR IGNORE INTO users (chat_id, timezone, notify_time) VALUES (?, ?, ?)',
+            (chat_id, DEFAULT_TIMEZONE, DEFAULT_NOTIFY_TIME),
+        )
+        return cursor.rowcount > 0
+
+    def get_user(self, chat_id):
+        row = self._connect().execute(
+            'SELECT chat_id, timezone, notify_time FROM users WHERE chat_id = ?', (chat_id,)
+        ).fetchone()
+        return {'chat_id': row[0], 'timezone': row[1], 'notify_time': row[2]} if row else None
+
+    def get_users(self):
+        rows = self._connect().execute('SELECT chat_id, timezone, notify_time FROM users')
+        return [{'chat_id': row[0], 'timezone': row[1], 'notify_time': row[2]} for row in rows]
+
+    def update_user(self, chat_id, **settings):
+        allowed = {'timezone', 'notify_time'}
+        if not settings or not set(settings) <= allowed:
+            raise ValueError(f"Недопустимые настройки пользователя: {settings}")
+        self.ensure_user(chat_id)
+        assignments = ', '.join(f'{name} = ?' for name in settings)
+        self._connect().execute(
+            f'UPDATE users SET {assignments} WHERE chat_id = ?', (*settings.values(), chat_id)
+        )
+
+    def is_delivered(self, chat_id, kind, key):
+        row = self._connect().execute(
+            'SELECT 1 FROM deliveries WHERE chat_id = ? AND kind = ? AND key = ?', (chat_id, kind, key)
+        ).fetchone()
+        return row is not None
+
+    def mark_delivered(self, chat_id, kind, key):
+        self._connect().execute(
+            'INSERT OR IGNORE INTO deliveries (chat_id, kind, key) VALUES (?, ?, ?)', (chat_id, kind, key)
+        )
+
+    def outbox_add(self, chat_id, payload):
+        cursor = self._connect().execute(
+            'INSERT INTO outbox (chat_id, payload) VALUES (?, ?)',
+            (chat_id, json.dumps(payload, ensure_ascii=False)),
+        )
+        return cursor.lastrowid
+
+    def outbox_pending(self, now, limit=1000):
+        rows = self._connect().execute(
+            'SELECT id, chat_id, payload, attempts FROM outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT ?',
+            (now, limit),
+        )
+        return [
+            {'id': row[0], 'chat_id': row[1], 'payload': json.loads(row[2]), 'attempts': row[3]}
+            for row in rows
+        ]
+
+    def outbox_retry_later(self, message_id, next_attempt_at):
+        self._connect().execute(
+            'UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?',
+            (next_attempt_at, message_id),
+        )
+
+    def outbox_remove(self, message_id):
+        self._connect().execute('DELETE FROM outbox WHERE id = ?', (message_id,))
+
+
+class _Transaction:
+    """
+    Контекстный менеджер явной транзакции (BEGIN IMMEDIATE ... COMMIT/ROLLBACK).
+    Внутри уже открытой транзакции (batch) не открывает новую, а становится её частью.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, local=None):
+        self.conn = conn
+        self.local = local  # threading.local хранилища: там копятся функции after_commit
+
+    def __enter__(self):
+        self.nested = self.conn.in_transaction
+        if not self.nested:
+            self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.nested:
+            return False
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        callbacks = getattr(self.local, 'after_commit', None)
+        if callbacks:
+            self.local.after_commit = []
+            if not exc_type:
+                for callback in callbacks:
+                    callback()
+        return False
+
+
+# --- Выбор реализации ---
+
+BACKENDS = {
+    'sqlite': SQLiteTaskStorage,
+}
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage() -> TaskStorage:
+    """Возвращает общее для процесса хранилище (тип задается переменной TASKS_STORAGE)."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                backend = os.getenv('TASKS_STORAGE', 'sqlite')
+                if backend not in BACKENDS:
+                    raise ValueError(f"Неизвестный тип хранилища задач: {backend}")
+                _storage = BACKENDS[backend]()
+    return _storage
+
+
+# --- Дата пользователя ---
+
+def user_today(chat_id: int, storage: TaskStorage = None) -> date:
+    """Сегодняшняя дата в часовом поясе пользователя (DEFAULT_TIMEZONE, если он еще не зарегистрирован)."""
+    user = (storage or get_storage()).get_user(chat_id)
+    return datetime.now(pytz.timezone(user['timezone'] if user else DEFAULT_TIMEZONE)).date()
+
+
+# --- Фоновая очистка ---
+
+def prune_cutoff() -> str:
+    """
+    Дата, раньше которой задачи считаются устаревшими.
+    Берем день перед сегодняшним в самом западном часовом поясе: там "сегодня"
+    наступает последним, поэтому ни у одного пользователя не удалятся актуальные задачи.
+    """
+    return (datetime.now(pytz.timezone(EARLIEST_TIMEZONE)) - timedelta(days=1)).strftime('%Y-%m-%d')
+
+def start_pruner(storage: TaskStorage = None, interval: int = PRUNE_INTERVAL) -> threading.Thread:
+    """Запускает фоновый поток, периодически удаляющий устаревшие задачи."""
+    def run():
+        while not stop.is_set():
+            try:
+                removed = (storage or get_storage()).prune_expired(prune_cutoff())
+                if removed:
+                    print(f"Удалено устаревших задач: {removed}")
+            except Exception as e:
+                print(f"Ошибка при очистке устаревших задач: {e}")
+            stop.wait(interval)
+
+    stop = threading.Event()
+    thread = threading.Thread(target=run, name='tasks-pruner', daemon=True)
+    thread.stop_event = stop
+    thread.start()
+    return thread
+
+
+# --- Миграция со старого формата tasks.json ---
+
+def migrate_json(json_path: str, chat_id: int, storage: TaskStorage = None) -> int:
+    """
+    Однократно переносит задачи из tasks.json ({дата: [задачи]}) в хранилище.
+    Старый формат не знал о пользователях, поэтому все задачи получает chat_id.
+    После успешного переноса файл переименовывается в *.migrated, чтобы не импортировать его повторно.
+    """
+    if not os.path.exists(json_path):
+        return 0
+    try:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            tasks = json.load(f)
+    except json.JSONDecodeError as e:
+        print(f"Не удалось прочитать {json_path} для миграции: {e}")
+        return 0
+
+    count = (storage or get_storage()).import_tasks(int(chat_id), tasks)
+    os.replace(json_path, json_path + '.migrated')
+    print(f"Перенесено задач из {json_path}: {count}")
+    return count
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 4 or sys.argv[1] != 'migrate':
+        print("Использование: python storage.py migrate <tasks.json> <chat_id>")
+        sys.exit(1)
+    migrate_json(sys.argv[2], int(sys.argv[3]))
@@ -0,0 +1,117 @@
+import os
+import time
+
+from outbox import CHAT_RATE, RATE_MARGIN
+
+# Не чаще одного редактирования сообщения за EDIT_INTERVAL секунд
+# (Telegram ограничивает частоту сообщений и правок в одном чате)
+EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+# Правки уходят через outbox, а он пропускает в один чат не больше CHAT_RATE * RATE_MARGIN
+# запросов в секунду: более частые правки только копились бы в его очереди, а окончательный
+# ответ ждал бы за ними. Поэтому интервал не бывает меньше этого
+MIN_EDIT_INTERVAL = 1 / (CHAT_RATE * RATE_MARGIN)
+# Минимальный прирост текста (в символах), ради которого стоит редактировать сообщение
+EDIT_MIN_CHARS = int(os.getenv('STREAM_EDIT_MIN_CHARS', '20'))
+# Максимальная длина текста сообщения в Telegram
+MESSAGE_LIMIT = 4096
+CURSOR = " ▌"
+
+
+class StreamingReply:
+    """
+    Показывает ответ модели по мере генерации, редактируя сообщение "Думаю...".
+    Правки объединяются: новый текст выводится не чаще раза в EDIT_INTERVAL секунд
+    (но не чаще, чем outbox отправляет в чат, см. MIN_EDIT_INTERVAL)
+    и только если прибавилось хотя бы EDIT_MIN_CHARS символов.
+    Если ответ начинается с "{" или "```", это вызов инструмента — такой текст
+    пользователю не показывается, пока ai_core не превратит его в обычный ответ.
+    """
+
+    def __init__(self, edit, interval: float = EDIT_INTERVAL, min_chars: int = EDIT_MIN_CHARS):
+        self._edit = edit  # edit(text, reply_markup=None) — отредактировать сообщение-заглушку
+        self.interval = max(interval, MIN_EDIT_INTERVAL)
+        self.min_chars = min_chars
+        self.shown = None  # Текст, который сейчас виден пользователю
+        self.suppressed = False
+        self._last_edit = time.monotonic()  # Заглушку только что отправили
+
+    def _next_render(self, text: str):
+        """Решает, нужно ли показать частичный текст сейчас. Возвращает текст для показа или None."""
+        if self.suppressed:
+            return None
+        stripped = text.lstrip()
+        if not stripped:
+            return None
+        if stripped.startswith('{') or stripped.startswith('```'):
+            self.suppressed = True
+            return None
+        if '```'.startswith(stripped):
+            return None  # Пришла только часть "```" — пока неясно, вызов ли это инструмента
+        if time.monotonic() - self._last_edit < self.interval:
+            return None
+        if self.shown is not None and len(text) - len(self.shown) + len(CURSOR) < self.min_chars:
+            return None
+        return text[:MESSAGE_LIMIT - len(CURSOR)] + CURSOR
+
+    def _mark_shown(self, text: str):
+        self.shown = text
+        self._last_edit = time.monotonic()
+
+    def update(self, text: str):
+        """Получает накопленный на данный момент текст ответа модели."""
+        render = self._next_render(text)
+        if render is None:
+            return
+        try:
+            self._edit(render)
+            self._mark_shown(render)
+        except Exception as e:
+            # Промежуточная правка не удалась (например, 429) — попробуем в следующий раз
+            print(f"Не удалось обновить сообщение при потоковом ответе: {e}")
+            self._last_edit = time.monotonic()
+
+    def finish(self, text: str):
+        """
+        Показывает окончательный ответ (если он отличается от уже показанного).
+        Кнопки ответа (атрибут reply_markup, как у pages.Page) прикрепляются к сообщению.
+        """
+        reply_markup = getattr(text, 'reply_markup', None)
+        if text != self.shown or reply_markup:
+            self._edit(text, reply_markup)
+            self._mark_shown(text)
+
+    def fail(self, text: str):
+        """Заменяет частично показанный ответ сообщением об ошибке (в том же сообщении, не новым)."""
+        try:
+            self._edit(text)
+            self._mark_shown(text)
+        except Exception as e:
+            print(f"Не удалось показать сообщение об ошибке: {e}")
+
+
+class AsyncStreamingReply(StreamingReply):
+    """Вариант StreamingReply для асинхронного режима: edit — корутина."""
+
+    async def update(self, text: str):
+        render = self._next_render(text)
+        if render is None:
+            return
+        try:
+            await self._edit(render)
+            self._mark_shown(render)
+        except Exception as e:
+            print(f"Не удалось обновить сообщение при потоковом ответе: {e}")
+            self._last_edit = time.monotonic()
+
+    async def finish(self, text: str):
+        reply_markup = getattr(text, 'reply_markup', None)
+        if text != self.shown or reply_markup:
+            await self._edit(text, reply_markup)
+            self._mark_shown(text)
+
+    async def fail(self, text: str):
+        try:
+            await self._edit(text)
+            self._mark_shown(text)
+        except Exception as e:
+            print(f"Не удалось показать сообщение об ошибке: {e}")
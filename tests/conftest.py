@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Модули бота читают настройки при импорте, поэтому окружение задаем до их импорта
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:test')
+os.environ.setdefault('OPENROUTER_API_KEY', 'test')
+os.environ['TASKS_DB'] = os.path.join(tempfile.mkdtemp(prefix='todo-tests-'), 'tasks.db')
+os.environ['SESSION_STORAGE'] = 'memory'
+
+
+@pytest.fixture(autouse=True)
+def project_dir(monkeypatch):
+    """ai_core.load_prompt читает ai_prompt.txt из текущего каталога."""
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.fixture
+def bot_state(tmp_path, monkeypatch):
+    """Чистые хранилище задач, сессии и кэш ответов модели для каждого теста."""
+    import llm_cache
+    import sessions
+    import storage
+
+    monkeypatch.setattr(storage, '_storage', storage.SQLiteTaskStorage(str(tmp_path / 'tasks.db')))
+    monkeypatch.setattr(sessions, '_store', sessions.MemorySessionStore())
+    monkeypatch.setattr(llm_cache, '_cache', llm_cache.LLMCache())
+    return storage.get_storage()
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import ai_core
+import openrouter_ai
+import storage
+
+TOMORROW = (datetime.now(pytz.timezone(storage.DEFAULT_TIMEZONE)).date() + timedelta(days=1)).isoformat()
+
+
+@pytest.fixture
+def locked_db(bot_state):
+    """Другое соединение держит блокировку записи 0.5 с, как долгая транзакция планировщика."""
+    locked = threading.Event()
+
+    def hold_lock():
+        conn = sqlite3.connect(bot_state.path, isolation_level=None)
+        conn.execute('BEGIN IMMEDIATE')
+        locked.set()
+        time.sleep(0.5)
+        conn.rollback()
+        conn.close()
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    locked.wait()
+    yield bot_state
+    thread.join()
+
+
+async def process_with_ticker(user_id, text):
+    """Обрабатывает сообщение и считает, сколько раз за это время успел выполниться цикл событий."""
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.02)
+            ticks += 1
+
+    task = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    response = await ai_core.process_message_async(user_id, text)
+    elapsed = time.perf_counter() - started
+    task.cancel()
+    return response, ticks, elapsed
+
+
+def test_event_loop_is_not_blocked_by_locked_database(locked_db):
+    response, ticks, elapsed = asyncio.run(process_with_ticker(1, "Добавь на завтра купить молоко"))
+
+    assert elapsed >= 0.4
+    # Пока задача ждала блокировку базы, остальные чаты продолжали обслуживаться
+    assert ticks >= 10
+    assert locked_db.get_tasks(1, TOMORROW) == ["купить молоко"]
+
+
+def test_model_answer_is_applied_off_the_event_loop(locked_db, monkeypatch):
+    async def get_ai_response_async(prompt, text, on_delta=None, history=None, tools=None):
+        return json.dumps({'tool_calls': [
+            {'tool_call': 'add_task', 'arguments': {'date': TOMORROW, 'task': task}}
+            for task in ("молоко", "хлеб")
+        ]}, ensure_ascii=False)
+
+    monkeypatch.setattr(openrouter_ai, 'get_ai_response_async', get_ai_response_async)
+    response, ticks, elapsed = asyncio.run(process_with_ticker(1, "Добавь на завтра молоко и хлеб"))
+
+    assert elapsed >= 0.4
+    assert ticks >= 10
+    assert locked_db.get_tasks(1, TOMORROW) == ["молоко", "хлеб"]
+
+
+def test_prompt_dates_follow_user_timezone(bot_state):
+    bot_state.update_user(1, timezone='Pacific/Kiritimati')
+    bot_state.update_user(2, timezone='Pacific/Pago_Pago')
+
+    for chat_id in (1, 2):
+        today = storage.user_today(chat_id)
+        assert datetime.now(pytz.timezone(bot_state.get_user(chat_id)['timezone'])).date() == today
+        assert f"Текущая дата: {today.isoformat()}" in ai_core.load_prompt(chat_id)
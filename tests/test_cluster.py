@@ -0,0 +1,169 @@
+import queue
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import cluster
+
+
+class FakeProcess:
+    def __init__(self):
+        self.alive = True
+        self.exitcode = None
+
+    def is_alive(self):
+        return self.alive
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    """Кластер без настоящих процессов: запоминаем долю лимита, с которой запущен каждый процесс."""
+    spawned = {}
+
+    def spawn(self, worker_id, rate):
+        worker = cluster._Worker(worker_id, FakeProcess(), queue.Queue())
+        spawned[worker_id] = rate
+        return worker
+
+    monkeypatch.setattr(cluster.Cluster, '_spawn', spawn)
+    group = cluster.Cluster(api_url='http://127.0.0.1:1/bot{0}/{1}', global_rate=30)
+    group.spawned = spawned
+    yield group.start(2)
+    group._control.put(None)
+
+
+def current_rates(group) -> dict:
+    """Доля лимита каждого процесса: последняя присланная ему или та, с которой он запущен."""
+    rates = {}
+    for worker in group.workers.values():
+        rates[worker.id] = group.spawned[worker.id]
+        while not worker.inbox.empty():
+            item = worker.inbox.get()
+            if item and item[0] == 'rate':
+                rates[worker.id] = item[1]
+        group.spawned[worker.id] = rates[worker.id]
+    return rates
+
+
+def test_global_rate_is_shared_after_resize(workers):
+    group = workers
+    assert sum(current_rates(group).values()) == pytest.approx(30)
+
+    group.add_worker()
+    group.add_worker()
+    rates = current_rates(group)
+    assert sum(rates.values()) == pytest.approx(30)
+    assert list(rates.values()) == pytest.approx([7.5] * 4)
+
+    # Выводимый процесс еще отправляет ответы, поэтому до его завершения доли не растут
+    group.remove_worker(3)
+    assert sum(current_rates(group).values()) == pytest.approx(30)
+
+    group.workers[3].process.alive = False
+    group._check_workers()
+    rates = current_rates(group)
+    assert sorted(rates) == [0, 1, 2]
+    assert list(rates.values()) == pytest.approx([10] * 3)
+
+
+def received(worker, kind: str, timeout: float = 2) -> list:
+    """Сообщения вида kind из очереди процесса: ждем первое не дольше timeout, затем забираем остальные."""
+    items = []
+    deadline = time.monotonic() + timeout
+    while True:
+        wait = 0.1 if items else deadline - time.monotonic()
+        try:
+            item = worker.inbox.get(timeout=max(wait, 0))
+        except queue.Empty:
+            return items
+        if item is not None and item[0] == kind:
+            items.append(item)
+
+
+def chat_of(group, worker_id: int) -> int:
+    return next(chat_id for chat_id in range(1000) if group.ring.get(chat_id) == worker_id)
+
+
+EVENT = ('schedule', 'task_added', {'id': 1, 'chat_id': 5, 'date': '2024-05-01', 'remind_at': '09:00'})
+
+
+def test_scheduler_events_reach_draining_worker(workers):
+    group = workers
+    group.route({'update_id': 1, 'message': {'chat': {'id': chat_of(group, 1)}}})
+    group.remove_worker(1)
+    assert group.workers[1].draining and not group.workers[1].closed
+
+    # Выводимый процесс может держать аренду планировщика — событие получают оба
+    group._control.put(EVENT)
+    assert received(group.workers[0], 'schedule') == [EVENT]
+    assert received(group.workers[1], 'schedule') == [EVENT]
+
+
+def test_events_missed_by_stopping_worker_are_resent(workers):
+    group = workers
+    group.remove_worker(1)
+    assert group.workers[1].closed
+
+    group._control.put(EVENT)
+    assert received(group.workers[0], 'schedule') == [EVENT]
+
+    # Остановленный процесс очередь уже не читает; когда он завершится, аренду возьмет
+    # оставшийся процесс, и событие приходит ему повторно
+    group.workers[1].process.alive = False
+    group._check_workers()
+    assert received(group.workers[0], 'schedule') == [EVENT]
+    assert group._deferred == []
+
+
+def test_worker_that_lost_lease_is_replaced_after_drain(workers):
+    group = workers
+    chat_id = chat_of(group, 0)
+    group.route({'update_id': 1, 'message': {'chat': {'id': chat_id}}})
+
+    group._control.put(('lease_lost', 0))
+    deadline = time.monotonic() + 5
+    while len(group.workers) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # Процесс не завершается сразу: он доработает сообщение чата, а новые сообщения получит замена
+    assert group.ring.nodes == {1, 2}
+    assert group.workers[0].draining and not group.workers[0].closed
+    assert list(current_rates(group).values()) == pytest.approx([10] * 3)
+
+    group._control.put(('done', 0, chat_id))
+    deadline = time.monotonic() + 5
+    while not group.workers[0].closed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert group.workers[0].closed
+
+    group.workers[0].process.alive = False
+    group._check_workers()
+    assert list(current_rates(group).values()) == pytest.approx([15] * 2)
+
+
+def test_lease_holder_is_notified_when_lease_is_taken(tmp_path):
+    path = str(tmp_path / 'lease.db')
+    lease = cluster.Lease('scheduler', 'A', ttl=0.3, path=path)
+    events = []
+    stopped = threading.Event()
+    holder = threading.Thread(target=lease.hold, args=(
+        stopped, lambda: events.append('acquired'), lambda: events.append('lost')))
+    holder.start()
+
+    deadline = time.monotonic() + 5
+    while not events and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert events == ['acquired']
+    assert not cluster.Lease('scheduler', 'B', ttl=0.3, path=path).acquire()
+
+    # Другой процесс забрал аренду, пока этот не мог её продлить
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("UPDATE leases SET owner = 'B', expires_at = ?", (time.time() + 10,))
+    conn.close()
+
+    holder.join(5)
+    assert not holder.is_alive()
+    assert events == ['acquired', 'lost']
+    stopped.set()
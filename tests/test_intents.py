@@ -0,0 +1,46 @@
+import json
+from datetime import date, timedelta
+
+import ai_core
+import intents
+import openrouter_ai
+
+TODAY = date(2026, 10, 18)
+
+
+def test_single_task_is_parsed_locally():
+    call, confidence = intents.parse_intent("Добавь на завтра купить молоко", TODAY)
+
+    assert call == {'tool_call': 'add_task', 'arguments': {'date': '2026-10-19', 'task': 'купить молоко'}}
+    assert confidence >= intents.MIN_CONFIDENCE
+
+
+def test_list_of_tasks_is_left_to_the_model():
+    assert intents.parse_intent("Добавь на завтра молоко, хлеб и позвонить маме", TODAY) is None
+    assert intents.parse_intent("напомни завтра купить хлеб и позвонить маме", TODAY) is None
+    assert intents.parse_intent("напомни купить хлеб; забрать посылку завтра", TODAY) is None
+
+
+def test_other_commands_are_not_affected():
+    assert intents.parse_intent("удали задачу 2 на завтра", TODAY)[0] == {
+        'tool_call': 'delete_tasks', 'arguments': {'date': '2026-10-19', 'task_number': 2},
+    }
+    assert intents.parse_intent("покажи мои задачи", TODAY)[0]['tool_call'] == 'show_tasks'
+
+
+def test_list_of_tasks_goes_to_the_model_as_one_batch(bot_state, monkeypatch):
+    tomorrow = date.today() + timedelta(days=1)
+    requests = []
+
+    def get_ai_response(prompt, text, on_delta=None, history=None, tools=None):
+        requests.append(text)
+        return json.dumps({'tool_calls': [
+            {'tool_call': 'add_task', 'arguments': {'date': tomorrow.isoformat(), 'task': task}}
+            for task in ("молоко", "хлеб", "позвонить маме")
+        ]}, ensure_ascii=False)
+
+    monkeypatch.setattr(openrouter_ai, 'get_ai_response', get_ai_response)
+    ai_core.process_message(1, "Добавь на завтра молоко, хлеб и позвонить маме")
+
+    assert len(requests) == 1
+    assert bot_state.get_tasks(1, tomorrow.isoformat()) == ["молоко", "хлеб", "позвонить маме"]
@@ -0,0 +1,75 @@
+import json
+from datetime import date
+
+import pytest
+
+import ai_core
+import llm_cache
+import openrouter_ai
+
+REPORT_DATE = f"{date.today().year}-10-25"
+
+
+@pytest.fixture
+def model(monkeypatch):
+    """Модель-заглушка: "вторую задачу" относит к дате, упомянутой раньше в истории диалога."""
+    calls = []
+
+    def get_ai_response(prompt, text, on_delta=None, history=None, tools=None):
+        calls.append({'text': text, 'history': list(history or [])})
+        if 'вторую задачу' in text:
+            if any('25.10' in m['content'] or REPORT_DATE in m['content'] for m in history or []):
+                return json.dumps({'tool_call': 'delete_tasks',
+                                   'arguments': {'date': REPORT_DATE, 'task_number': 2}})
+            return "Уточните, пожалуйста, на какую дату."
+        return "Не понял."
+
+    monkeypatch.setattr(openrouter_ai, 'get_ai_response', get_ai_response)
+    return calls
+
+
+def test_answer_depending_on_history_is_not_replayed_to_other_chat(bot_state, model):
+    ai_core.process_message(1, "запиши 25.10 отчет")
+    first = ai_core.process_message(1, "убери вторую задачу")
+    assert REPORT_DATE in first
+
+    second = ai_core.process_message(2, "убери вторую задачу")
+
+    assert REPORT_DATE not in second
+    assert [call['text'] for call in model].count("убери вторую задачу") == 2
+    assert model[-1]['history'] == []
+
+
+def test_same_message_without_history_is_served_from_cache(bot_state, model):
+    cache = llm_cache.get_llm_cache()
+    cache.put('prompt', "Удали задачу 2 на завтра", [{'tool_call': 'delete_all_tasks', 'arguments': {}}])
+
+    assert cache.get('prompt', "удали задачу 2 на завтра!") is not None
+    assert cache.get('prompt', "удали задачу 2 на завтра", history=[{'role': 'user', 'content': 'x'}]) is None
+
+
+def test_key_depends_on_history():
+    cache = llm_cache.LLMCache()
+    history = [{'role': 'user', 'content': "запиши 25.10 отчет"}]
+
+    assert cache.key('prompt', "убери вторую задачу") != cache.key('prompt', "убери вторую задачу", history)
+    assert cache.key('prompt', "убери вторую задачу", history) == cache.key('prompt', "Убери вторую задачу.", list(history))
+
+
+def test_messages_referring_to_previous_replies_are_cached_per_history():
+    cache = llm_cache.LLMCache()
+    first = [{'role': 'user', 'content': "запиши 25.10 отчет"}]
+    second = [{'role': 'user', 'content': "запиши 26.10 отчет"}]
+
+    assert cache.key('prompt', "удали её", first) is not None
+    assert cache.key('prompt', "удали её", first) != cache.key('prompt', "удали её", second)
+    assert cache.key('prompt', "?!") is None
+
+
+def test_date_separators_are_kept_in_key():
+    cache = llm_cache.LLMCache()
+
+    assert llm_cache.normalize("Задачи на 12.10!") == "задачи на 12.10"
+    assert cache.key('prompt', "задачи на 12.10") != cache.key('prompt', "задачи на 12-10")
+    assert cache.key('prompt', "напомни в 9:30") != cache.key('prompt', "напомни в 9 30")
+    assert cache.key('prompt', "Покажи задачи, пожалуйста.") == cache.key('prompt', "покажи задачи пожалуйста")
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import time
+from collections import deque
+
+import openai
+import pytest
+
+import openrouter_ai
+from fake_openrouter import FakeOpenRouter
+
+MESSAGES = [{'role': 'user', 'content': "как дела?"}]
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    """Локальная заглушка /chat/completions и клиент OpenRouter, настроенный на неё."""
+    server = FakeOpenRouter(script=[(r'', "Все хорошо.")]).start()
+    monkeypatch.setattr(openrouter_ai, 'BASE_URL', server.base_url)
+    monkeypatch.setattr(openrouter_ai, '_client', None)
+    monkeypatch.setattr(openrouter_ai, '_async_client', None)
+    monkeypatch.setattr(openrouter_ai, '_async_semaphore', None)
+    monkeypatch.setattr(openrouter_ai, '_latencies', deque(maxlen=200))
+    monkeypatch.setattr(openrouter_ai, 'MAX_RETRIES', 3)
+    monkeypatch.setattr(openrouter_ai, 'BACKOFF_BASE', 0.01)
+    yield server
+    server.stop()
+
+
+def test_client_is_created_once(fake):
+    assert openrouter_ai.get_client() is openrouter_ai.get_client()
+
+
+def test_temporary_errors_are_retried(fake):
+    fake.queue_response(429)
+    fake.queue_response(503)
+    fake.queue_response(500)
+
+    assert openrouter_ai._complete_with_retries(MESSAGES) == "Все хорошо."
+    assert fake.requests == 4
+
+
+def test_retries_are_limited(fake, monkeypatch):
+    monkeypatch.setattr(openrouter_ai, 'MAX_RETRIES', 1)
+    fake.queue_response(503)
+    fake.queue_response(503)
+
+    with pytest.raises(openai.APIStatusError):
+        openrouter_ai._complete_with_retries(MESSAGES)
+    assert fake.requests == 2
+
+
+def test_retry_after_is_honoured(fake):
+    fake.queue_response(429, retry_after=0.5)
+
+    assert openrouter_ai._complete_with_retries(MESSAGES) == "Все хорошо."
+    first, second = fake.request_times
+    assert second - first >= 0.5
+
+
+def test_client_errors_are_not_retried(fake):
+    fake.queue_response(400)
+
+    with pytest.raises(openai.BadRequestError):
+        openrouter_ai._complete_with_retries(MESSAGES)
+    assert fake.requests == 1
+
+
+def test_timeout_is_applied(fake, monkeypatch):
+    monkeypatch.setattr(openrouter_ai, 'READ_TIMEOUT', 0.3)
+    monkeypatch.setattr(openrouter_ai, 'MAX_RETRIES', 0)
+    fake.queue_response(latency=2)
+
+    started = time.monotonic()
+    with pytest.raises(openai.APITimeoutError):
+        openrouter_ai._complete_with_retries(MESSAGES)
+    assert time.monotonic() - started < 1.5
+
+
+def test_hedged_request_fires_after_p95_and_first_answer_wins(fake, monkeypatch):
+    monkeypatch.setattr(openrouter_ai, 'HEDGE_MIN_DELAY', 0.2)
+    openrouter_ai._latencies.extend([0.05] * openrouter_ai.HEDGE_MIN_SAMPLES)
+    fake.queue_response(latency=1.5)  # Первый запрос "завис"
+    fake.queue_response(latency=0)
+
+    started = time.monotonic()
+    assert openrouter_ai._complete_hedged(MESSAGES) == "Все хорошо."
+    elapsed = time.monotonic() - started
+
+    assert elapsed < 1.0
+    # Второй запрос ушел не раньше порога p95 и ответил раньше первого
+    assert fake.request_times[1] - started >= 0.2
+    assert fake.requests == 2
+
+
+def test_no_hedge_without_enough_samples(fake):
+    fake.queue_response(latency=0.3)
+
+    assert openrouter_ai._complete_hedged(MESSAGES) == "Все хорошо."
+    assert fake.requests == 1
+
+
+def test_async_client_retries_temporary_errors(fake):
+    fake.queue_response(502)
+
+    async def main():
+        try:
+            return await openrouter_ai._complete_with_retries_async(MESSAGES)
+        finally:
+            await openrouter_ai.close_async_client()
+
+    assert asyncio.run(main()) == "Все хорошо."
+    assert fake.requests == 2
+
+
+def test_streaming_response_reports_usage(fake):
+    deltas = []
+
+    response = openrouter_ai._stream_with_retries(MESSAGES, deltas.append)
+
+    assert response == "Все хорошо."
+    assert deltas[-1] == "Все хорошо."
+    assert response.usage == {'prompt_tokens': 2, 'completion_tokens': 2}
+
+
+def test_async_streaming_response_reports_usage(fake):
+    async def on_delta(text):
+        pass
+
+    async def main():
+        try:
+            return await openrouter_ai._stream_with_retries_async(MESSAGES, on_delta)
+        finally:
+            await openrouter_ai.close_async_client()
+
+    assert asyncio.run(main()).usage == {'prompt_tokens': 2, 'completion_tokens': 2}
+
+
+def test_llm_span_and_counters_get_token_counts(fake, bot_state, monkeypatch, capsys):
+    import ai_core
+    import metrics
+
+    monkeypatch.setattr(metrics, 'ENABLED', True)
+    monkeypatch.setattr(metrics, 'JSON_LOG', True)
+    metrics.reset()
+
+    # Как в main.py: ответ всегда запрашивается потоково
+    assert ai_core.process_message(1, "как дела?", on_partial=lambda text: None) == "Все хорошо."
+
+    counters = metrics.snapshot()['counters']
+    assert counters['llm_tokens_total{type="completion"}'] == 2
+    assert counters['llm_tokens_total{type="prompt"}'] > 0
+    spans = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    llm = next(s for s in spans if s.get('event') == 'span' and s['stage'] == 'llm')
+    assert llm['completion_tokens'] == 2
+    assert llm['prompt_tokens'] == counters['llm_tokens_total{type="prompt"}']
+    metrics.reset()
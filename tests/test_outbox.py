@@ -0,0 +1,166 @@
+import threading
+import time
+
+import pytest
+import telebot
+import telebot.apihelper
+
+import outbox
+import storage
+from fake_telegram import FakeTelegram
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    """Имитация Bot API с лимитами Telegram по умолчанию."""
+    server = FakeTelegram().start()
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', server.api_url)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def bot():
+    return telebot.TeleBot('123456:test', threaded=False)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return storage.SQLiteTaskStorage(str(tmp_path / 'tasks.db'))
+
+
+@pytest.fixture
+def make_outbox(bot, store):
+    started = []
+
+    def make(start: bool = True, **kwargs):
+        box = outbox.Outbox(bot, storage=store, **kwargs)
+        if start:
+            box.start(resume=False)
+            started.append(box)
+        return box
+
+    yield make
+    for box in started:
+        box.stop()
+
+
+def texts(telegram, chat_id) -> list:
+    return [m['text'] for m in telegram.sent if m['chat_id'] == chat_id]
+
+
+def test_default_limits_cause_no_429(telegram, make_outbox):
+    box = make_outbox()
+    futures = [box.send_message(chat_id, f"рассылка {chat_id}") for chat_id in range(1, 41)]
+    futures += [box.send_message(100, f"ответ {n}") for n in range(5)]
+
+    for future in futures:
+        future.result(timeout=30)
+
+    assert telegram.rejected == 0
+    assert len(telegram.sent) == 45
+    assert texts(telegram, 100) == [f"ответ {n}" for n in range(5)]
+
+
+def test_retry_after_is_honoured_and_chat_order_kept(monkeypatch, bot, make_outbox):
+    # Очередь считает лимит чата большим, чем у Telegram, поэтому получает 429
+    monkeypatch.setattr(outbox, 'CHAT_RATE', 100)
+    monkeypatch.setattr(outbox, 'CHAT_BURST', 100)
+    server = FakeTelegram(chat_rate=1, chat_burst=1).start()
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', server.api_url)
+    try:
+        box = make_outbox()
+        futures = [box.send_message(1, f"сообщение {n}") for n in range(3)]
+        other = box.send_message(2, "другой чат")
+        for future in futures + [other]:
+            future.result(timeout=30)
+    finally:
+        server.stop()
+
+    assert server.rejected >= 2
+    chat = [m for m in server.sent if m['chat_id'] == 1]
+    assert [m['text'] for m in chat] == [f"сообщение {n}" for n in range(3)]
+    # После 429 сообщение уходит не раньше retry_after (Telegram отвечает не меньше 1 с)
+    for previous, current in zip(chat, chat[1:]):
+        assert current['time'] - previous['time'] >= 0.9
+    # Пауза одного чата не задерживает другие
+    assert server.sent.index(next(m for m in server.sent if m['chat_id'] == 2)) < server.sent.index(chat[1])
+
+
+def test_interactive_messages_go_before_bulk(monkeypatch, telegram, make_outbox):
+    monkeypatch.setattr(outbox, 'GLOBAL_RATE', 5)
+    box = make_outbox(start=False)
+    bulk = [box.send_message(chat_id, "сводка", priority=outbox.BULK) for chat_id in range(1, 11)]
+    reply = box.send_message(100, "ответ")
+    box.start(resume=False)
+    try:
+        for future in bulk + [reply]:
+            future.result(timeout=30)
+    finally:
+        box.stop()
+
+    # Ответ уходит в первом же всплеске, а не после десяти сводок, поставленных раньше него
+    # (внутри всплеска запросы выполняются параллельно, поэтому порядок прихода не определен)
+    assert [m['text'] for m in telegram.sent].index("ответ") < 5
+    assert telegram.rejected == 0
+
+
+def test_durable_message_survives_failure_and_is_resent_by_resume(monkeypatch, bot, store, telegram, make_outbox):
+    monkeypatch.setattr(outbox, 'RETRY_DELAY', 0.01)
+    monkeypatch.setattr(outbox, 'DURABLE_RETRY_DELAY', 0)
+    # Telegram недоступен: все попытки заканчиваются сетевой ошибкой
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', 'http://127.0.0.1:9/bot{0}/{1}')
+    box = make_outbox()
+    future = box.send_message(1, "напоминание", priority=outbox.BULK, durable=True)
+    with pytest.raises(Exception):
+        future.result(timeout=30)
+    assert len(store.outbox_pending(time.time())) == 1
+
+    # После перезапуска сохраненное сообщение досылается
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', telegram.api_url)
+    restarted = make_outbox()
+    assert restarted.resume() == 1
+    assert restarted.join(timeout=10)
+    assert texts(telegram, 1) == ["напоминание"]
+    assert store.outbox_pending(time.time() + 3600) == []
+
+
+def test_durable_message_queued_before_crash_is_sent_after_restart(store, telegram, make_outbox):
+    crashed = make_outbox(start=False)  # Процесс упал, не успев отправить
+    crashed.send_message(1, "сводка", priority=outbox.BULK, durable=True)
+
+    restarted = make_outbox()
+    assert restarted.resume() == 1
+    assert restarted.join(timeout=10)
+    assert texts(telegram, 1) == ["сводка"]
+    assert restarted.resume() == 0
+
+
+def test_global_rate_can_be_lowered_on_the_fly(monkeypatch, make_outbox):
+    # Как после добавления процессов в cluster.py: доля лимита этого процесса уменьшилась до 5 в секунду
+    server = FakeTelegram(global_rate=5).start()
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', server.api_url)
+    try:
+        box = make_outbox()
+        box.set_global_rate(5)
+        started = time.monotonic()
+        futures = [box.send_message(chat_id, f"рассылка {chat_id}") for chat_id in range(1, 11)]
+        for future in futures:
+            future.result(timeout=30)
+        elapsed = time.monotonic() - started
+    finally:
+        server.stop()
+
+    assert server.rejected == 0
+    assert elapsed >= 1.0
+
+
+def test_resume_can_be_stopped(telegram, make_outbox):
+    box = make_outbox()
+    before = set(threading.enumerate())
+    box.start_resume()
+    resume = next(t for t in set(threading.enumerate()) - before if t.name == 'outbox-resume')
+
+    box.stop_resume()
+    resume.join(5)
+    assert not resume.is_alive()
@@ -0,0 +1,149 @@
+import re
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import pages
+import storage
+
+TODAY = datetime.now(pytz.timezone(storage.DEFAULT_TIMEZONE)).date()
+DAYS = [(TODAY + timedelta(days=n)).isoformat() for n in range(1, 4)]
+
+
+@pytest.fixture
+def renderer(bot_state):
+    return pages.PageRenderer(page_size=4)
+
+
+def add_tasks(storage, chat_id=1, per_day=3, text="задача"):
+    """По per_day задач на каждую из DAYS. Возвращает тексты в порядке показа."""
+    texts = []
+    for day in DAYS:
+        for n in range(1, per_day + 1):
+            texts.append(f"{text} {day} {n}")
+            storage.add_task(chat_id, day, texts[-1])
+    return texts
+
+
+def buttons(page) -> dict:
+    """Кнопки листания страницы: {'◀ Назад': callback_data, 'Вперед ▶': callback_data}."""
+    if page.reply_markup is None:
+        return {}
+    return {button.text: button.callback_data for row in page.reply_markup.keyboard for button in row}
+
+
+def shown(page) -> list:
+    return re.findall(r"^\s*\d+\. (.+)$", page, re.MULTILINE)
+
+
+def walk_forward(renderer, chat_id=1, from_date=None, to_date=None) -> list:
+    page = renderer.render(chat_id, from_date, to_date)
+    result = [page]
+    while 'Вперед ▶' in buttons(page):
+        page = renderer.handle_callback(chat_id, buttons(page)['Вперед ▶'])
+        result.append(page)
+    return result
+
+
+def test_callback_data_round_trip_and_size(renderer, bot_state):
+    task_id = bot_state.add_task(1, DAYS[0], "x")
+    task = {'date': DAYS[0], 'id': 10 ** 12}
+    data = pages.callback_data(DAYS[0], DAYS[2], 'a', task)
+
+    assert data == f"tp:{DAYS[0].replace('-', '')}:{DAYS[2].replace('-', '')}:a{DAYS[0].replace('-', '')}.{10 ** 12}"
+    # Telegram принимает callback_data не длиннее 64 байт
+    assert len(data.encode('utf-8')) <= 64
+    assert pages.CALLBACK_RE.fullmatch(data).groups() == (
+        DAYS[0].replace('-', ''), DAYS[2].replace('-', ''), 'a', DAYS[0].replace('-', ''), str(10 ** 12))
+    assert pages.callback_data(None, None, 'b', {'date': DAYS[0], 'id': task_id}).startswith('tp:::b')
+    assert pages.is_callback(data) and not pages.is_callback('other')
+    # Испорченные данные кнопки — первая страница, а не ошибка
+    assert pages.handle_callback(1, 'tp:garbage') == pages.render(1)
+
+
+def test_pages_go_forward_and_back_across_dates(renderer, bot_state):
+    texts = add_tasks(bot_state)
+
+    forward = walk_forward(renderer)
+
+    assert [len(shown(page)) for page in forward] == [4, 4, 1]
+    assert sum((shown(page) for page in forward), []) == texts
+    assert 'Всего задач: 9' in forward[0]
+    assert '◀ Назад' not in buttons(forward[0])
+    # Номера задач считаются в пределах своей даты, даже если дата началась на прошлой странице
+    assert re.search(rf"{DAYS[1]}:\n  2\. задача {DAYS[1]} 2", forward[1])
+    assert re.search(rf"{DAYS[2]}:\n  1\. задача {DAYS[2]} 1", forward[1])
+
+    page = forward[-1]
+    backward = [page]
+    while '◀ Назад' in buttons(page):
+        page = renderer.handle_callback(1, buttons(page)['◀ Назад'])
+        backward.append(page)
+    assert [shown(page) for page in reversed(backward)] == [shown(page) for page in forward]
+
+
+def test_date_range_pages_stay_within_range(renderer, bot_state):
+    add_tasks(bot_state)
+
+    forward = walk_forward(renderer, 1, DAYS[1], DAYS[2])
+
+    assert sum((shown(page) for page in forward), []) == [f"задача {day} {n}" for day in DAYS[1:] for n in (1, 2, 3)]
+    assert forward[0].startswith(f"Задачи с {DAYS[1]} по {DAYS[2]}:")
+
+
+def test_long_tasks_are_truncated_and_split_by_length(renderer, bot_state, monkeypatch):
+    monkeypatch.setattr(pages, 'PAGE_CHAR_LIMIT', 1000)
+    add_tasks(bot_state, per_day=4, text="х" * 1000)
+
+    forward = walk_forward(renderer)
+
+    assert all(len(page) <= 1000 + len("\n\nВсего задач: 12") for page in forward)
+    assert len(forward) > 12 // renderer.page_size
+    lines = sum((shown(page) for page in forward), [])
+    assert len(lines) == 12
+    assert all(len(line) == pages.TASK_TEXT_LIMIT and line.endswith('…') for line in lines)
+
+
+def test_cache_is_invalidated_by_task_changes(renderer, bot_state):
+    add_tasks(bot_state)
+    add_tasks(bot_state, chat_id=2)
+    renderer.render(1)
+    renderer.render(2)
+    assert renderer.render(1) == renderer.render(1)
+    assert renderer.stats == {'hits': 2, 'misses': 2}
+
+    bot_state.add_task(1, DAYS[0], "новая задача")
+    assert "новая задача" in renderer.render(1)
+    assert renderer.stats['misses'] == 3
+
+    # Кэш другого пользователя не сбрасывается
+    renderer.render(2)
+    assert renderer.stats == {'hits': 3, 'misses': 3}
+
+    bot_state.delete_task(1, DAYS[0], 4)
+    assert "новая задача" not in renderer.render(1)
+
+
+def test_stale_cursor_shows_first_page(renderer, bot_state):
+    add_tasks(bot_state)
+    second = renderer.handle_callback(1, buttons(renderer.render(1))['Вперед ▶'])
+
+    bot_state.delete_all(1)
+    bot_state.add_task(1, DAYS[0], "единственная")
+
+    assert shown(renderer.handle_callback(1, buttons(second)['◀ Назад'])) == ["единственная"]
+
+
+def test_today_is_taken_from_user_timezone(renderer, bot_state):
+    # UTC+14 и UTC-11: у этих пользователей никогда не бывает одной и той же даты
+    bot_state.update_user(1, timezone='Pacific/Kiritimati')
+    bot_state.update_user(2, timezone='Pacific/Pago_Pago')
+    east, west = storage.user_today(1).isoformat(), storage.user_today(2).isoformat()
+    for chat_id in (1, 2):
+        bot_state.add_task(chat_id, west, "вчера на востоке")
+        bot_state.add_task(chat_id, east, "дедлайн")
+
+    assert renderer.render(1) == "--- Задачи на сегодня ---\n\n  1. дедлайн"
+    assert renderer.render(2).startswith("--- Задачи на сегодня ---\n\n  1. вчера на востоке")
+    assert f"--- Остальные задачи ---\n\n{east}:\n  1. дедлайн" in renderer.render(2)
@@ -0,0 +1,83 @@
+import time
+from datetime import date
+
+import pytest
+import telebot
+import telebot.apihelper
+
+import outbox
+import scheduler
+import storage
+from fake_telegram import FakeTelegram
+
+TODAY = date.today().isoformat()
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    server = FakeTelegram().start()
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', server.api_url)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return storage.SQLiteTaskStorage(str(tmp_path / 'tasks.db'))
+
+
+@pytest.fixture
+def box(telegram, store):
+    box = outbox.Outbox(telebot.TeleBot('123456:test', threaded=False), storage=store)
+    box.start(resume=False)
+    yield box
+    box.stop()
+
+
+def make_scheduler(box, store):
+    send = lambda chat_id, text: box.send_message(chat_id, text, priority=outbox.BULK, durable=True)
+    return scheduler.Scheduler(send, storage=store)
+
+
+def reminder(store, chat_id=1):
+    task_id = store.add_task(chat_id, TODAY, "позвонить маме", '09:00')
+    return {'kind': scheduler.REMINDER, 'chat_id': chat_id, 'task_id': task_id, 'attempt': 1}
+
+
+def test_reminder_is_queued_and_marked_delivered_together(telegram, store, box):
+    event = reminder(store)
+    make_scheduler(box, store)._fire(event)
+
+    assert box.join(10)
+    assert [m['text'] for m in telegram.sent] == ["⏰ Напоминание: позвонить маме"]
+    assert store.is_delivered(1, scheduler.REMINDER, str(event['task_id']))
+    assert store.outbox_pending(time.time()) == []
+
+
+def test_failed_delivery_record_rolls_back_queued_message(monkeypatch, telegram, store, box):
+    store.ensure_user(1)
+    store.add_task(1, TODAY, "отчет")
+    event = {'kind': scheduler.DIGEST, 'chat_id': 1, 'date': TODAY, 'version': 1, 'attempt': 1}
+    notifications = make_scheduler(box, store)
+    notifications._digest_versions[1] = 1
+
+    mark_delivered = store.mark_delivered
+    failures = [storage.sqlite3.OperationalError('database is locked')]
+
+    def fail_once(*args):
+        if failures:
+            raise failures.pop()
+        mark_delivered(*args)
+
+    monkeypatch.setattr(store, 'mark_delivered', fail_once)
+    with pytest.raises(storage.sqlite3.OperationalError):
+        notifications._fire(event)
+    # Сводка не ушла и не осталась в очереди: повтор события не приведет к дублю
+    assert box.join(10)
+    assert telegram.sent == []
+    assert store.outbox_pending(time.time()) == []
+
+    notifications._fire(event)
+    assert box.join(10)
+    assert len(telegram.sent) == 1
+    assert store.is_delivered(1, scheduler.DIGEST, TODAY)
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+import sessions
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_store(request, tmp_path):
+    def make(**kwargs):
+        if request.param == 'sqlite':
+            return sessions.SQLiteSessionStore(str(tmp_path / 'sessions.db'), **kwargs)
+        return sessions.MemorySessionStore(**kwargs)
+    return make
+
+
+def test_session_is_saved_as_copy(make_store):
+    store = make_store()
+    with store.open(1) as session:
+        session['pending'] = {'state': 'awaiting_confirmation', 'params': {'date': '2024-05-01'}}
+
+    first = store.get(1)
+    first['pending']['params']['date'] = 'изменено'
+    assert store.get(1)['pending']['params']['date'] == '2024-05-01'
+
+    # Пустая сессия удаляется, а исключение внутри блока отбрасывает изменения
+    with pytest.raises(RuntimeError):
+        with store.open(1) as session:
+            session['pending'] = None
+            raise RuntimeError
+    assert store.get(1)['pending']['state'] == 'awaiting_confirmation'
+    with store.open(1) as session:
+        session.clear()
+    assert store.get(1) is None and len(store) == 0
+
+
+def test_sessions_expire_after_ttl(make_store):
+    store = make_store(ttl=0.2)
+    store.set(1, {'history': []})
+    store.set(2, {'history': []})
+    time.sleep(0.1)
+    store.set(2, {'history': []})  # Запись продлевает срок жизни
+    time.sleep(0.15)
+
+    assert store.get(1) is None
+    assert store.get(2) == {'history': []}
+    assert len(store) == 1
+
+
+def test_least_recently_saved_sessions_are_evicted(make_store):
+    store = make_store(max_size=3)
+    for chat_id in range(1, 5):
+        store.set(chat_id, {'n': chat_id})
+        time.sleep(0.01)
+    store.set(2, {'n': 2})
+    store.set(5, {'n': 5})
+    if isinstance(store, sessions.SQLiteSessionStore):
+        store.cleanup()  # SQLite чистит раз в CLEANUP_EVERY записей
+
+    assert len(store) == 3
+    assert [chat_id for chat_id in range(1, 6) if store.get(chat_id)] == [2, 4, 5]
+
+
+def test_history_keeps_last_messages(monkeypatch):
+    monkeypatch.setattr(sessions, 'HISTORY_SIZE', 4)
+    session = {}
+    for n in range(1, 6):
+        sessions.add_to_history(session, 'user', f"вопрос {n}")
+        sessions.add_to_history(session, 'assistant', f"ответ {n}")
+    sessions.add_to_history(session, 'assistant', "х" * 1000)
+
+    assert [m['content'] for m in session['history']] == ["ответ 4", "вопрос 5", "ответ 5",
+                                                          "х" * sessions.HISTORY_MESSAGE_LIMIT + '…']
+    assert session['history'][0]['role'] == 'assistant'
+
+
+def test_open_is_serialized_per_chat(make_store):
+    store = make_store()
+    intervals = {1: [], 2: []}
+
+    def increment(chat_id):
+        with store.open(chat_id) as session:
+            started = time.monotonic()
+            count = session.get('count', 0)
+            time.sleep(0.05)  # Без блокировки второй поток прочитал бы то же значение
+            session['count'] = count + 1
+            intervals[chat_id].append((started, time.monotonic()))
+
+    threads = [threading.Thread(target=increment, args=(chat_id,)) for chat_id in (1, 1, 1, 2, 2, 2)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert store.get(1) == {'count': 3} and store.get(2) == {'count': 3}
+    for chat_intervals in intervals.values():
+        chat_intervals.sort()
+        assert all(end <= next_start for (_, end), (next_start, _) in zip(chat_intervals, chat_intervals[1:]))
+    # Разные чаты друг друга не ждут
+    assert time.monotonic() - started < 6 * 0.05
+    assert store._key_locks._locks == {}
@@ -0,0 +1,172 @@
+import json
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import storage
+
+
+@pytest.fixture
+def store(tmp_path):
+    return storage.SQLiteTaskStorage(str(tmp_path / 'tasks.db'))
+
+
+@pytest.fixture
+def legacy_json(tmp_path):
+    path = tmp_path / 'tasks.json'
+    path.write_text(json.dumps({
+        '2024-05-02': ["купить хлеб", "позвонить маме"],
+        '2024-05-01': ["отчет"],
+    }, ensure_ascii=False), encoding='utf-8')
+    return path
+
+
+def test_legacy_json_is_migrated_and_renamed(store, legacy_json):
+    assert storage.migrate_json(str(legacy_json), 42, store) == 3
+
+    assert store.get_all_tasks(42) == {
+        '2024-05-01': ["отчет"],
+        '2024-05-02': ["купить хлеб", "позвонить маме"],
+    }
+    assert not legacy_json.exists()
+    assert json.loads(legacy_json.with_name('tasks.json.migrated').read_text(encoding='utf-8'))
+
+
+def test_migration_is_not_repeated(store, legacy_json):
+    storage.migrate_json(str(legacy_json), 42, store)
+
+    # Файл уже переименован: повторный запуск ничего не импортирует
+    assert storage.migrate_json(str(legacy_json), 42, store) == 0
+    assert store.count_tasks(42, '') == 3
+
+
+def test_broken_legacy_json_is_left_in_place(store, legacy_json):
+    legacy_json.write_text('{', encoding='utf-8')
+
+    assert storage.migrate_json(str(legacy_json), 42, store) == 0
+    assert legacy_json.exists()
+
+
+def test_database_without_reminders_column_is_upgraded(tmp_path):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE tasks (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, '
+                 'date TEXT NOT NULL, text TEXT NOT NULL)')
+    conn.execute("INSERT INTO tasks (chat_id, date, text) VALUES (1, '2024-05-01', 'отчет')")
+    conn.commit()
+    conn.close()
+
+    upgraded = storage.SQLiteTaskStorage(path)
+    task_id = upgraded.add_task(1, '2024-05-01', "созвон", '10:00')
+
+    assert upgraded.get_tasks(1, '2024-05-01') == ["отчет", "созвон"]
+    assert upgraded.get_task(task_id)['remind_at'] == '10:00'
+    # Повторное открытие уже обновленной базы не ломает схему
+    assert storage.SQLiteTaskStorage(path).get_tasks(1, '2024-05-01') == ["отчет", "созвон"]
+
+
+def test_chats_do_not_see_each_others_tasks(store):
+    store.add_task(1, '2024-05-01', "задача первого")
+    store.add_task(2, '2024-05-01', "задача второго")
+
+    assert store.get_tasks(1, '2024-05-01') == ["задача первого"]
+    assert store.delete_task(2, '2024-05-01', 1) == "задача второго"
+    assert store.delete_task(2, '2024-05-01', 1) is None
+    assert store.delete_all(2) == 0
+    assert store.get_all_tasks(1) == {'2024-05-01': ["задача первого"]}
+    assert [task['text'] for task in store.get_tasks_page(2, '')] == []
+
+
+def test_failed_batch_rolls_back_everything(store):
+    store.add_task(1, '2024-05-01', "было")
+    committed = []
+
+    with pytest.raises(RuntimeError):
+        with store.batch():
+            store.add_task(1, '2024-05-01', "добавлено в пакете")
+            # Вложенная транзакция становится частью внешней и не фиксирует её раньше времени
+            store.delete_task(1, '2024-05-01', 1)
+            store.after_commit(lambda: committed.append('sent'))
+            raise RuntimeError("сбой посреди пакета")
+
+    assert store.get_tasks(1, '2024-05-01') == ["было"]
+    assert committed == []
+
+    # Следующий пакет не получает функций after_commit от откаченного
+    with store.batch():
+        store.add_task(1, '2024-05-01', "второй пакет")
+    assert committed == []
+
+
+def test_after_commit_runs_only_after_commit(store):
+    seen = []
+
+    with store.batch():
+        store.outbox_add(1, {'text': "привет"})
+        store.after_commit(lambda: seen.append(len(store.outbox_pending(time.time()))))
+        assert seen == []
+    assert seen == [1]
+
+    # Вне транзакции функция выполняется сразу
+    store.after_commit(lambda: seen.append('now'))
+    assert seen == [1, 'now']
+
+
+def test_tasks_version_identifies_chat_contents(store):
+    seen = {}
+
+    def check():
+        version = store.tasks_version(1)
+        contents = tuple(task['id'] for task in store.get_tasks_page(1, '', limit=100))
+        # Одна версия — одно и то же содержимое, иначе кэш страниц покажет устаревший список
+        assert seen.setdefault(version, contents) == contents
+
+    check()
+    for text in "abc":
+        store.add_task(1, '2024-05-01', text)
+        check()
+    store.delete_task(1, '2024-05-01', 2)
+    check()
+    store.delete_task(1, '2024-05-01', 2)
+    check()
+    store.add_task(1, '2024-05-02', "d")
+    check()
+    store.delete_task(1, '2024-05-02', 1)
+    check()
+    store.delete_task(1, '2024-05-01', 1)
+    store.add_task(1, '2024-05-01', "e")
+    check()
+
+    assert len(seen) == 7
+    assert store.tasks_version(2) == (0, None)
+
+
+def test_pruner_removes_only_expired_tasks(store, monkeypatch):
+    monkeypatch.setattr(storage, 'prune_cutoff', lambda: '2024-05-02')
+    store.add_task(1, '2024-05-01', "старая")
+    store.add_task(2, '2024-05-02', "сегодняшняя")
+
+    pruner = storage.start_pruner(store, interval=60)
+    try:
+        deadline = time.monotonic() + 5
+        while store.count_tasks(1, '') and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        pruner.stop_event.set()
+        pruner.join(5)
+
+    assert store.count_tasks(1, '') == 0
+    assert store.get_tasks(2, '2024-05-02') == ["сегодняшняя"]
+
+
+def test_prune_cutoff_is_behind_every_timezone(store):
+    store.update_user(1, timezone='Pacific/Pago_Pago')
+    todays = [datetime.now(pytz.timezone(name)).date() for name in pytz.all_timezones]
+
+    assert store.get_user(2) is None
+    assert storage.user_today(2, store) == datetime.now(pytz.timezone(storage.DEFAULT_TIMEZONE)).date()
+    assert storage.prune_cutoff() == (min(todays) - timedelta(days=1)).isoformat()
+    assert storage.prune_cutoff() < storage.user_today(1, store).isoformat()
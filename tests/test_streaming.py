@@ -0,0 +1,154 @@
+import asyncio
+import time
+
+import pytest
+import telebot
+import telebot.apihelper
+
+import outbox
+import pages
+import storage
+import streaming
+from fake_telegram import FakeTelegram
+
+ANSWER = "Конечно! Вот несколько идей, как провести выходные: сходить в парк, " * 3
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    server = FakeTelegram().start()
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', server.api_url)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def box(telegram, tmp_path):
+    box = outbox.Outbox(telebot.TeleBot('123456:test', threaded=False),
+                        storage=storage.SQLiteTaskStorage(str(tmp_path / 'tasks.db')))
+    box.start(resume=False)
+    yield box
+    box.stop()
+
+
+@pytest.fixture
+def placeholder(box):
+    """Сообщение "Думаю...", которое правит StreamingReply, и функция правки через outbox."""
+    message = box.send_message(1, "Думаю... 🤔").result(timeout=10)
+
+    def edit(text, reply_markup=None):
+        box.edit_message_text(text, 1, message.message_id, reply_markup=reply_markup)
+
+    return edit
+
+
+def edits(telegram) -> list:
+    return [m['text'] for m in telegram.sent if m['method'] == 'editMessageText']
+
+
+def stream(reply, text: str, duration: float, step: int = 5):
+    """Выдает text кусками по step символов равномерно за duration секунд."""
+    chunks = range(step, len(text) + step, step)
+    for end in chunks:
+        reply.update(text[:end])
+        time.sleep(duration / len(chunks))
+
+
+def test_edit_interval_is_not_below_chat_rate():
+    reply = streaming.StreamingReply(lambda text, reply_markup=None: None, interval=0.1)
+
+    assert reply.interval == pytest.approx(1 / (outbox.CHAT_RATE * outbox.RATE_MARGIN))
+    assert streaming.StreamingReply(None, interval=5).interval == 5
+
+
+def test_partial_answer_is_coalesced_within_chat_rate(telegram, box, placeholder):
+    reply = streaming.StreamingReply(placeholder)
+    stream(reply, ANSWER, duration=2.5)
+    reply.finish(ANSWER.strip())
+    assert box.join(10)
+
+    shown = edits(telegram)
+    # Не чаще раза в MIN_EDIT_INTERVAL плюс окончательный ответ — Telegram ни разу не ответил 429
+    assert 2 <= len(shown) <= 2.5 / streaming.MIN_EDIT_INTERVAL + 1
+    assert telegram.rejected == 0
+    assert all(text.endswith(streaming.CURSOR) for text in shown[:-1])
+    assert shown[-1] == ANSWER.strip()
+    assert [m['method'] for m in telegram.sent].count('sendMessage') == 1
+
+
+def test_small_increments_are_not_shown(telegram, box, placeholder, monkeypatch):
+    monkeypatch.setattr(streaming, 'MIN_EDIT_INTERVAL', 0)
+    reply = streaming.StreamingReply(placeholder, interval=0, min_chars=20)
+
+    for end in range(1, 60):
+        reply.update(ANSWER[:end])
+    assert box.join(10)
+
+    shown = edits(telegram)
+    assert len(shown) == 3
+    lengths = [len(text) - len(streaming.CURSOR) for text in shown]
+    assert all(later - earlier >= 20 - len(streaming.CURSOR) for earlier, later in zip(lengths, lengths[1:]))
+
+
+@pytest.mark.parametrize('answer', [
+    '{"tool_call": "add_task", "arguments": {"date": "2024-05-01", "task": "отчет"}}',
+    '```json\n{"tool_call": "show_tasks", "arguments": {}}\n```',
+])
+def test_tool_calls_are_not_streamed(telegram, box, placeholder, monkeypatch, answer):
+    monkeypatch.setattr(streaming, 'MIN_EDIT_INTERVAL', 0)
+    reply = streaming.StreamingReply(placeholder, interval=0, min_chars=1)
+
+    for end in range(1, len(answer) + 1):
+        reply.update("  " + answer[:end])
+    reply.finish("✅ Добавлено: [2024-05-01] — отчет")
+    assert box.join(10)
+
+    assert edits(telegram) == ["✅ Добавлено: [2024-05-01] — отчет"]
+
+
+def test_final_edit_attaches_buttons_and_is_skipped_when_shown(telegram, box, placeholder):
+    reply = streaming.StreamingReply(placeholder)
+    page = pages.Page("Задачи на 2024-05-01:\n1. отчет")
+    page.reply_markup = telebot.types.InlineKeyboardMarkup()
+    page.reply_markup.add(telebot.types.InlineKeyboardButton("Вперед ▶", callback_data='tp:::a20240501.1'))
+
+    reply.finish(page)
+    reply.finish(str(page))
+    assert box.join(10)
+
+    assert edits(telegram) == [str(page)]
+    assert telegram.sent[-1]['reply_markup']['inline_keyboard'][0][0]['text'] == "Вперед ▶"
+
+
+def test_error_replaces_partial_answer_in_place(telegram, box, placeholder, monkeypatch):
+    monkeypatch.setattr(streaming, 'MIN_EDIT_INTERVAL', 0)
+    reply = streaming.StreamingReply(placeholder, interval=0)
+    reply.update(ANSWER[:40])
+
+    reply.fail("Произошла внутренняя ошибка. Попробуйте позже.")
+    assert box.join(10)
+
+    assert edits(telegram) == [ANSWER[:40] + streaming.CURSOR, "Произошла внутренняя ошибка. Попробуйте позже."]
+    assert [m['method'] for m in telegram.sent].count('sendMessage') == 1
+
+
+def test_async_reply_coalesces_and_fails_in_place(telegram, box, placeholder):
+    async def edit(text, reply_markup=None):
+        placeholder(text, reply_markup)
+
+    async def run():
+        reply = streaming.AsyncStreamingReply(edit)
+        for end in range(5, len(ANSWER), 5):
+            await reply.update(ANSWER[:end])
+            await asyncio.sleep(0.05)
+        await reply.fail("Произошла внутренняя ошибка. Попробуйте позже.")
+
+    started = time.monotonic()
+    asyncio.run(run())
+    elapsed = time.monotonic() - started
+    assert box.join(10)
+
+    shown = edits(telegram)
+    assert 1 <= len(shown) - 1 <= elapsed / streaming.MIN_EDIT_INTERVAL
+    assert shown[-1] == "Произошла внутренняя ошибка. Попробуйте позже."
+    assert telegram.rejected == 0
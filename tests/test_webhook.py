@@ -0,0 +1,120 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import webhook
+
+SECRET = 'secret'
+HEADERS = {webhook.SECRET_HEADER: SECRET}
+
+
+class FakeDispatcher:
+    def __init__(self, pending: int = 0):
+        self.updates = []
+        self.busy = pending
+
+    def submit(self, update):
+        self.updates.append(update)
+
+    def pending(self) -> int:
+        return self.busy + len(self.updates)
+
+
+def message_update(update_id: int, text: str = "привет") -> dict:
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': 1, 'type': 'private'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'user'},
+    }}
+
+
+def run_with_client(server: webhook.WebhookServer, scenario):
+    """Поднимает приложение webhook на локальном порту и выполняет scenario(client)."""
+    async def main():
+        async with TestClient(TestServer(server.make_app())) as client:
+            return await scenario(client)
+    return asyncio.run(main())
+
+
+def test_wrong_secret_is_rejected():
+    dispatcher = FakeDispatcher()
+    server = webhook.WebhookServer(dispatcher, SECRET, path='/telegram')
+
+    async def scenario(client):
+        wrong = await client.post('/telegram', json=message_update(1), headers={webhook.SECRET_HEADER: 'wrong'})
+        missing = await client.post('/telegram', json=message_update(2))
+        return wrong.status, missing.status
+
+    assert run_with_client(server, scenario) == (401, 401)
+    assert dispatcher.updates == []
+
+
+def test_update_is_accepted_and_duplicate_is_dropped():
+    dispatcher = FakeDispatcher()
+    server = webhook.WebhookServer(dispatcher, SECRET, path='/telegram')
+
+    async def scenario(client):
+        first = await client.post('/telegram', json=message_update(7), headers=HEADERS)
+        repeated = await client.post('/telegram', json=message_update(7), headers=HEADERS)
+        return first.status, repeated.status
+
+    assert run_with_client(server, scenario) == (200, 200)
+    assert [update.update_id for update in dispatcher.updates] == [7]
+    assert dispatcher.updates[0].message.text == "привет"
+
+
+def test_invalid_json_is_rejected():
+    dispatcher = FakeDispatcher()
+    server = webhook.WebhookServer(dispatcher, SECRET, path='/telegram')
+
+    async def scenario(client):
+        response = await client.post('/telegram', data=b'{not json', headers=HEADERS)
+        return response.status
+
+    assert run_with_client(server, scenario) == 400
+    assert dispatcher.updates == []
+
+
+def test_full_queue_answers_503_with_retry_after():
+    dispatcher = FakeDispatcher(pending=3)
+    server = webhook.WebhookServer(dispatcher, SECRET, queue_size=3, path='/telegram')
+
+    async def scenario(client):
+        response = await client.post('/telegram', json=message_update(1), headers=HEADERS)
+        return response.status, response.headers.get('Retry-After')
+
+    assert run_with_client(server, scenario) == (503, str(webhook.RETRY_AFTER))
+    assert dispatcher.updates == []
+
+
+def test_update_rejected_while_full_is_accepted_on_redelivery():
+    dispatcher = FakeDispatcher(pending=1)
+    server = webhook.WebhookServer(dispatcher, SECRET, queue_size=1, path='/telegram')
+
+    async def scenario(client):
+        rejected = await client.post('/telegram', json=message_update(5), headers=HEADERS)
+        dispatcher.busy = 0
+        redelivered = await client.post('/telegram', json=message_update(5), headers=HEADERS)
+        return rejected.status, redelivered.status
+
+    assert run_with_client(server, scenario) == (503, 200)
+    assert [update.update_id for update in dispatcher.updates] == [5]
+
+
+def test_healthz_reports_state():
+    dispatcher = FakeDispatcher(pending=2)
+    server = webhook.WebhookServer(dispatcher, SECRET, queue_size=10, path='/telegram')
+
+    async def scenario(client):
+        ok = await client.get('/healthz')
+        ok_body = await ok.json()
+        server.accepting = False
+        stopping = await client.get('/healthz')
+        rejected = await client.post('/telegram', json=message_update(1), headers=HEADERS)
+        return ok.status, ok_body, stopping.status, rejected.status
+
+    status, body, stopping_status, rejected_status = run_with_client(server, scenario)
+    assert status == 200
+    assert body['status'] == 'ok' and body['pending'] == 2 and body['queue_size'] == 10
+    assert stopping_status == 503
+    assert rejected_status == 503
@@ -0,0 +1,214 @@
+import json
+import re
+from datetime import datetime
+
+# Описание инструментов для function calling (формат OpenAI "tools").
+# Эти же схемы используются для проверки аргументов, откуда бы ни пришел вызов:
+# из нативного tool_calls, из JSON в тексте ответа или из локального распознавания.
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "add_task",
+            "description": "Добавляет задачу на дату. Если указано время, в это время придет напоминание.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "date": {"type": "string", "format": "date", "description": "Дата ГГГГ-ММ-ДД"},
+                    "task": {"type": "string", "minLength": 1, "description": "Текст задачи"},
+                    "time": {"type": "string", "pattern": r"^\d{1,2}:\d{2}$", "description": "Время напоминания ЧЧ:ММ"},
+                },
+                "required": ["date", "task"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "show_tasks",
+            "description": "Показывает задачи на дату, на диапазон дат (date — end_date) или все актуальные задачи, если дата не указана.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "date": {"type": "string", "format": "date", "description": "Дата ГГГГ-ММ-ДД"},
+                    "end_date": {"type": "string", "format": "date", "description": "Последняя дата диапазона ГГГГ-ММ-ДД"},
+                },
+                "required": [],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "delete_tasks",
+            "description": "Удаляет задачу с номером task_number на дату или все задачи на дату, если номер не указан.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "date": {"type": "string", "format": "date", "description": "Дата ГГГГ-ММ-ДД"},
+                    "task_number": {"type": "integer", "minimum": 1, "description": "Номер задачи в списке на дату"},
+                },
+                "required": ["date"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "delete_all_tasks",
+            "description": "Удаляет абсолютно все задачи пользователя.",
+            "parameters": {"type": "object", "properties": {}, "required": []},
+        },
+    },
+]
+
+SCHEMAS = {tool["function"]["name"]: tool["function"]["parameters"] for tool in TOOLS}
+
+
+def validate(name: str, arguments) -> tuple:
+    """
+    Проверяет вызов по схеме инструмента. Возвращает (аргументы, None) или (None, текст ошибки).
+    Лишние аргументы отбрасываются, null у необязательных считается отсутствием значения,
+    число в виде строки ("2") приводится к int.
+    """
+    schema = SCHEMAS.get(name)
+    if schema is None:
+        return None, f"неизвестная команда {name}"
+    if arguments is None:
+        arguments = {}
+    if not isinstance(arguments, dict):
+        return None, "аргументы должны быть объектом"
+
+    result = {}
+    for key, rules in schema["properties"].items():
+        value = arguments.get(key)
+        if value is None or value == "":
+            if key in schema["required"]:
+                return None, f"не указан аргумент {key}"
+            continue
+        if rules["type"] == "integer":
+            if isinstance(value, str) and value.strip().isdigit():
+                value = int(value)
+            if not isinstance(value, int) or isinstance(value, bool) or value < rules.get("minimum", value):
+                return None, f"неверное значение {key}: {value}"
+        else:
+            if not isinstance(value, str):
+                return None, f"неверное значение {key}: {value}"
+            value = value.strip()
+            if len(value) < rules.get("minLength", 0):
+                return None, f"не указан аргумент {key}"
+            if rules.get("format") == "date":
+                try:
+                    datetime.strptime(value, "%Y-%m-%d")
+                except ValueError:
+                    return None, f"неверная дата {value}"
+            if "pattern" in rules and not re.match(rules["pattern"], value):
+                return None, f"неверное значение {key}: {value}"
+        result[key] = value
+    return result, None
+
+
+# --- Разбор ответа модели ---
+
+def looks_like_json(text: str) -> bool:
+    """Похоже ли начало ответа на вызов инструмента в JSON (а не на обычный текст)."""
+    return text.lstrip().startswith(("{", "[", "```"))
+
+def repair_json(text: str):
+    """
+    Дешевая локальная починка типичных ошибок модели в JSON: обертка ```json, текст вокруг объекта,
+    одинарные и "умные" кавычки, True/False/None, запятые перед скобкой, незакрытые строки и скобки.
+    Возвращает разобранное значение или None.
+    """
+    text = re.sub(r"^\s*```(?:json)?\s*|\s*```\s*$", "", text.strip())
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        return None
+    text = text[start:]
+    end = max(text.rfind("}"), text.rfind("]"))
+    candidates = [text[:end + 1]] if end >= 0 else []
+    candidates.append(text)  # Возможно, ответ оборван и закрывающих скобок нет вовсе
+
+    for candidate in candidates:
+        fixed = candidate.replace("“", '"').replace("”", '"').replace("«", '"').replace("»", '"')
+        if '"' not in fixed:
+            fixed = fixed.replace("'", '"')
+        fixed = re.sub(r"\bTrue\b", "true", fixed)
+        fixed = re.sub(r"\bFalse\b", "false", fixed)
+        fixed = re.sub(r"\bNone\b", "null", fixed)
+        fixed = re.sub(r",\s*([}\]])", r"\1", fixed)
+        fixed = _close_brackets(fixed)
+        try:
+            return json.loads(fixed)
+        except json.JSONDecodeError:
+            continue
+    return None
+
+def _close_brackets(text: str) -> str:
+    """Дописывает незакрытую строку и скобки в конце оборванного JSON."""
+    stack = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    return re.sub(r",\s*$", "", text) + "".join(reversed(stack))
+
+def _loads(text: str):
+    """json.loads с одной попыткой локальной починки. Возвращает (значение, починен ли) или (None, False)."""
+    try:
+        return json.loads(text), False
+    except (json.JSONDecodeError, TypeError):
+        value = repair_json(text)
+        return value, value is not None
+
+def normalize_calls(value) -> list:
+    """
+    Приводит вызовы к списку {"tool_call": имя, "arguments": {...}}. Понимает один объект
+    {"tool_call": ...}, пакет {"tool_calls": [...]}, список и формат OpenAI {"function": {...}}.
+    Возвращает None, если это не похоже на вызовы инструментов.
+    """
+    if isinstance(value, dict) and isinstance(value.get("tool_calls"), list):
+        value = value["tool_calls"]
+    items = value if isinstance(value, list) else [value]
+    calls = []
+    for item in items:
+        if not isinstance(item, dict):
+            return None
+        if isinstance(item.get("function"), dict):
+            item = item["function"]
+        name = item.get("tool_call") or item.get("name")
+        if not isinstance(name, str):
+            return None
+        arguments = item.get("arguments", {})
+        if isinstance(arguments, str):
+            arguments, _ = _loads(arguments) if arguments.strip() else ({}, False)
+            if arguments is None:
+                return None
+        calls.append({"tool_call": name, "arguments": arguments})
+    return calls or None
+
+def parse_tool_calls(text: str):
+    """
+    Извлекает вызовы инструментов из текста ответа (режим JSON без нативного function calling).
+    Возвращает (вызовы, починен ли JSON). Вызовы — [] для обычного текста, None для JSON,
+    который не удалось разобрать даже после починки.
+    """
+    if not looks_like_json(text):
+        return [], False
+    value, repaired = _loads(text)
+    if value is None:
+        return None, False
+    return normalize_calls(value), repaired
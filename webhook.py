@@ -0,0 +1,161 @@
+# Режим webhook: python webhook.py
+#
+# Вместо long polling Telegram сам присылает обновления POST-запросами на WEBHOOK_URL.
+# Небольшой сервер на aiohttp проверяет секретный заголовок, сразу отвечает Telegram
+# и передает обновление диспетчеру из async_main.py: разные чаты обрабатываются
+# параллельно, сообщения одного чата — по очереди. Если необработанных обновлений
+# накопилось больше WEBHOOK_QUEUE_SIZE, сервер отвечает 503 и Telegram повторит доставку
+# позже. Повторно доставленные обновления отбрасываются по update_id.
+# Несколько экземпляров можно поставить за балансировщиком, /healthz — проверка живости.
+import asyncio
+import hmac
+import os
+import secrets
+import signal
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from aiohttp import web
+from dotenv import load_dotenv
+from telebot import types
+
+load_dotenv() # До импорта модулей бота: они читают настройки при импорте
+
+import async_main
+import metrics
+import openrouter_ai
+import main as sync_main
+
+# Публичный адрес webhook. Если задан, бот сам регистрирует его в Telegram (setWebhook)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH') or urlsplit(WEBHOOK_URL).path or '/telegram'
+# Секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Сколько принятых, но еще не обработанных обновлений допускается до ответа 503
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+# Сколько последних update_id помнить для отбрасывания повторных доставок
+DEDUPE_SIZE = 10000
+# Через сколько секунд предлагать повторить доставку при перегрузке (заголовок Retry-After)
+RETRY_AFTER = 1
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class RecentIds:
+    """Ограниченное множество последних номеров обновлений."""
+
+    def __init__(self, max_size: int = DEDUPE_SIZE):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+
+    def add(self, update_id: int) -> bool:
+        """Запоминает номер. Возвращает False, если он уже встречался."""
+        if update_id in self._ids:
+            return False
+        self._ids[update_id] = None
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return True
+
+
+class WebhookServer:
+    """Прием обновлений от Telegram: проверка секрета, ограничение очереди, отбрасывание повторов."""
+
+    def __init__(self, dispatcher, secret: str = WEBHOOK_SECRET, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 path: str = WEBHOOK_PATH):
+        self.dispatcher = dispatcher
+        self.secret = secret
+        self.queue_size = queue_size
+        self.path = path
+        self.accepting = True  # False во время остановки: новые обновления получают 503
+        self._recent = RecentIds()
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/healthz', self.health)
+        return app
+
+    def _reply(self, result: str, status: int = 200, **headers) -> web.Response:
+        metrics.inc('webhook_updates_total', result=result)
+        return web.Response(status=status, headers=headers)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            return self._reply('unauthorized', 401)
+        if not self.accepting:
+            return self._reply('stopping', 503, **{'Retry-After': str(RETRY_AFTER)})
+        if self.dispatcher.pending() >= self.queue_size:
+            # Не подтверждаем обновление: Telegram повторит его, когда очередь разберется
+            return self._reply('overloaded', 503, **{'Retry-After': str(RETRY_AFTER)})
+        try:
+            update = types.Update.de_json(await request.json())
+        except Exception as e:
+            print(f"Webhook: некорректное обновление: {e}")
+            return self._reply('invalid', 400)
+        if not self._recent.add(update.update_id):
+            return self._reply('duplicate')
+        self.dispatcher.submit(update)
+        return self._reply('accepted')
+
+    async def health(self, request: web.Request) -> web.Response:
+        data = {
+            'status': 'ok' if self.accepting else 'stopping',
+            'pending': self.dispatcher.pending(),
+            'queue_size': self.queue_size,
+            'outbox_pending': async_main.outbox.pending(),
+        }
+        return web.json_response(data, status=200 if self.accepting else 503)
+
+
+async def run(stop_event: asyncio.Event = None):
+    """Работает до сигнала SIGINT/SIGTERM (или до stop_event, если его передали — например, из benchmark.py)."""
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                pass # Windows: остановка по Ctrl+C через KeyboardInterrupt
+
+    secret = WEBHOOK_SECRET
+    if not secret and WEBHOOK_URL:
+        secret = secrets.token_urlsafe(32) # Адрес регистрируем сами, поэтому и секрет можем выбрать сами
+    if not secret:
+        print("Внимание: WEBHOOK_SECRET не задан, запросы к webhook не проверяются.")
+
+    server = WebhookServer(async_main.dispatcher, secret)
+    runner = web.AppRunner(server.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    print(f"Webhook слушает http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    if WEBHOOK_URL:
+        await async_main.bot.set_webhook(url=WEBHOOK_URL, secret_token=secret)
+        print(f"Webhook зарегистрирован: {WEBHOOK_URL}")
+
+    await stop_event.wait()
+
+    # Мягкая остановка: новые обновления получают 503 (Telegram доставит их повторно),
+    # уже принятые дорабатываем. Webhook не удаляем — после перезапуска доставка продолжится.
+    print("Остановка: дожидаемся обработки текущих сообщений...")
+    server.accepting = False
+    if not await async_main.dispatcher.join(async_main.SHUTDOWN_TIMEOUT):
+        print(f"Не дождались обработки {async_main.dispatcher.pending()} обновлений.")
+    await runner.cleanup()
+    if not await asyncio.to_thread(async_main.outbox.join, async_main.SHUTDOWN_TIMEOUT):
+        print(f"Не успели отправить {async_main.outbox.pending()} сообщений.")
+    await async_main.bot.close_session()
+    await openrouter_ai.close_async_client()
+    print("Бот остановлен.")
+
+if __name__ == '__main__':
+    sync_main.start_background_services()
+
+    print("AI-бот (режим webhook) запускается...")
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass